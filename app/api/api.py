@@ -1,12 +1,125 @@
 
 # proj imports
+from app.api import config
 from app.api.routes.report_router import router as report_router
+from app.api.routes.metrics_router import router as metrics_router
+from app.api.routes.live_router import router as live_router
+from app.api.routes.health_router import router as health_router
+from app.api.routes.report_router import warm_up_report_path
+from app.api.jobs import ReportJobStore
+from app.api.workers import EtlWorkerPool
+from app.data_processor.cache import ParquetCache
+from app.data_processor.metrics import METRICS, collect_request_stages, server_timing
 
 # lib imports
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from time import perf_counter
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''
+    Own the resources shared by all requests for the lifetime of the app
+    '''
+    # the data stack is only imported here, after the app itself is up
+    from app.data_processor.connections import DuckDBConnectionPool
+    from app.data_processor.live import LiveDayAggregates
+
+    app.state.ready = not config.WARM_UP_ENABLED
+    app.state.duckdb_pool = DuckDBConnectionPool(size=config.DUCKDB_POOL_SIZE,
+                                                 machines_csv=config.MACHINES_CSV,
+                                                 sensors_csv=config.SENSORS_CSV)
+    app.state.parquet_cache = ParquetCache(cache_dir=config.CACHE_DIR, max_bytes=config.CACHE_MAX_BYTES)
+    app.state.worker_pool = EtlWorkerPool(max_workers=config.ETL_WORKERS, max_pending=config.ETL_MAX_PENDING)
+    app.state.report_jobs = ReportJobStore(ttl_seconds=config.REPORT_JOB_TTL_SECONDS,
+                                           max_active=config.REPORT_JOBS_MAX_ACTIVE)
+    app.state.live_day = LiveDayAggregates(flush_dir=config.LIVE_DIR)
+    live_flusher = asyncio.create_task(flush_live_aggregates(app))
+    lookups_watcher = asyncio.create_task(watch_lookups(app))
+    warm_up = asyncio.create_task(warm_up_app(app)) if config.WARM_UP_ENABLED else None
+    yield
+    if warm_up is not None:
+        warm_up.cancel()
+    live_flusher.cancel()
+    lookups_watcher.cancel()
+    app.state.live_day.flush()
+    await app.state.report_jobs.shutdown()
+    app.state.worker_pool.shutdown()
+    app.state.duckdb_pool.close()
+
+
+async def flush_live_aggregates(app: FastAPI):
+    '''
+    Periodically persist the live aggregates, a restart then only loses the readings of the last period
+    '''
+    while True:
+        await asyncio.sleep(config.LIVE_FLUSH_SECONDS)
+        try:
+            await app.state.worker_pool.run(app.state.live_day.flush)
+        except Exception as e:
+            print(f"[ERROR] failed flushing the live aggregates: {e}")
+
+
+async def watch_lookups(app: FastAPI):
+    '''
+    Periodically check the lookup files, so a changed lookup is reloaded (and swapped in) off the request path
+    '''
+    while True:
+        await asyncio.sleep(config.LOOKUP_WATCH_SECONDS)
+        try:
+            await app.state.worker_pool.run(app.state.duckdb_pool.refresh_lookups)
+        except Exception as e:
+            print(f"[ERROR] failed reloading the lookups: {e}")
+
+
+async def warm_up_app(app: FastAPI):
+    '''
+    Warm the report path up on the worker pool, retried until it succeeds (e.g. once the lookups are mounted),
+    then mark the app ready
+    '''
+    while True:
+        started = perf_counter()
+        try:
+            await app.state.worker_pool.run(warm_up_report_path, app.state.duckdb_pool)
+        except Exception as e:
+            print(f"[ERROR] failed warming up, retrying in {config.RETRY_AFTER_SECONDS}s: {e}")
+            await asyncio.sleep(config.RETRY_AFTER_SECONDS)
+            continue
+        app.state.ready = True
+        print(f"[INFO] warmed up in {perf_counter() - started:.2f}s, ready")
+        return
+
 
 app = FastAPI(
     title='Summery Report API',
-    description='Insert Sensor data reading, will return summary!'
+    description='Insert Sensor data reading, will return summary!',
+    lifespan=lifespan
 )
 app.include_router(report_router)
+app.include_router(metrics_router)
+app.include_router(live_router)
+app.include_router(health_router)
+METRICS.enabled = config.METRICS_ENABLED
+
+
+@app.middleware('http')
+async def stage_timing(request: Request, call_next):
+    '''
+    Collect the stages a request ran (in worker threads too, they inherit its context) into a Server-Timing
+    header, and count the request per route
+    '''
+    if not METRICS.enabled:
+        return await call_next(request)
+
+    started = perf_counter()
+    with collect_request_stages() as records:
+        response = await call_next(request)
+    seconds = perf_counter() - started
+    response.headers['Server-Timing'] = server_timing(records, total_seconds=seconds)
+
+    # route template rather than the raw path, so ids in paths don't blow up the label set
+    route = getattr(request.scope.get('route'), 'path', 'unmatched')
+    METRICS.record_request(request.method, route, response.status_code, seconds)
+    return response
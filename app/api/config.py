@@ -0,0 +1,55 @@
+""" API configuration, read once from environment variables with sane defaults"""
+
+# lib imports
+import os
+
+# data dir defaults to the project's data dir, wherever the app is run from (docker or local)
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.path.dirname(__file__), '..', '..', 'data'))
+SENSORS_CSV = os.path.join(DATA_DIR, 'csv', 'Sensors.csv')
+MACHINES_CSV = os.path.join(DATA_DIR, 'csv', 'Machines.csv')
+
+# number of duckdb connections report requests can borrow concurrently
+DUCKDB_POOL_SIZE = int(os.environ.get('DUCKDB_POOL_SIZE', os.cpu_count() or 4))
+
+# rows per chunk when streaming uploads through the onboarding etl
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 250_000))
+
+# etl worker threads, and how many report requests may be admitted at once before answering 503
+ETL_WORKERS = int(os.environ.get('ETL_WORKERS', os.cpu_count() or 4))
+ETL_MAX_PENDING = int(os.environ.get('ETL_MAX_PENDING', 4 * ETL_WORKERS))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 5))
+
+# persistent cache of onboarded days and summaries, evicted least recently used first beyond its size
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(DATA_DIR, 'parquet', 'cache'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# date partitioned sensor data lake, backing the multi day reports
+LAKE_DIR = os.environ.get('LAKE_DIR', os.path.join(DATA_DIR, 'lake'))
+
+# per stage metrics (/metrics and the Server-Timing header), cheap enough to leave on
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+
+# background report jobs: how many may be queued or running at once, and how long finished ones are kept
+REPORT_JOBS_MAX_ACTIVE = int(os.environ.get('REPORT_JOBS_MAX_ACTIVE', ETL_MAX_PENDING))
+REPORT_JOB_TTL_SECONDS = int(os.environ.get('REPORT_JOB_TTL_SECONDS', 3600))
+
+# persist freshly onboarded days to the cache (reports themselves run on the in memory copies)
+CACHE_ONBOARDED_DAYS = os.environ.get('CACHE_ONBOARDED_DAYS', '1').lower() not in ('0', 'false', 'no')
+
+# plain csv days uploaded up to this many bytes are onboarded in memory; larger (and compressed) ones are streamed
+# into the cache by UPLOAD_CHUNK_SIZE rows and scanned from there, so their memory stays bounded whatever the size
+IN_MEMORY_ONBOARD_MAX_BYTES = int(os.environ.get('IN_MEMORY_ONBOARD_MAX_BYTES', 256 * 1024 ** 2))
+
+# live intra-day aggregates, flushed to (and restored from) their own dir, so partial days never reach the lake
+LIVE_DIR = os.environ.get('LIVE_DIR', os.path.join(DATA_DIR, 'live'))
+LIVE_FLUSH_SECONDS = float(os.environ.get('LIVE_FLUSH_SECONDS', 30))
+
+# warm the report path up with a tiny synthetic report at startup, /readyz answers 503 until it ran
+WARM_UP_ENABLED = os.environ.get('WARM_UP_ENABLED', '1').lower() not in ('0', 'false', 'no')
+
+# how often the lookup files are checked for changes, a changed lookup is swapped in as a new versioned index
+LOOKUP_WATCH_SECONDS = float(os.environ.get('LOOKUP_WATCH_SECONDS', 10))
+
+# batch reports: sites accepted per request, and how many of them are onboarded and summarized at once
+BATCH_MAX_SITES = int(os.environ.get('BATCH_MAX_SITES', 100))
+BATCH_MAX_CONCURRENT_SITES = int(os.environ.get('BATCH_MAX_CONCURRENT_SITES', ETL_WORKERS))
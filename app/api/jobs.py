@@ -0,0 +1,131 @@
+""" Background report jobs: submitted once, polled by id, deduplicated by content and kept for a ttl"""
+
+# proj imports
+from app.api.workers import QueueFullError
+
+# lib imports
+import asyncio
+import contextvars
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# job steps in the order they run, with the progress reported while in them
+JOB_STEPS = {'queued': 0.0, 'onboarding': 0.1, 'summarizing': 0.7, 'done': 1.0}
+
+
+@dataclass
+class ReportJob:
+    '''
+    State of one report job, only touched from the event loop thread
+    '''
+    job_id: str
+    key: str
+    status: str = 'queued'  # queued, running, succeeded or failed
+    step: str = 'queued'
+    result: Any = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+
+    @property
+    def progress(self) -> float:
+        return JOB_STEPS[self.step]
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('succeeded', 'failed')
+
+
+class ReportJobStore:
+    '''
+    Runs report jobs as event loop tasks (their blocking work goes to the worker pool) and keeps them until their
+    ttl runs out after they finish. Submissions with the same key share one job, unless that job failed.
+    '''
+
+    def __init__(self, ttl_seconds: float, max_active: int):
+        '''
+        :param ttl_seconds: how long a finished job (and its result) is kept
+        :param max_active: number of queued or running jobs accepted at once
+        '''
+        self.ttl_seconds = ttl_seconds
+        self.max_active = max_active
+        self._jobs: Dict[str, ReportJob] = {}
+        self._keys: Dict[str, str] = {}  # dedup key -> job id
+
+    @property
+    def active(self) -> int:
+        return sum(not job.finished for job in self._jobs.values())
+
+    def find(self, key: str) -> Optional[ReportJob]:
+        '''
+        :param key: dedup key of a submission
+        :return: the live job sharing that key, if any
+        '''
+        self.purge_expired()
+        job = self._jobs.get(self._keys.get(key, ''))
+        return job if job is not None and job.status != 'failed' else None
+
+    def get(self, job_id: str) -> Optional[ReportJob]:
+        self.purge_expired()
+        return self._jobs.get(job_id)
+
+    def submit(self, key: str, run: Callable[[ReportJob], Awaitable[Any]]) -> ReportJob:
+        '''
+        Start a job, or return the live one already submitted with the same key
+        :param key: dedup key, e.g. a content hash of the inputs
+        :param run: coroutine function producing the job's result, may report its step by setting job.step
+        :raise QueueFullError: if max_active jobs are already queued or running
+        :return: the job
+        '''
+        job = self.find(key)
+        if job is not None:
+            return job
+        if self.active >= self.max_active:
+            raise QueueFullError(f"{self.active} report jobs active, limit is {self.max_active}")
+
+        job = ReportJob(job_id=uuid.uuid4().hex, key=key)
+        self._jobs[job.job_id] = job
+        self._keys[key] = job.job_id
+        # fresh context, the job outlives the submitting request and must not report into it
+        job.task = asyncio.get_running_loop().create_task(self._run(job, run), context=contextvars.Context())
+        return job
+
+    async def _run(self, job: ReportJob, run: Callable[[ReportJob], Awaitable[Any]]):
+        job.status = 'running'
+        try:
+            job.result = await run(job)
+            job.status = 'succeeded'
+            job.step = 'done'
+        except asyncio.CancelledError:
+            job.status, job.error = 'failed', 'cancelled'
+            raise
+        except Exception as e:
+            print(f"[ERROR] report job {job.job_id} failed: {e}")
+            job.status, job.error = 'failed', getattr(e, 'detail', None) or str(e)
+        finally:
+            job.finished_at = time.time()
+
+    def purge_expired(self):
+        now = time.time()
+        expired = [job for job in self._jobs.values()
+                   if job.finished and now - job.finished_at >= self.ttl_seconds]
+        for job in expired:
+            del self._jobs[job.job_id]
+            if self._keys.get(job.key) == job.job_id:
+                del self._keys[job.key]
+
+    async def shutdown(self):
+        '''
+        Cancel the jobs still in progress and wait for them to unwind
+        '''
+        tasks = [job.task for job in self._jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    pass
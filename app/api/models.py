@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 
 class MachineMetadata(BaseModel):
@@ -28,3 +28,79 @@ class ReportResponse(BaseModel):
     """
     machines: List[MachineMetadata]  # Summary for each machine/coordinate pair
     metadata: ReportMetadata  # Information about the input data used
+
+
+class WindowReportMetadata(BaseModel):
+    """
+    Metadata describing the context of a multi day (window) report.
+    """
+    date: str  # Date the report is for
+    window: int  # Window size in days
+    mode: str  # 'trailing' (date vs trailing window) or 'period' (window vs the window before it)
+    current_start: str  # First date of the compared range
+    baseline_start: str  # First date of the baseline range
+    baseline_end: str  # Last date of the baseline range
+
+
+class WindowReportResponse(BaseModel):
+    """
+    API response of a multi day report, machine summaries compared against a multi day baseline.
+    """
+    machines: List[MachineMetadata]  # Summary for each machine/coordinate pair
+    metadata: WindowReportMetadata  # Information about the compared date ranges
+
+
+class ReportJobStatus(BaseModel):
+    """
+    State of a background report job, carrying the report once it succeeded.
+    """
+    job_id: str  # Id to poll the job with, GET /report/{job_id}
+    status: str  # 'queued', 'running', 'succeeded' or 'failed'
+    step: str  # Step the job is in ('queued', 'onboarding', 'summarizing' or 'done')
+    progress: float  # Rough completion, from 0 to 1
+    error: Optional[str] = None  # Why the job failed
+    result: Optional[ReportResponse] = None  # The report, once the job succeeded
+
+
+class SiteReport(BaseModel):
+    """
+    Outcome of one site of a batch report, carrying its report once it succeeded.
+    """
+    site: str  # Site the uploaded files were tagged with
+    status: str  # 'succeeded' or 'failed'
+    error: Optional[str] = None  # Why the site failed
+    report: Optional[ReportResponse] = None  # The site's report, once it succeeded
+
+
+class BatchReportResponse(BaseModel):
+    """
+    API response of a batch report, one entry per site in submission order.
+    """
+    sites: List[SiteReport]  # Report (or failure) of every site
+
+
+class LiveIngestResponse(BaseModel):
+    """
+    Outcome of appending a batch of readings to the live aggregates.
+    """
+    date: Optional[str] = None  # Day the live aggregates are for, None until a reading arrived
+    rows: int  # Readings added to the day's aggregates
+    late_rows: int  # Readings dropped for belonging to a day before it
+    unmapped_rows: int  # Readings whose tag is not in the sensors lookup
+
+
+class LiveReportMetadata(BaseModel):
+    """
+    Metadata describing the context of a live (intra-day) report.
+    """
+    date: str  # Day the live aggregates are for
+    yesterday_source: str  # Where yesterday's aggregates came from, 'lake' or 'live'
+    last_sample_time: Optional[str] = None  # Latest reading folded in so far, iso timestamp
+
+
+class LiveReportResponse(BaseModel):
+    """
+    API response of a live report, today's readings so far compared against yesterday.
+    """
+    machines: List[MachineMetadata]  # Summary for each machine/coordinate pair
+    metadata: LiveReportMetadata  # Information about the compared days
@@ -0,0 +1,23 @@
+# lib imports
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+# router
+router = APIRouter()
+
+@router.get('/healthz', include_in_schema=False)
+async def healthz():
+    '''
+    Liveness, the process is up and serving
+    '''
+    return {'status': 'ok'}
+
+
+@router.get('/readyz', include_in_schema=False)
+async def readyz(request: Request):
+    '''
+    Readiness, green once the startup warm-up ran the report path end to end
+    '''
+    if not getattr(request.app.state, 'ready', False):
+        return JSONResponse({'status': 'warming up'}, status_code=503)
+    return {'status': 'ready'}
@@ -0,0 +1,122 @@
+
+# annotations are not evaluated, so the data stack types below are only imported by type checkers
+from __future__ import annotations
+
+# proj imports
+from app.api import config
+from app.api.models import LiveIngestResponse, LiveReportMetadata, LiveReportResponse
+from app.api.routes.report_router import CSV_CONTENT_TYPES, REPORT_COLUMNS, summary_ranking
+from app.api.workers import QueueFullError
+from app.data_processor.lake import aggregates_parquet
+
+# lib imports
+from fastapi import APIRouter, HTTPException, Request, Depends
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+import datetime
+import io
+import os
+
+# imported on first use, like the report router's data stack
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from app.data_processor.connections import DuckDBConnectionPool
+    from app.data_processor.live import LiveDayAggregates
+    from app.data_processor.lookups import LookupIndex
+
+# router
+router = APIRouter()
+
+
+@router.post('/live/readings', response_model=LiveIngestResponse)
+async def ingest_readings(request: Request):
+    '''
+    append a small batch of readings to today's live aggregates
+    :body: csv of Tag Name,Timestamp,Value rows (plain or gzip/zstd compressed), as in a day file
+    :return: Response following the LiveIngestResponse model.
+    '''
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    if content_type not in CSV_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Expected a csv body, got '{content_type}'")
+
+    duckdb_pool = request.app.state.duckdb_pool
+    try:
+        lookup = duckdb_pool.lookup_index
+    except FileNotFoundError:
+        raise HTTPException(status_code=500, detail="Required metadata files not found in system!")
+
+    body = await request.body()
+    worker_pool = request.app.state.worker_pool
+    try:
+        async with worker_pool.admission():
+            return LiveIngestResponse(**await worker_pool.run(_append_readings, request.app.state.live_day,
+                                                              body, lookup))
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Too many requests in progress, try again later",
+                            headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)})
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid readings: {e}")
+
+
+@router.get('/live/report', response_model=LiveReportResponse)
+async def make_live_report(request: Request, ranking: Dict = Depends(summary_ranking)):
+    '''
+    create a summary report of today's readings so far against yesterday, from the live aggregates
+    :param ranking: top_k, min_increase, increase_mode, machines and sort_by query parameters
+    :return: Response following the LiveReportResponse model.
+    '''
+    live_day: LiveDayAggregates = request.app.state.live_day
+    date = live_day.date
+    if date is None:
+        raise HTTPException(status_code=404, detail="No live readings yet")
+    yesterday_source = _yesterday_aggregates(date)
+    if yesterday_source is None:
+        raise HTTPException(status_code=404, detail=f"No sensor data for the day before {date}")
+
+    # Tiny aggregate tables only, no need to go through the worker pool's admission
+    yesterday_aggregates, source = yesterday_source
+    summary = await request.app.state.worker_pool.run(_make_live_summary_report, request.app.state.duckdb_pool,
+                                                      yesterday_aggregates, live_day.snapshot(), ranking)
+    last_sample_time = live_day.last_sample_time
+    columns = summary.select(REPORT_COLUMNS).to_pydict()
+    return LiveReportResponse(
+        machines=[dict(zip(REPORT_COLUMNS, row)) for row in zip(*columns.values())],
+        metadata=LiveReportMetadata(
+            date=date,
+            yesterday_source=source,
+            last_sample_time=None if last_sample_time is None else datetime.datetime.fromtimestamp(
+                last_sample_time / 1_000_000, tz=datetime.timezone.utc).isoformat()
+        )
+    )
+
+
+def _append_readings(live_day: LiveDayAggregates, body: bytes, lookup: LookupIndex) -> Dict:
+    from app.data_processor.extract import extract_csv
+    return live_day.append(machine_reading_df=extract_csv(io.BytesIO(body)), sensors_lookup_df=lookup)
+
+
+def _yesterday_aggregates(date: str) -> Optional[Tuple[str, str]]:
+    '''
+    Aggregates of the day before `date`, from the lake if it landed there, otherwise the live aggregates' last flush
+    :return: the aggregates parquet and where it came from, or None if neither has it
+    '''
+    yesterday = (datetime.date.fromisoformat(date) - datetime.timedelta(days=1)).isoformat()
+    for source, base_dir in [('lake', config.LAKE_DIR), ('live', config.LIVE_DIR)]:
+        parquet_path = aggregates_parquet(base_dir, yesterday)
+        if os.path.isfile(parquet_path):
+            return parquet_path, source
+    return None
+
+
+def _make_live_summary_report(duckdb_pool: DuckDBConnectionPool, yesterday_aggregates: str,
+                              today_aggregates: pa.Table, ranking: Dict) -> pa.Table:
+    '''
+    Produce the live summary report on a connection borrowed from the pool, blocks until one is free
+    '''
+    from app.data_processor.analysis import make_summary_report_from_aggregates
+    with duckdb_pool.connection() as con:
+        return make_summary_report_from_aggregates(yesterday_aggregates=yesterday_aggregates,
+                                                   today_aggregates=today_aggregates, connection=con,
+                                                   as_arrow=True, **ranking)
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,16 @@
+# proj imports
+from app.data_processor.metrics import METRICS
+
+# lib imports
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+# router
+router = APIRouter()
+
+@router.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    '''
+    Per stage and per route totals, in Prometheus text exposition format
+    '''
+    return PlainTextResponse(METRICS.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,83 +1,723 @@
 
+# annotations are not evaluated, so the data stack types below are only imported by type checkers
+from __future__ import annotations
+
 # proj imports
-from app.data_processor.pipeline import produce_summary_report_etl, onboard_machine_readings_etl
-from app.api.models import ReportMetadata, ReportResponse, MachineMetadata
+from app.api import config
+from app.api.models import ReportMetadata, ReportResponse, MachineMetadata, WindowReportMetadata, \
+    WindowReportResponse, ReportJobStatus, BatchReportResponse
+from app.api.jobs import ReportJob, ReportJobStore
+from app.api.workers import EtlWorkerPool, QueueFullError
+from app.data_processor.cache import ParquetCache, hash_file, hash_key
+from app.data_processor.metrics import unrecorded
+from app.data_processor.options import WINDOW_REPORT_MODES, INCREASE_MODES, SUMMARY_SORT_KEYS
+from app.data_processor.lake import list_lake_dates, parse_date
 
 # lib imports
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from typing import List
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request, Query, Response, Depends
+from fastapi.responses import StreamingResponse
+from typing import TYPE_CHECKING, AsyncIterator, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+import asyncio
+import contextlib
+import datetime
+import functools
+import io
+import json
 import os
+import re
+import shutil
 import tempfile
-import pandas as pd
+import time
+import urllib.parse
+
+# the data stack (pandas, pyarrow and the etl on top of them) is imported on first use, by the startup warm-up,
+# so the app and its health checks come up without it
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+    from app.data_processor.connections import DuckDBConnectionPool
+    from app.data_processor.lookups import LookupIndex
 
 # router
 router = APIRouter()
 
-@router.post('/report', response_model=ReportResponse)
+# report formats, negotiated on the Accept header: json (default), an Arrow IPC stream or the summary parquet itself
+JSON_MEDIA_TYPE = 'application/json'
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_MEDIA_TYPE = 'application/x-parquet'
+REPORT_MEDIA_TYPES = (JSON_MEDIA_TYPE, ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE)
+
+# batch reports can be streamed instead, one site report json per line as each site finishes
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+REPORT_COLUMNS = list(MachineMetadata.model_fields)
+
+# uploads are plain, gzip or zstd compressed csvs (told apart by their magic bytes, not their content type)
+CSV_CONTENT_TYPES = ('text/csv', 'application/gzip', 'application/x-gzip', 'application/zstd',
+                     'application/octet-stream')
+
+# a day may be uploaded as several part files (e.g. one per machine), named after it: 2024-01-02.CR1.csv.gz
+DAY_FILENAME = re.compile(r'^(\d{4}-\d{2}-\d{2})')
+
+
+def summary_ranking(
+        top_k: int = Query(1, ge=1, le=1000, description="coordinates reported per machine"),
+        min_increase: float = Query(0.0, description="only increases strictly above it are reported"),
+        increase_mode: str = Query('absolute', enum=list(INCREASE_MODES),
+                                   description="'relative' increases are fractions of yesterday's average"),
+        machines: Optional[List[str]] = Query(None, description="machine codes to report on, all by default"),
+        sort_by: str = Query('increase', enum=list(SUMMARY_SORT_KEYS))
+) -> Dict:
+    '''
+    Ranking parameters of a summary report, as make_summary_report keyword arguments
+    '''
+    if increase_mode not in INCREASE_MODES or sort_by not in SUMMARY_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"increase_mode must be one of {INCREASE_MODES} and sort_by "
+                                                    f"one of {tuple(SUMMARY_SORT_KEYS)}")
+    return {'top_k': top_k, 'min_increase': min_increase, 'increase_mode': increase_mode,
+            'machine_codes': sorted(set(machines)) if machines is not None else None, 'sort_by': sort_by}
+
+@router.post('/report', response_model=ReportResponse,
+             responses={200: {'content': {ARROW_STREAM_MEDIA_TYPE: {}, PARQUET_MEDIA_TYPE: {}}}})
 async def make_report(
-        machine_readings_csv: List[UploadFile] = File(...)
+        request: Request,
+        machine_readings_csv: List[UploadFile] = File(...),
+        ranking: Dict = Depends(summary_ranking)
 ):
     '''
     create a summary report through api request
-    :param machine_readings_csv: List of two following sensor data readings, the second being the more recent reading
-    :return: Response following the ReportResponse model.
+    :param machine_readings_csv: Two following days of sensor data readings, plain or gzip/zstd compressed csvs.
+     Either two files, the second being the more recent day, or any number of part files named after their day
+     (e.g. 2024-01-01.CR1.csv.gz), exactly two days between them
+    :param ranking: top_k, min_increase, increase_mode, machines and sort_by query parameters
+    :return: Response following the ReportResponse model, or with `Accept: application/vnd.apache.arrow.stream`
+     / `application/x-parquet` the machines as an Arrow stream / parquet, the metadata in (percent-encoded)
+     X-Report-* headers.
     '''
 
-    # Check for correct file type
-    for f in machine_readings_csv:
-        if f.content_type != 'text/csv':
-            raise HTTPException(status_code=400, detail=f"Invalid file type for {f.filename}")
+    # Pick the response format upfront, no point running the etl for a format we can't answer in
+    media_type = negotiate_report_media_type(request.headers.get('accept'))
+    if media_type is None:
+        raise HTTPException(status_code=406, detail=f"Supported report formats: {', '.join(REPORT_MEDIA_TYPES)}")
+
+    # Check for correct file types, and which day each file belongs to
+    days = _check_uploads(machine_readings_csv)
 
-    # Check if metadata exists
-    sensors_csv = os.path.join("data", "csv", "Sensors.csv")
-    machines_csv = os.path.join("data", "csv", "Machines.csv")
-    if not os.path.exists(sensors_csv) or not os.path.exists(machines_csv):
+    # Check if metadata exists, lookups are preloaded by the pool and reloaded only on change
+    duckdb_pool = request.app.state.duckdb_pool
+    try:
+        lookup = duckdb_pool.lookup_index
+    except FileNotFoundError:
         raise HTTPException(status_code=500, detail="Required metadata files not found in system!")
 
-    # Create Workspace
-    with tempfile.TemporaryDirectory() as tmpdir:
-
-        # Save input CSVs temporarily
-        yesterday_csv_path = os.path.join(tmpdir, "yesterday.csv")
-        today_csv_path = os.path.join(tmpdir, "today.csv")
-        with open(yesterday_csv_path, "wb") as f:
-            f.write(await machine_readings_csv[0].read()) # Save yesterday
-        with open(today_csv_path, "wb") as f:
-            f.write(await machine_readings_csv[1].read()) # Save today
-
-        # Save uploaded files to tempdir
-        yesterday_parquet = os.path.join(tmpdir,'yesterday_sensor_data.parquet')
-        today_parquet = os.path.join(tmpdir,'today_sensor_data.parquet')
-        onboard_machine_readings_etl(machine_readings_csv=yesterday_csv_path, sensors_csv=sensors_csv,
-                                     output_parquet=yesterday_parquet)
-        onboard_machine_readings_etl(machine_readings_csv=today_csv_path, sensors_csv=sensors_csv,
-                                     output_parquet=today_parquet)
-
-        output_parquets = [yesterday_parquet, today_parquet]
-        summary_parquet = os.path.join(tmpdir, 'summary_report.parquet')
-        produce_summary_report_etl(sensor_data_parquets=output_parquets,
-                                   machines_lookup_csv=machines_csv,
-                                   output_path=summary_parquet)
-
-        # JSONify
-        summary_date = machine_readings_csv[1].filename.split('.')[0]
-        df = pd.read_parquet(summary_parquet)
-        records = df.to_dict(orient="records")
-
-        # Create list of Pydantic machine models efficiently
-        machines = [MachineMetadata(**rec) for rec in records]
-
-        # Construct response
-        response = ReportResponse(
-            machines=machines,
-            metadata=ReportMetadata(
-                date=summary_date,
-                yesterday_data=machine_readings_csv[0].filename,
-                today_data=machine_readings_csv[1].filename
-            )
+    # Admission control, refuse early rather than queue unboundedly behind the workers
+    worker_pool = request.app.state.worker_pool
+    try:
+        async with worker_pool.admission():
+            filenames = [f.filename for f in machine_readings_csv]
+            summary = await _run_report_pipeline(worker_pool, duckdb_pool, request.app.state.parquet_cache,
+                                                 lookup, [f.file for f in machine_readings_csv], days,
+                                                 ranking=ranking)
+            content = await worker_pool.run(_render_report, summary, filenames, days, media_type)
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Too many reports in progress, try again later",
+                            headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)})
+
+    # Already serialised, bypass the response model (header values are percent-encoded, filenames needn't be latin-1)
+    headers = {} if media_type == JSON_MEDIA_TYPE else \
+        {f"X-Report-{key.title().replace('_', '-')}": urllib.parse.quote(value, safe='/,:')
+         for key, value in _report_metadata(filenames, days).items()}
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+def negotiate_report_media_type(accept: Optional[str]) -> Optional[str]:
+    '''
+    Pick the report format from an Accept header, by quality then order
+    :param accept: Accept header value, e.g. 'application/vnd.apache.arrow.stream, application/json;q=0.5'
+    :return: one of REPORT_MEDIA_TYPES, or None if none is acceptable
+    '''
+    if not accept:
+        return JSON_MEDIA_TYPE
+
+    media_ranges = []
+    for media_range in accept.split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_ranges.append((quality, media_type.lower()))
+
+    for quality, media_type in sorted(media_ranges, key=lambda media_range: -media_range[0]):  # stable, keeps order
+        if quality <= 0:
+            continue
+        if media_type in REPORT_MEDIA_TYPES:
+            return media_type
+        if media_type in ('*/*', 'application/*'):
+            return JSON_MEDIA_TYPE
+    return None
+
+
+@router.get('/report/window', response_model=WindowReportResponse)
+async def make_window_report_endpoint(
+        request: Request,
+        date: str,
+        window: int = Query(7, ge=1, le=366),
+        mode: str = Query('trailing', enum=list(WINDOW_REPORT_MODES))
+):
+    '''
+    create a multi day summary report from the sensor data lake
+    :param date: iso date the report is for, must have landed in the lake
+    :param window: window size in days, e.g. 7 or 30
+    :param mode: 'trailing' compares the date with the trailing window's average, 'period' compares the window
+     ending at the date with the window before it (window=7 is week-over-week)
+    :return: Response following the WindowReportResponse model.
+    '''
+
+    # Check the report can be answered from the lake
+    from app.data_processor.analysis import window_report_ranges
+    try:
+        date = parse_date(date)
+        (current_from, _), (baseline_from, baseline_to) = window_report_ranges(date, window, mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if date not in list_lake_dates(config.LAKE_DIR):
+        raise HTTPException(status_code=404, detail=f"No sensor data in the lake for {date}")
+
+    # Admission control, same budget as the upload reports
+    worker_pool = request.app.state.worker_pool
+    duckdb_pool = request.app.state.duckdb_pool
+    try:
+        async with worker_pool.admission():
+            df = await worker_pool.run(_make_window_report, duckdb_pool, date, window, mode)
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Too many reports in progress, try again later",
+                            headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)})
+
+    def days_before(days: int) -> str:
+        return (datetime.date.fromisoformat(date) - datetime.timedelta(days=days)).isoformat()
+
+    return WindowReportResponse(
+        machines=[MachineMetadata(**rec) for rec in df.to_dict(orient="records")],
+        metadata=WindowReportMetadata(
+            date=date,
+            window=window,
+            mode=mode,
+            current_start=days_before(current_from),
+            baseline_start=days_before(baseline_from),
+            baseline_end=days_before(baseline_to)
         )
+    )
+
+
+@router.post('/report/batch', response_model=BatchReportResponse,
+             responses={200: {'content': {NDJSON_MEDIA_TYPE: {}}}})
+async def make_batch_report(
+        request: Request,
+        machine_readings_csv: List[UploadFile] = File(...),
+        sites: List[str] = Form(..., description="site of every uploaded file, in upload order"),
+        ranking: Dict = Depends(summary_ranking)
+):
+    '''
+    create the summary reports of many sites (e.g. every plant) at once, sites are onboarded and summarized
+    concurrently, so the batch takes about as long as its slowest site rather than all of them
+    :param machine_readings_csv: every site's two days of readings, per site as for POST /report
+    :param sites: the site of every uploaded file, in upload order
+    :param ranking: top_k, min_increase, increase_mode, machines and sort_by query parameters, for every site
+    :return: Response following the BatchReportResponse model, or with `Accept: application/x-ndjson` one
+     SiteReport json per line, streamed as each site finishes
+    '''
+
+    # Check for correct file types, and which site and day each file belongs to
+    site_files = _check_batch_uploads(machine_readings_csv, sites)
+    accept = request.headers.get('accept') or ''
+    stream = NDJSON_MEDIA_TYPE in [media_range.split(';')[0].strip() for media_range in accept.split(',')]
+
+    duckdb_pool = request.app.state.duckdb_pool
+    try:
+        lookup = duckdb_pool.lookup_index  # one index for the whole batch
+    except FileNotFoundError:
+        raise HTTPException(status_code=500, detail="Required metadata files not found in system!")
+
+    # One admission for the whole batch, held until its last site is done (streamed or not)
+    worker_pool = request.app.state.worker_pool
+    admission = contextlib.AsyncExitStack()
+    try:
+        await admission.enter_async_context(worker_pool.admission())
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Too many reports in progress, try again later",
+                            headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)})
+    run = functools.partial(_run_batch, worker_pool=worker_pool, duckdb_pool=duckdb_pool,
+                            cache=request.app.state.parquet_cache, lookup=lookup,
+                            filenames=[f.filename for f in machine_readings_csv], site_files=site_files,
+                            ranking=ranking)
+
+    if not stream:
+        async with admission:
+            site_reports = {site_report['site']: site_report
+                            async for site_report in run(csv_files=[f.file for f in machine_readings_csv])}
+        content = json.dumps({'sites': [site_reports[site] for site in site_files]}, separators=(',', ':'))
+        return Response(content=content.encode(), media_type=JSON_MEDIA_TYPE)
+
+    # Uploads are closed once the endpoint returns, the stream works on its own copies
+    try:
+        spool_dir = await worker_pool.run(_spool_uploads, [f.file for f in machine_readings_csv])
+    except BaseException:
+        await admission.aclose()
+        raise
+
+    async def ndjson_lines() -> AsyncIterator[bytes]:
+        csv_files = [open(os.path.join(spool_dir, f'{i}.csv'), 'rb') for i in range(len(machine_readings_csv))]
+        try:
+            async with admission:
+                async for site_report in run(csv_files=csv_files):
+                    yield json.dumps(site_report, separators=(',', ':')).encode() + b'\n'
+        finally:
+            for csv_file in csv_files:
+                csv_file.close()
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+    return StreamingResponse(ndjson_lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.post('/report/jobs', response_model=ReportJobStatus, status_code=202)
+async def submit_report_job(
+        request: Request,
+        response: Response,
+        machine_readings_csv: List[UploadFile] = File(...),
+        ranking: Dict = Depends(summary_ranking)
+):
+    '''
+    submit a summary report to be produced in the background, poll it with GET /report/{job_id}
+    :param machine_readings_csv: Two following days of sensor data readings, as for POST /report
+    :param ranking: top_k, min_increase, increase_mode, machines and sort_by query parameters
+    :return: the job's status, identical submissions share one job
+    '''
+
+    # Check for correct file types, and which day each file belongs to
+    days = _check_uploads(machine_readings_csv)
+
+    duckdb_pool = request.app.state.duckdb_pool
+    try:
+        lookup = duckdb_pool.lookup_index
+    except FileNotFoundError:
+        raise HTTPException(status_code=500, detail="Required metadata files not found in system!")
+
+    # Identical submissions are identified the way the report cache identifies them, plus the filenames and day
+    # grouping, which the job's report metadata is rendered from
+    worker_pool = request.app.state.worker_pool
+    report_jobs: ReportJobStore = request.app.state.report_jobs
+    file_hashes = await _hash_uploads(worker_pool, [f.file for f in machine_readings_csv])
+    filenames = [f.filename for f in machine_readings_csv]
+    _, summary_key = _report_keys(lookup, file_hashes, days, ranking)
+    job_key = hash_key(summary_key, json.dumps([filenames, days]))
+
+    job = report_jobs.find(job_key)
+    if job is None:
+
+        # Uploads are closed with the request, the job works on its own copies
+        spool_dir = await worker_pool.run(_spool_uploads, [f.file for f in machine_readings_csv])
+        job = report_jobs.find(job_key)  # an identical submission may have landed while spooling
+        try:
+            if job is None:
+                run = functools.partial(_run_report_job, worker_pool=worker_pool, duckdb_pool=duckdb_pool,
+                                        cache=request.app.state.parquet_cache, lookup=lookup,
+                                        spool_dir=spool_dir, filenames=filenames, days=days,
+                                        file_hashes=file_hashes, ranking=ranking)
+                job = report_jobs.submit(job_key, run)
+                spool_dir = None  # owned by the job now
+        except QueueFullError:
+            raise HTTPException(status_code=503, detail="Too many report jobs in progress, try again later",
+                                headers={"Retry-After": str(config.RETRY_AFTER_SECONDS)})
+        finally:
+            if spool_dir is not None:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+
+    response.headers['Location'] = f"/report/{job.job_id}"
+    return _job_status(job)
+
+
+@router.get('/report/{job_id}', response_model=ReportJobStatus)
+async def get_report_job(request: Request, job_id: str):
+    '''
+    poll a background report job
+    :param job_id: id returned on submission
+    :return: the job's status and progress, with the report once it succeeded
+    '''
+    job = request.app.state.report_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No report job {job_id}, it may have expired")
+    return _job_status(job)
+
+
+def _job_status(job: ReportJob) -> ReportJobStatus:
+    return ReportJobStatus(job_id=job.job_id, status=job.status, step=job.step, progress=job.progress,
+                           error=job.error, result=job.result)
+
+
+def _check_uploads(uploads: List[UploadFile]) -> List[List[int]]:
+    '''
+    Validate uploaded csvs and tell which day each one belongs to
+    :return: indices of yesterday's files, and of today's
+    '''
+    _check_upload_types(uploads)
+    try:
+        return group_day_files([f.filename or '' for f in uploads])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _check_batch_uploads(uploads: List[UploadFile], sites: List[str]) -> Dict[str, Tuple[List[int], List[List[int]]]]:
+    '''
+    Validate the uploaded csvs of a batch and tell which site, and which of its days, each one belongs to
+    :return: per site in submission order, the indices of its files, and of its yesterday's and today's files
+     among them (see group_day_files)
+    '''
+    _check_upload_types(uploads)
+    if len(sites) != len(uploads):
+        raise HTTPException(status_code=400, detail=f"Expected one site per uploaded file, got {len(sites)} sites "
+                                                    f"for {len(uploads)} files")
+    files_per_site: Dict[str, List[int]] = {}
+    for i, site in enumerate(sites):
+        files_per_site.setdefault(site, []).append(i)
+    if len(files_per_site) > config.BATCH_MAX_SITES:
+        raise HTTPException(status_code=400, detail=f"At most {config.BATCH_MAX_SITES} sites per batch, "
+                                                    f"got {len(files_per_site)}")
+
+    site_files = {}
+    for site, files in files_per_site.items():
+        try:
+            site_files[site] = files, group_day_files([uploads[i].filename or '' for i in files])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Site '{site}': {e}")
+    return site_files
+
+
+def _check_upload_types(uploads: List[UploadFile]):
+    for f in uploads:
+        if f.content_type not in CSV_CONTENT_TYPES:
+            raise HTTPException(status_code=400, detail=f"Invalid file type for {f.filename}")
+
+
+def group_day_files(filenames: List[str]) -> List[List[int]]:
+    '''
+    Group uploaded files into yesterday's and today's. Files named after their day (DAY_FILENAME) are grouped by
+    it, otherwise exactly two files are expected, yesterday's first.
+    :param filenames: uploaded file names, in upload order
+    :return: indices of yesterday's files, and of today's, each in upload order
+    '''
+    matches = [DAY_FILENAME.match(filename) for filename in filenames]
+    if all(matches):
+        days: Dict[str, List[int]] = {}
+        for i, match in enumerate(matches):
+            try:
+                days.setdefault(parse_date(match.group(1)), []).append(i)
+            except ValueError:
+                raise ValueError(f"Invalid date in file name '{filenames[i]}'")
+        if len(days) == 2:
+            return [days[date] for date in sorted(days)]
+        if len(filenames) != 2:
+            raise ValueError(f"Expected files of exactly two days, got {', '.join(sorted(days))}")
+
+    if len(filenames) != 2:
+        raise ValueError("Expected two files, or part files named after their day (e.g. 2024-01-02.CR1.csv.gz)")
+    return [[0], [1]]
+
+
+def _spool_uploads(csv_files: List[BinaryIO]) -> str:
+    '''
+    Copy uploaded files to a fresh temp dir, as 0.csv, 1.csv.. (compressed ones stay compressed)
+    :return: the temp dir
+    '''
+    spool_dir = tempfile.mkdtemp(prefix='report-job-')
+    for i, csv_file in enumerate(csv_files):
+        csv_file.seek(0)
+        with open(os.path.join(spool_dir, f'{i}.csv'), 'wb') as f:
+            shutil.copyfileobj(csv_file, f)
+    return spool_dir
+
+
+async def _run_report_job(job: ReportJob, worker_pool: EtlWorkerPool, duckdb_pool: DuckDBConnectionPool,
+                          cache: ParquetCache, lookup: LookupIndex, spool_dir: str, filenames: List[str],
+                          days: List[List[int]], file_hashes: List[str], ranking: Dict) -> Dict:
+    '''
+    Body of a background report job, the same pipeline as POST /report on the spooled uploads
+    '''
+    csv_files = [open(os.path.join(spool_dir, f'{i}.csv'), 'rb') for i in range(len(filenames))]
+    try:
+        summary = await _run_report_pipeline(worker_pool, duckdb_pool, cache, lookup, csv_files, days,
+                                             file_hashes=file_hashes, ranking=ranking,
+                                             on_step=lambda step: setattr(job, 'step', step))
+        return await worker_pool.run(_report_json, summary, filenames, days)
+    finally:
+        for csv_file in csv_files:
+            csv_file.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+async def _run_batch(worker_pool: EtlWorkerPool, duckdb_pool: DuckDBConnectionPool, cache: ParquetCache,
+                     lookup: LookupIndex, csv_files: List[BinaryIO], filenames: List[str],
+                     site_files: Dict[str, Tuple[List[int], List[List[int]]]], ranking: Dict) -> AsyncIterator[Dict]:
+    '''
+    Run the report pipeline of every site concurrently, at most BATCH_MAX_CONCURRENT_SITES at once (their
+    onboarding and summaries share the worker and connection pools with every other request)
+    :param site_files: per site, its files' indices in csv_files and its days among them, see _check_batch_uploads
+    :return: SiteReport shaped dicts, as each site finishes; a failing site doesn't fail the others
+    '''
+    semaphore = asyncio.Semaphore(config.BATCH_MAX_CONCURRENT_SITES)
+
+    async def site_report(site: str, files: List[int], days: List[List[int]]) -> Dict:
+        async with semaphore:
+            try:
+                summary = await _run_report_pipeline(worker_pool, duckdb_pool, cache, lookup,
+                                                     [csv_files[i] for i in files], days, ranking=ranking)
+                report = await worker_pool.run(_report_json, summary, [filenames[i] for i in files], days)
+                return {'site': site, 'status': 'succeeded', 'error': None, 'report': report}
+            except Exception as e:
+                error = e.detail if isinstance(e, HTTPException) else str(e)
+                print(f"[ERROR] failed producing the report of site '{site}': {error}")
+                return {'site': site, 'status': 'failed', 'error': error, 'report': None}
+
+    tasks = [asyncio.create_task(site_report(site, files, days)) for site, (files, days) in site_files.items()]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:  # e.g. the client went away mid stream
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _hash_uploads(worker_pool: EtlWorkerPool, csv_files: List[BinaryIO]) -> List[str]:
+    return list(await asyncio.gather(*[worker_pool.run(hash_file, csv_file) for csv_file in csv_files]))
+
+
+def _report_keys(lookup: LookupIndex, file_hashes: List[str], days: List[List[int]],
+                 ranking: Optional[Dict] = None) -> Tuple[List[str], str]:
+    '''
+    Content address a report, a day is identified by its readings (its part files, in order) and the sensors
+    lookup it was mapped with, a summary by its days, the machines lookup and its ranking parameters
+    :param lookup: the lookup index the report is onboarded with
+    :return: cache keys of the onboarded days, and of the summary
+    '''
+    sensors_version = lookup.versions['sensors']
+    day_keys = [f"day-{hash_key(*[file_hashes[i] for i in day], sensors_version)}" for day in days]
+    ranking_key = json.dumps(ranking or {}, sort_keys=True)
+    summary_key = f"summary-{hash_key(*day_keys, lookup.versions['machines'], ranking_key)}"
+    return day_keys, summary_key
+
+
+async def _run_report_pipeline(worker_pool: EtlWorkerPool, duckdb_pool: DuckDBConnectionPool, cache: ParquetCache,
+                               lookup: LookupIndex, csv_files: List[BinaryIO], days: List[List[int]],
+                               file_hashes: Optional[List[str]] = None, ranking: Optional[Dict] = None,
+                               on_step: Optional[Callable[[str], None]] = None) -> pa.Table:
+    '''
+    Run the report etl on the worker pool, onboarding both days (and all their part files) in parallel. Days are
+    onboarded to in memory Arrow tables that DuckDB summarizes in place; the parquet cache is only a sink, written
+    alongside the summary, so a repeated day is onboarded once and a repeated pair is answered without DuckDB.
+    Days that don't fit in memory (see _fits_in_memory) are streamed into the cache instead and scanned from there.
+    :param csv_files: yesterday's and today's readings, plain or compressed
+    :param days: indices of yesterday's files in csv_files, and of today's, see group_day_files
+    :param file_hashes: their content hashes, when already known
+    :param ranking: make_summary_report ranking keyword arguments, defaults to each machine's largest increase
+    :param on_step: called with 'onboarding' and 'summarizing' as the etl gets there
+    :return: the summary report
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from app.data_processor.load import sensor_data_write_options
+
+    # Content address the uploads
+    if file_hashes is None:
+        file_hashes = await _hash_uploads(worker_pool, csv_files)
+    day_keys, summary_key = _report_keys(lookup, file_hashes, days, ranking)
+
+    # The cached parquets scanned below are leased, a concurrent request's eviction can't remove them meanwhile
+    with cache.lease() as lease:
+        # Repeated pair, skip onboarding and analysis altogether
+        summary_parquet = cache.get(summary_key, lease=lease)
+        if summary_parquet is not None:
+            return await worker_pool.run(pq.read_table, summary_parquet)
+
+        # Onboard the days not cached yet, cached ones are scanned from their parquet
+        if on_step is not None:
+            on_step('onboarding')
+        day_sources = [cache.get(day_key, lease=lease) for day_key in day_keys]
+        try:
+            onboarded = await asyncio.gather(*[
+                _onboard_day(worker_pool, cache, lease, day_key, lookup, [csv_files[i] for i in day])
+                for day, day_key, day_source in zip(days, day_keys, day_sources) if day_source is None])
+        except Exception as e:
+            print(f"[ERROR] failed onboarding the machine readings: {e}")
+            raise HTTPException(status_code=500, detail="Failed onboarding the machine readings!")
+        onboarded = iter(onboarded)
+        day_sources = [next(onboarded) if day_source is None else day_source for day_source in day_sources]
+
+        # Summarize, persisting the freshly onboarded days meanwhile
+        if on_step is not None:
+            on_step('summarizing')
+        day_sinks = [worker_pool.run(cache.get_or_create, day_key, functools.partial(_sink_parquet, day_source,
+                                                                                      sensor_data_write_options()))
+                     for day_key, day_source in zip(day_keys, day_sources)
+                     if config.CACHE_ONBOARDED_DAYS and isinstance(day_source, pa.Table)]
+        try:
+            summary, *_ = await asyncio.gather(worker_pool.run(_make_summary_report, duckdb_pool, day_sources, ranking),
+                                               *day_sinks)
+        except Exception as e:
+            print(f"[ERROR] failed producing the summary report: {e}")
+            raise HTTPException(status_code=500, detail="Failed producing the summary report!")
+        await worker_pool.run(cache.get_or_create, summary_key, functools.partial(_sink_parquet, summary, {}))
+        return summary
+
+
+async def _onboard_day(worker_pool: EtlWorkerPool, cache: ParquetCache, lease: List[str], day_key: str,
+                       lookup: LookupIndex, part_files: List[BinaryIO]) -> Union[pa.Table, str]:
+    '''
+    Onboard a day's part files concurrently on the worker pool, merged into one in memory day dataset. A day that
+    doesn't fit in memory is streamed through the out of core sort into the cache instead, so memory stays bounded
+    by the chunk size rather than growing with the upload.
+    :param lease: cache lease the cached parquet is pinned with, until the caller scanned it
+    :return: the onboarded day as an Arrow table, or the path of its cached parquet
+    '''
+    from app.data_processor.pipeline import onboard_machine_readings, merge_onboarded_parts
+    if not await worker_pool.run(_fits_in_memory, part_files):
+        day_parquet = await worker_pool.run(cache.get_or_create, day_key,
+                                            functools.partial(_onboard_day_parquet, lookup, part_files), lease=lease)
+        if not day_parquet:
+            raise RuntimeError(f"Failed onboarding day '{day_key}' to parquet")
+        return day_parquet
+
+    inserted_at = int(time.time() * 1_000_000)  # one insertion time for the whole day
+    tables = await asyncio.gather(*[
+        worker_pool.run(onboard_machine_readings, machine_readings_csv=part_file, sensors_csv=lookup,
+                        chunk_size=config.UPLOAD_CHUNK_SIZE, inserted_at=inserted_at)
+        for part_file in part_files])
+    if len(tables) == 1:
+        return tables[0]
+    return await worker_pool.run(merge_onboarded_parts, tables)
+
+
+def _onboard_day_parquet(lookup: LookupIndex, part_files: List[BinaryIO], output_parquet: str) -> str:
+    from app.data_processor.pipeline import onboard_machine_readings_etl
+    return onboard_machine_readings_etl(machine_readings_csv=part_files, sensors_csv=lookup,
+                                        output_parquet=output_parquet, chunk_size=config.UPLOAD_CHUNK_SIZE)
+
+
+def _fits_in_memory(csv_files: List[BinaryIO]) -> bool:
+    '''
+    Whether a day's uploads are onboarded in memory: plain csvs of up to IN_MEMORY_ONBOARD_MAX_BYTES in all. The
+    size a compressed upload expands to isn't known upfront (gzip's trailer keeps it modulo 4 GiB and of the last
+    member only, zstd frames needn't carry it), so compressed days are always streamed.
+    '''
+    from app.data_processor.extract import csv_compression
+    size = 0
+    for csv_file in csv_files:
+        if csv_compression(csv_file) is not None:
+            return False
+        size += csv_file.seek(0, os.SEEK_END)
+        csv_file.seek(0)
+    return size <= config.IN_MEMORY_ONBOARD_MAX_BYTES
+
+
+def _sink_parquet(table: pa.Table, write_options: Dict, output_parquet: str) -> str:
+    from app.data_processor.load import load_parquet
+    return load_parquet(parquet_path=output_parquet, df=table, **write_options)
+
+
+def _report_metadata(filenames: List[str], days: List[List[int]]) -> Dict[str, str]:
+    yesterday_files, today_files = [[filenames[i] for i in day] for day in days]
+    today_match = DAY_FILENAME.match(today_files[0])
+    return ReportMetadata(date=today_match.group(1) if today_match else today_files[0].split('.')[0],
+                          yesterday_data=','.join(yesterday_files),
+                          today_data=','.join(today_files)).model_dump()
+
+
+def _report_json(summary: pa.Table, filenames: List[str], days: List[List[int]]) -> Dict:
+    '''
+    ReportResponse shaped body built straight from the summary's columns, no per row model
+    '''
+    columns = summary.select(REPORT_COLUMNS).to_pydict()
+    return {'machines': [dict(zip(REPORT_COLUMNS, row)) for row in zip(*columns.values())],
+            'metadata': _report_metadata(filenames, days)}
+
+
+def _render_report(summary: pa.Table, filenames: List[str], days: List[List[int]], media_type: str):
+    '''
+    Serialise the summary in the negotiated format
+    :return: the response body
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    sink = pa.BufferOutputStream()
+    if media_type == PARQUET_MEDIA_TYPE:
+        pq.write_table(summary.select(REPORT_COLUMNS), sink)
+        return memoryview(sink.getvalue())
+
+    if media_type == ARROW_STREAM_MEDIA_TYPE:
+        table = summary.select(REPORT_COLUMNS)
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return memoryview(sink.getvalue())
+
+    return json.dumps(_report_json(summary, filenames, days), separators=(',', ':')).encode()
+
+
+def _make_summary_report(duckdb_pool: DuckDBConnectionPool, sensor_data: List,
+                         ranking: Optional[Dict] = None) -> pa.Table:
+    '''
+    Produce the summary report on a connection borrowed from the pool, blocks until one is free
+    '''
+    from app.data_processor.analysis import make_summary_report
+    with duckdb_pool.connection() as con:
+        return make_summary_report(sensor_data_parquets=sensor_data, connection=con, as_arrow=True,
+                                   **(ranking or {}))
+
+def _make_window_report(duckdb_pool: DuckDBConnectionPool, date: str, window: int, mode: str) -> pd.DataFrame:
+    '''
+    Produce a window report on a connection borrowed from the pool, blocks until one is free
+    '''
+    from app.data_processor.analysis import make_window_report
+    with duckdb_pool.connection() as con:
+        return make_window_report(lake_dir=config.LAKE_DIR, date=date, window=window, mode=mode, connection=con)
+
+
+def warm_up_report_path(duckdb_pool: DuckDBConnectionPool):
+    '''
+    Run a tiny synthetic report through every step a real one takes: the data stack imports, onboarding, the
+    parquet writer and reader, the summary macro of every pooled connection and the three response formats.
+    Stages are not recorded in the metrics.
+    :raise FileNotFoundError: if the lookups are not there yet
+    '''
+    import pyarrow.parquet as pq
+    from app.data_processor.analysis import make_summary_report
+    from app.data_processor.load import sensor_data_write_options
+    from app.data_processor.pipeline import onboard_machine_readings
+
+    with unrecorded(), tempfile.TemporaryDirectory() as tmp_dir:
+        lookup = duckdb_pool.lookup_index
+        tag_name = lookup.sensors_df['tag_name'].iloc[0]
+        yesterday, today = [
+            onboard_machine_readings(machine_readings_csv=io.BytesIO(
+                f'Tag Name,Timestamp,Value\n{tag_name},2024-01-0{day}T00:00:00,{day}.0\n'.encode()),
+                sensors_csv=lookup, chunk_size=config.UPLOAD_CHUNK_SIZE)
+            for day in (1, 2)]
+        yesterday_parquet = _sink_parquet(yesterday, sensor_data_write_options(),
+                                          os.path.join(tmp_dir, 'yesterday.parquet'))
+        pq.read_table(yesterday_parquet)
+
+        # Borrow the whole pool at once, so every connection gets its summary macro
+        with contextlib.ExitStack() as stack:
+            connections = [stack.enter_context(duckdb_pool.connection()) for _ in range(duckdb_pool.size)]
+            summaries = [make_summary_report(sensor_data_parquets=[yesterday_parquet, today], connection=con,
+                                             as_arrow=True) for con in connections]
 
-    return response
+        filenames, days = ['2024-01-01.csv', '2024-01-02.csv'], [[0], [1]]
+        for media_type in REPORT_MEDIA_TYPES:
+            _render_report(summaries[0], filenames, days, media_type)
+        ReportResponse.model_validate(_report_json(summaries[0], filenames, days))
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -0,0 +1,66 @@
+""" Worker pool running the blocking ETL off the event loop, with admission control"""
+
+# lib imports
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable
+
+
+class QueueFullError(Exception):
+    '''
+    Raised when a request is refused because too many requests are already pending
+    '''
+
+
+class EtlWorkerPool:
+    '''
+    Bounded thread pool for the pandas/DuckDB work. Threads rather than processes, so workers can share the
+    DuckDB connection pool and lookups; DuckDB and pyarrow release the GIL while they work.
+    '''
+
+    def __init__(self, max_workers: int, max_pending: int):
+        '''
+        :param max_workers: number of worker threads
+        :param max_pending: number of requests admitted at once (running or waiting for a worker)
+        '''
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pending = 0  # only touched from the event loop thread
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='etl-worker')
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @asynccontextmanager
+    async def admission(self):
+        '''
+        Admit a request for the duration of the context
+        :raise QueueFullError: if max_pending requests are already admitted
+        '''
+        if self._pending >= self.max_pending:
+            raise QueueFullError(f"{self._pending} requests pending, limit is {self.max_pending}")
+        self._pending += 1
+        try:
+            yield
+        finally:
+            self._pending -= 1
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        '''
+        Run a blocking function on a worker thread, keeping the caller's context variables
+        :return: the function's return value
+        '''
+        loop = asyncio.get_running_loop()
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    pass
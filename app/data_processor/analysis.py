@@ -1,85 +1,341 @@
 """ Utility functions boiled down to one definition file"""
 
+# proj imports
+from .lake import aggregates_glob, parse_date
+from .metrics import stage
+from .options import WINDOW_REPORT_MODES, INCREASE_MODES, SUMMARY_SORT_KEYS
+
 # lib imports
 import duckdb
-from typing import List
+import datetime
+import os
+import threading
+import weakref
+from typing import List, Optional, Tuple, Union
 import pandas as pd
+import pyarrow as pa
+
+# how increases are measured per INCREASE_MODES
+INCREASE_EXPRESSIONS = {
+    'absolute': 'today.avg_value - yesterday.avg_value',
+    'relative': '(today.avg_value - yesterday.avg_value) / NULLIF(ABS(yesterday.avg_value), 0)',
+}
+
+# inputs of a comparison, per call temporary views (machine_code, coordinate, avg_value and, today, sample_cnt)
+# on the connection it runs on, and the machines lookup when it is given as a csv
+YESTERDAY_VIEW, TODAY_VIEW, MACHINES_VIEW = 'summary_yesterday', 'summary_today', 'summary_machines'
+MACHINES_SOURCES = {'csv': MACHINES_VIEW, 'table': 'main.machines'}
+
+# per coordinate averages of onboarded readings, and of daily aggregates (value_sum, value_cnt, sample_cnt)
+READINGS_AVERAGES = 'machine_code, coordinate, AVG(value) AS avg_value, COUNT(*) AS sample_cnt'
+AGGREGATES_AVERAGES = 'machine_code, coordinate, SUM(value_sum) / SUM(value_cnt) AS avg_value, ' \
+                      'CAST(SUM(sample_cnt) AS BIGINT) AS sample_cnt'
+
+# comparison of the two average views, keeping each machine's top_k increases above min_increase, ranked and
+# filtered before the machines lookup is joined. Defined once per connection as a table macro for every increase
+# mode, ordering and machines source in use; the ranking parameters are bound on every call.
+COMPARISON_MACRO = """
+CREATE OR REPLACE TEMP MACRO {macro_name}(top_k, min_increase, machine_codes) AS TABLE
+WITH
+diffs as (
+    SELECT
+        today.machine_code,
+        today.coordinate,
+        today.avg_value AS today_avg_value,
+        today.avg_value - yesterday.avg_value AS increase_in_avg_value,
+        {increase_expression} AS ranking_increase,
+        today.sample_cnt
+    FROM {today_view} AS today
+    INNER JOIN {yesterday_view} AS yesterday
+        ON today.machine_code = yesterday.machine_code
+            AND today.coordinate = yesterday.coordinate
+    WHERE machine_codes IS NULL OR list_contains(machine_codes, today.machine_code)
+),
+ranked AS (
+    SELECT *,
+           ROW_NUMBER() OVER (PARTITION BY machine_code ORDER BY ranking_increase DESC) AS rnk
+    FROM diffs
+),
+top_ranked AS (
+    SELECT *
+    FROM ranked
+    WHERE rnk <= top_k AND ranking_increase > min_increase
+),
+machines AS (
+    SELECT *
+    FROM {machines_source}
+)
+
+SELECT 
+    machines.machine_name, 
+    top_ranked.coordinate,
+    top_ranked.today_avg_value AS value_avg,
+    top_ranked.increase_in_avg_value AS increase_in_value,
+    top_ranked.sample_cnt
+FROM top_ranked
+INNER JOIN machines
+    ON top_ranked.machine_code = machines.machine_code
+ORDER BY {order_by}
+"""
 
+# comparison macros defined so far, per connection
+_comparison_macros: 'weakref.WeakKeyDictionary[duckdb.DuckDBPyConnection, set]' = weakref.WeakKeyDictionary()
+_comparison_macros_lock = threading.Lock()
 
-def make_summary_report(sensor_data_parquets: List[str], machines_lookup_csv: str) -> pd.DataFrame:
+# connection of every thread reporting without one, a cursor over the default database (cursors are opened one
+# at a time, concurrent duckdb.default_connection() calls can deadlock)
+_thread_connections = threading.local()
+_thread_connections_lock = threading.Lock()
+
+
+def make_summary_report(sensor_data_parquets: List[Union[str, List[str], pa.Table]],
+                        machines_lookup_csv: Optional[str] = None,
+                        connection: Optional[duckdb.DuckDBPyConnection] = None,
+                        as_arrow: bool = False, top_k: int = 1, min_increase: float = 0.0,
+                        increase_mode: str = 'absolute', machine_codes: Optional[List[str]] = None,
+                        sort_by: str = 'increase') -> Union[pd.DataFrame, pa.Table]:
     '''
     Generate Summery report using SQL
-    :param sensor_data_parquets: List of Yesterday's and Today's sensor data in two following parquets
-    :param machines_lookup_csv: a csv containing the machines lookup
+    :param sensor_data_parquets: List of Yesterday's and Today's sensor data in two following parquets (or lists of
+     parquets, e.g. a day's part files), or already onboarded Arrow tables, which DuckDB scans in place
+    :param machines_lookup_csv: a csv containing the machines lookup, when omitted the `machines` table of the
+     connection is used instead
+    :param connection: duckdb connection to run on (e.g. borrowed from a pool), defaults to one per thread over
+     the default database
+    :param as_arrow: return an Arrow table rather than a pandas dataframe
+    :param top_k: number of coordinates reported per machine, those with the largest increases
+    :param min_increase: only increases strictly above it are reported
+    :param increase_mode: rank and threshold increases as 'absolute' value differences or 'relative' to
+     yesterday's average (0.1 is +10%), see INCREASE_MODES
+    :param machine_codes: only report these machines, all when omitted
+    :param sort_by: ordering of the report, one of SUMMARY_SORT_KEYS
     :return:
     '''
-    yesterday_data, today_data = sensor_data_parquets
-
-    average_summary_view_query = """
-     {view_name} AS (
-        SELECT
-            machine_code,
-            coordinate,
-            AVG(value) AS avg_value,
-            COUNT(*) AS sample_cnt
-        FROM parquet_scan('{sensor_data}')
-        GROUP BY machine_code, coordinate
-    )
-    """
-    comparison_query = """
-    WITH
-    {yesterday_view_query},
-    {today_view_query},
-    diffs as (
-        SELECT
-            {today_view_name}.machine_code,
-            {today_view_name}.coordinate,
-            {today_view_name}.avg_value AS today_avg_value,
-            {today_view_name}.avg_value - {yesterday_view_name}.avg_value AS increase_in_avg_value,
-            {today_view_name}.sample_cnt
-        FROM {today_view_name}
-        INNER JOIN {yesterday_view_name}
-            ON {today_view_name}.machine_code = {yesterday_view_name}.machine_code
-                AND {today_view_name}.coordinate = {yesterday_view_name}.coordinate
-
-    ),    
-    ranked AS (
-        SELECT *,
-               ROW_NUMBER() OVER (PARTITION BY machine_code ORDER BY increase_in_avg_value DESC) AS rnk
-        FROM diffs
-    ),
-    machines AS (
-        SELECT *
-        FROM read_csv_auto('{machines_csv}')
-    )
-
-    SELECT 
-        machines.machine_name, 
-        ranked.coordinate,
-        ranked.today_avg_value AS value_avg,
-        ranked.increase_in_avg_value AS increase_in_value,
-        ranked.sample_cnt
-    FROM ranked
-    INNER JOIN machines
-        ON ranked.machine_code = machines.machine_code
-    WHERE rnk = 1 AND increase_in_avg_value > 0
-    ORDER BY increase_in_avg_value DESC
-    """
+    con = _connection(connection, machines_lookup_csv)
+    yesterday_data, today_data = [_scan(con, sensor_data) for sensor_data in sensor_data_parquets]
+    bytes_read = sum(os.path.getsize(parquet) for sensor_data in sensor_data_parquets
+                     for parquet in ([sensor_data] if isinstance(sensor_data, str) else
+                                     [] if isinstance(sensor_data, pa.Table) else sensor_data)
+                     if os.path.isfile(parquet))
 
     # summary average views
-    yesterday_view_name = 'yesterday'
-    yesterday_view_query = average_summary_view_query.format(view_name=yesterday_view_name, sensor_data=yesterday_data)
-    today_view_name = 'today'
-    today_view_query = (average_summary_view_query.format(view_name=today_view_name, sensor_data=today_data))
-
-    # construct final query
-    final_query = comparison_query.format(yesterday_view_query=yesterday_view_query,
-                                          today_view_query=today_view_query,
-                                          yesterday_view_name=yesterday_view_name,
-                                          today_view_name=today_view_name,
-                                          machines_csv=machines_lookup_csv)
-    result = duckdb.sql(final_query)
-    return result.df()
+    return _compare_averages(con=con,
+                             yesterday=yesterday_data.aggregate(READINGS_AVERAGES, 'machine_code, coordinate'),
+                             today=today_data.aggregate(READINGS_AVERAGES, 'machine_code, coordinate'),
+                             machines_lookup_csv=machines_lookup_csv,
+                             bytes_read=bytes_read,
+                             as_arrow=as_arrow, top_k=top_k, min_increase=min_increase,
+                             increase_mode=increase_mode, machine_codes=machine_codes, sort_by=sort_by)
+
+
+def make_summary_report_from_lake(lake_dir: str, yesterday_date: str, today_date: str,
+                                  machines_lookup_csv: Optional[str] = None,
+                                  connection: Optional[duckdb.DuckDBPyConnection] = None) -> pd.DataFrame:
+    '''
+    Generate the same Summery report from the lake's daily aggregates, without scanning raw readings
+    :param lake_dir: sensor data lake directory (see lake.py)
+    :param yesterday_date: iso date of yesterday's data in the lake
+    :param today_date: iso date of today's data in the lake
+    :param machines_lookup_csv: a csv containing the machines lookup, when omitted the `machines` table of the
+     connection is used instead
+    :param connection: duckdb connection to run on (e.g. borrowed from a pool), defaults to one per thread over
+     the default database
+    :return:
+    '''
+    con = _connection(connection, machines_lookup_csv)
+    aggregates = _lake_aggregates(con, lake_dir)
+
+    # summary average views, only the two dates' partitions are read
+    yesterday, today = [aggregates.filter(_date_is(date)).aggregate(AGGREGATES_AVERAGES, 'machine_code, coordinate')
+                        for date in [yesterday_date, today_date]]
+    return _compare_averages(con=con, yesterday=yesterday, today=today, machines_lookup_csv=machines_lookup_csv)
+
+
+def make_summary_report_from_aggregates(yesterday_aggregates: Union[str, pa.Table],
+                                        today_aggregates: Union[str, pa.Table],
+                                        machines_lookup_csv: Optional[str] = None,
+                                        connection: Optional[duckdb.DuckDBPyConnection] = None,
+                                        as_arrow: bool = False, **ranking) -> Union[pd.DataFrame, pa.Table]:
+    '''
+    Generate the same Summery report from two days of per coordinate aggregates (machine_code, coordinate,
+    value_sum, value_cnt, sample_cnt), e.g. a lake aggregates partition and the live aggregates of today
+    :param yesterday_aggregates: yesterday's aggregates, a parquet or an Arrow table
+    :param today_aggregates: today's aggregates, a parquet or an Arrow table
+    :param machines_lookup_csv: a csv containing the machines lookup, when omitted the `machines` table of the
+     connection is used instead
+    :param connection: duckdb connection to run on (e.g. borrowed from a pool), defaults to one per thread over
+     the default database
+    :param as_arrow: return an Arrow table rather than a pandas dataframe
+    :param ranking: top_k, min_increase, increase_mode, machine_codes and sort_by, see make_summary_report
+    :return:
+    '''
+    con = _connection(connection, machines_lookup_csv)
+    yesterday, today = [_scan(con, aggregates).aggregate(AGGREGATES_AVERAGES, 'machine_code, coordinate')
+                        for aggregates in [yesterday_aggregates, today_aggregates]]
+    return _compare_averages(con=con, yesterday=yesterday, today=today, machines_lookup_csv=machines_lookup_csv,
+                             as_arrow=as_arrow, **ranking)
+
+
+def window_report_ranges(date: str, window: int, mode: str) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    '''
+    Day offsets (first, last days before `date`) of the compared and baseline ranges of a window report
+    :param date: iso date the report is for
+    :param window: window size in days
+    :param mode: one of WINDOW_REPORT_MODES
+    :return: (current range, baseline range), each as (preceding days from, preceding days to)
+    '''
+    if mode not in WINDOW_REPORT_MODES:
+        raise ValueError(f"Unknown window report mode '{mode}', expected one of {WINDOW_REPORT_MODES}")
+    if window < 1:
+        raise ValueError(f"Window must be at least one day, got {window}")
+    parse_date(date)
+    if mode == 'trailing':
+        return (0, 0), (window, 1)
+    return (window - 1, 0), (2 * window - 1, window)
+
+
+def make_window_report(lake_dir: str, date: str, window: int, mode: str = 'trailing',
+                       machines_lookup_csv: Optional[str] = None,
+                       connection: Optional[duckdb.DuckDBPyConnection] = None) -> pd.DataFrame:
+    '''
+    Generate a Summery report comparing against a multi day baseline from the lake's daily aggregates.
+    'trailing' compares the date with the average of the `window` days before it (e.g. today vs trailing 7 days),
+    'period' compares the `window` days ending at the date with the `window` days before them (window=7 is
+    week-over-week). Only the date partitions the ranges cover are read.
+    :param lake_dir: sensor data lake directory (see lake.py)
+    :param date: iso date the report is for
+    :param window: window size in days
+    :param mode: one of WINDOW_REPORT_MODES
+    :param machines_lookup_csv: a csv containing the machines lookup, when omitted the `machines` table of the
+     connection is used instead
+    :param connection: duckdb connection to run on (e.g. borrowed from a pool), defaults to the global one
+    :return:
+    '''
+    (current_from, current_to), (baseline_from, baseline_to) = window_report_ranges(date, window, mode)
+    date = parse_date(date)
+    first_date = (datetime.date.fromisoformat(date) - datetime.timedelta(days=baseline_from)).isoformat()
+
+    # both ranges' averages of every coordinate, as of every date the ranges cover
+    windowed_query = """
+    SELECT
+        date,
+        machine_code,
+        coordinate,
+        SUM(value_sum) OVER current_days / SUM(value_cnt) OVER current_days AS current_avg_value,
+        CAST(SUM(sample_cnt) OVER current_days AS BIGINT) AS current_sample_cnt,
+        SUM(value_sum) OVER baseline_days / SUM(value_cnt) OVER baseline_days AS baseline_avg_value
+    FROM read_parquet($aggregates_glob, hive_partitioning = true)
+    WHERE date BETWEEN DATE '{first_date}' AND DATE '{date}'
+    WINDOW
+        current_days AS (PARTITION BY machine_code, coordinate ORDER BY date
+                         RANGE BETWEEN INTERVAL {current_from} DAYS PRECEDING
+                             AND INTERVAL {current_to} DAYS PRECEDING),
+        baseline_days AS (PARTITION BY machine_code, coordinate ORDER BY date
+                          RANGE BETWEEN INTERVAL {baseline_from} DAYS PRECEDING
+                              AND INTERVAL {baseline_to} DAYS PRECEDING)
+    """
+    con = _connection(connection, machines_lookup_csv)
+    windowed = con.sql(windowed_query.format(first_date=first_date, date=date, current_from=current_from,
+                                             current_to=current_to, baseline_from=baseline_from,
+                                             baseline_to=baseline_to),
+                       params={'aggregates_glob': aggregates_glob(lake_dir)}).filter(_date_is(date))
+
+    return _compare_averages(con=con,
+                             yesterday=windowed.filter('baseline_avg_value IS NOT NULL').project(
+                                 'machine_code, coordinate, baseline_avg_value AS avg_value'),
+                             today=windowed.project('machine_code, coordinate, current_avg_value AS avg_value, '
+                                                    'current_sample_cnt AS sample_cnt'),
+                             machines_lookup_csv=machines_lookup_csv)
+
+
+def _compare_averages(con: duckdb.DuckDBPyConnection, yesterday: duckdb.DuckDBPyRelation,
+                      today: duckdb.DuckDBPyRelation, machines_lookup_csv: Optional[str], bytes_read: int = 0,
+                      as_arrow: bool = False, top_k: int = 1, min_increase: float = 0.0,
+                      increase_mode: str = 'absolute', machine_codes: Optional[List[str]] = None,
+                      sort_by: str = 'increase') -> Union[pd.DataFrame, pa.Table]:
+    '''
+    Rank today's per coordinate averages against yesterday's, given relations on `con` with machine_code,
+    coordinate, avg_value and (today) sample_cnt columns
+    :param machines_lookup_csv: a csv containing the machines lookup, the `machines` table of `con` if omitted
+    :param bytes_read: size of the scanned inputs, when known, for the stage metrics
+    :param as_arrow: return an Arrow table rather than a pandas dataframe
+    :param top_k, min_increase, increase_mode, machine_codes, sort_by: ranking, see make_summary_report
+    '''
+    if increase_mode not in INCREASE_MODES:
+        raise ValueError(f"Unknown increase mode '{increase_mode}', expected one of {INCREASE_MODES}")
+    if sort_by not in SUMMARY_SORT_KEYS:
+        raise ValueError(f"Unknown sort key '{sort_by}', expected one of {tuple(SUMMARY_SORT_KEYS)}")
+    if top_k < 1:
+        raise ValueError(f"top_k must be at least 1, got {top_k}")
+
+    # inputs are bound as temporary views, private to the connection (pooled cursors share one catalog), the
+    # machines lookup either parsed from csv or the connection's preloaded table
+    views = {YESTERDAY_VIEW: yesterday, TODAY_VIEW: today}
+    if machines_lookup_csv is not None:
+        views[MACHINES_VIEW] = con.read_csv(machines_lookup_csv)
+    macro_name = _comparison_macro(con, increase_mode, sort_by, 'csv' if machines_lookup_csv is not None else 'table')
+    params = {'top_k': int(top_k), 'min_increase': float(min_increase),
+              'machine_codes': None if machine_codes is None else [str(code) for code in machine_codes]}
+
+    with stage('analysis', bytes_read=bytes_read) as record:
+        try:
+            for view_name, relation in views.items():
+                con.register(view_name, relation)
+            relation = con.execute(f"SELECT * FROM {macro_name}($top_k, $min_increase, $machine_codes::VARCHAR[])",
+                                   params)
+            result = relation.arrow() if as_arrow else relation.df()
+        finally:
+            for view_name in views:  # don't keep the inputs (e.g. Arrow tables) alive until the next report
+                con.unregister(view_name)
+        record.rows_out = result.shape[0]
+    return result
+
+
+def _comparison_macro(con: duckdb.DuckDBPyConnection, increase_mode: str, sort_by: str, machines_source: str) -> str:
+    '''
+    Name of the comparison macro of the given ranking variant, defining it on the connection on first use
+    '''
+    macro_name = f'summary_{increase_mode}_{sort_by}_{machines_source}'
+    with _comparison_macros_lock:
+        defined = _comparison_macros.setdefault(con, set())
+    if macro_name not in defined:
+        con.execute(COMPARISON_MACRO.format(macro_name=macro_name,
+                                            increase_expression=INCREASE_EXPRESSIONS[increase_mode],
+                                            yesterday_view=YESTERDAY_VIEW,
+                                            today_view=TODAY_VIEW,
+                                            machines_source=MACHINES_SOURCES[machines_source],
+                                            order_by=SUMMARY_SORT_KEYS[sort_by]))
+        defined.add(macro_name)
+    return macro_name
+
+
+def _connection(connection: Optional[duckdb.DuckDBPyConnection],
+                machines_lookup_csv: Optional[str]) -> duckdb.DuckDBPyConnection:
+    '''
+    The connection to report on, the calling thread's own cursor over the default database when none is given
+    '''
+    if connection is not None:
+        return connection
+    if machines_lookup_csv is None:
+        raise ValueError("Either a machines lookup csv or a connection holding a `machines` table is required")
+    if getattr(_thread_connections, 'connection', None) is None:
+        with _thread_connections_lock:
+            _thread_connections.connection = duckdb.default_connection().cursor()
+    return _thread_connections.connection
+
+
+def _scan(con: duckdb.DuckDBPyConnection, source: Union[str, List[str], pa.Table]) -> duckdb.DuckDBPyRelation:
+    if isinstance(source, pa.Table):
+        return con.from_arrow(source)
+    return con.read_parquet(source if isinstance(source, str) else list(source))
+
+
+def _lake_aggregates(con: duckdb.DuckDBPyConnection, lake_dir: str) -> duckdb.DuckDBPyRelation:
+    return con.read_parquet(aggregates_glob(lake_dir), hive_partitioning=True)
+
+
+def _date_is(date: str) -> duckdb.Expression:
+    return duckdb.ColumnExpression('date') == duckdb.ConstantExpression(datetime.date.fromisoformat(parse_date(date)))
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
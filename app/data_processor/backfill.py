@@ -0,0 +1,180 @@
+""" Batch backfill command line entry point, onboards many days in parallel across processes
+
+usage: python -m app.data_processor.backfill data/csv/2024-*.csv --output-dir data/parquet --workers 8
+"""
+
+# proj imports
+from .lake import list_lake_dates, load_day_to_lake, parse_date
+from .pipeline import ONBOARD_ENGINES, onboard_machine_readings_etl, produce_summary_report_etl
+
+# lib imports
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+
+
+def find_daily_csvs(inputs: List[str]) -> List[Tuple[str, str]]:
+    '''
+    Resolve directories and globs to daily csvs, named by their date (e.g. 2024-01-02.csv)
+    :param inputs: directories, globs or csv paths
+    :return: (date, csv path) pairs sorted by date
+    '''
+    csv_files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            csv_files += glob.glob(os.path.join(path, '*.csv'))
+        else:
+            csv_files += glob.glob(path)
+
+    daily_csvs = {}
+    for csv_file in csv_files:
+        try:
+            date = parse_date(os.path.splitext(os.path.basename(csv_file))[0])
+        except ValueError:
+            continue  # lookups and other non daily csvs
+        daily_csvs[date] = csv_file
+    return sorted(daily_csvs.items())
+
+
+def _onboard_day(date: str, csv_file: str, sensors_csv: str, output_parquet: str, engine: str,
+                 lake_dir: Optional[str], lake_dates: List[str]) -> Dict:
+    '''
+    Onboard one day (and land it in the lake), in a worker process
+    :return: timing record of the day
+    '''
+    started = perf_counter()
+    if os.path.exists(output_parquet):
+        status = 'skipped'
+    else:
+        onboarded = _write_atomically(output_parquet, lambda tmp_parquet: onboard_machine_readings_etl(
+            machine_readings_csv=csv_file, sensors_csv=sensors_csv, output_parquet=tmp_parquet, engine=engine))
+        status = 'onboarded' if onboarded else 'failed'
+
+    if lake_dir is not None and status != 'failed' and (status == 'onboarded' or date not in lake_dates):
+        if not load_day_to_lake(day_parquet=output_parquet, lake_dir=lake_dir, date=date):
+            status = 'failed'
+
+    return {'stage': 'onboard', 'date': date, 'input': csv_file, 'output': output_parquet, 'status': status,
+            'seconds': round(perf_counter() - started, 4)}
+
+
+def _summarize_days(date: str, day_parquets: List[str], machines_csv: str, output_parquet: str) -> Dict:
+    '''
+    Produce the summary of a consecutive day pair, in a worker process
+    :return: timing record of the summary
+    '''
+    started = perf_counter()
+    if os.path.exists(output_parquet):
+        status = 'skipped'
+    else:
+        summarized = _write_atomically(output_parquet, lambda tmp_parquet: produce_summary_report_etl(
+            sensor_data_parquets=day_parquets, machines_lookup_csv=machines_csv, output_path=tmp_parquet))
+        status = 'summarized' if summarized else 'failed'
+    return {'stage': 'summary', 'date': date, 'input': day_parquets, 'output': output_parquet, 'status': status,
+            'seconds': round(perf_counter() - started, 4)}
+
+
+def _write_atomically(output_parquet: str, build: Callable[[str], str]) -> str:
+    '''
+    Build a parquet next to its final path and swap it in, so a run killed mid write never leaves a partial file
+    that a resumed run would skip as done
+    :param build: builds the parquet at the path it is given, returns that path or empty string on failure
+    :return: output_parquet, or empty string if the build failed
+    '''
+    tmp_parquet = os.path.join(os.path.dirname(output_parquet),
+                               f'.{os.path.basename(output_parquet)}.{uuid.uuid4().hex}.tmp')
+    try:
+        if not build(tmp_parquet):
+            return ''
+        os.replace(tmp_parquet, output_parquet)
+        return output_parquet
+    finally:
+        if os.path.exists(tmp_parquet):
+            os.remove(tmp_parquet)
+
+
+def backfill(daily_csvs: List[Tuple[str, str]], sensors_csv: str, machines_csv: str, output_dir: str,
+             workers: int, engine: str = 'pandas', lake_dir: Optional[str] = None) -> List[Dict]:
+    '''
+    Onboard daily csvs with a process pool, then summarize every consecutive day pair.
+    Resumable: days and summaries whose parquet already exists are skipped.
+    :param daily_csvs: (date, csv path) pairs
+    :param sensors_csv: a csv containing the sensors lookup
+    :param machines_csv: a csv containing the machines lookup
+    :param output_dir: directory of the onboarded <date>.parquet and summary-<date>.parquet files
+    :param workers: number of worker processes
+    :param engine: onboarding engine, one of ONBOARD_ENGINES
+    :param lake_dir: when given, every day is also landed in this sensor data lake
+    :return: timing records, one per day and per summary
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    lake_dates = list_lake_dates(lake_dir) if lake_dir is not None else []
+    day_parquets = {date: os.path.join(output_dir, f'{date}.parquet') for date, _ in daily_csvs}
+
+    # spawned rather than forked workers, duckdb connections are not fork safe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        onboard_futures = [executor.submit(_onboard_day, date, csv_file, sensors_csv, day_parquets[date], engine,
+                                           lake_dir, lake_dates)
+                           for date, csv_file in daily_csvs]
+        records = [future.result() for future in onboard_futures]
+        for record in records:
+            print(f"[INFO] {record['status']} {record['date']} in {record['seconds']:.2f}s")
+
+        # consecutive calendar days only, a gap has no "yesterday"
+        onboarded = {record['date'] for record in records if record['status'] != 'failed'}
+        summary_futures = []
+        for date in sorted(onboarded):
+            yesterday = (datetime.date.fromisoformat(date) - datetime.timedelta(days=1)).isoformat()
+            if yesterday not in onboarded:
+                continue
+            summary_futures.append(executor.submit(_summarize_days, date, [day_parquets[yesterday], day_parquets[date]],
+                                                   machines_csv, os.path.join(output_dir, f'summary-{date}.parquet')))
+        for future in summary_futures:
+            record = future.result()
+            print(f"[INFO] {record['status']} summary-{record['date']} in {record['seconds']:.2f}s")
+            records.append(record)
+
+    return records
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Onboard daily sensor data csvs and summarize consecutive days')
+    parser.add_argument('inputs', nargs='+', help='directories, globs or paths of daily csvs named <yyyy-mm-dd>.csv')
+    parser.add_argument('--sensors-csv', default=os.path.join(DEFAULT_DATA_DIR, 'csv', 'Sensors.csv'))
+    parser.add_argument('--machines-csv', default=os.path.join(DEFAULT_DATA_DIR, 'csv', 'Machines.csv'))
+    parser.add_argument('--output-dir', default=os.path.join(DEFAULT_DATA_DIR, 'parquet'))
+    parser.add_argument('--lake-dir', default=None, help='also land every day in this sensor data lake')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--engine', choices=ONBOARD_ENGINES, default='pandas')
+    parser.add_argument('--timings-json', default=None, help='write per file timing records to this json file')
+    args = parser.parse_args(argv)
+
+    daily_csvs = find_daily_csvs(args.inputs)
+    if not daily_csvs:
+        print(f"[ERROR] no daily csvs found in {args.inputs}")
+        return 1
+    print(f"[INFO] backfilling {len(daily_csvs)} days with {args.workers} workers..")
+
+    started = perf_counter()
+    records = backfill(daily_csvs=daily_csvs, sensors_csv=args.sensors_csv, machines_csv=args.machines_csv,
+                       output_dir=args.output_dir, workers=args.workers, engine=args.engine,
+                       lake_dir=args.lake_dir)
+    print(f"[INFO] backfill done in {perf_counter() - started:.2f}s")
+
+    if args.timings_json is not None:
+        with open(args.timings_json, 'w') as f:
+            json.dump(records, f, indent=2)
+    return 1 if any(record['status'] == 'failed' for record in records) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
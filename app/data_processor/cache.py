@@ -0,0 +1,167 @@
+""" Content addressed parquet cache boiled down to one definition file"""
+
+# lib imports
+import collections
+import hashlib
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterator, List, Optional, Union
+
+
+def hash_file(file: Union[str, BinaryIO], block_size: int = 1 << 20) -> str:
+    '''
+    Content hash of a file, read block by block so memory stays bounded
+    :param file: file path or binary file-like object, rewound to the start afterwards
+    :param block_size: bytes read per block
+    :return: sha256 hex digest
+    '''
+    digest = hashlib.sha256()
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    else:
+        file.seek(0)
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+        file.seek(0)
+    return digest.hexdigest()
+
+
+def hash_key(*parts: str) -> str:
+    '''
+    Combine several hashes/versions into one short cache key component
+    '''
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+
+
+class ParquetCache:
+    '''
+    A directory of parquet files addressed by key, with size based LRU eviction.
+    Recency is tracked through file mtimes, so the cache survives restarts. Entries looked up under a lease are
+    pinned, never evicted, until the lease is released.
+    '''
+
+    def __init__(self, cache_dir: str, max_bytes: int, lock_stripes: int = 64):
+        '''
+        :param cache_dir: directory holding the cached parquets, created if missing
+        :param max_bytes: total size the cache is evicted down to
+        :param lock_stripes: number of locks keys are spread over, to build each key only once at a time
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._evict_lock = threading.Lock()  # also guards the pins
+        self._pins: 'collections.Counter[str]' = collections.Counter()  # path -> leases holding it
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    @contextmanager
+    def lease(self) -> Iterator[List[str]]:
+        '''
+        Lease for the entries a caller is about to read: whatever is looked up with it (the lease argument of get
+        and get_or_create) is pinned until the lease is released, so a concurrent eviction can't remove it first
+        :return: the paths leased so far
+        '''
+        leased: List[str] = []
+        try:
+            yield leased
+        finally:
+            with self._evict_lock:
+                self._pins.subtract(leased)
+                self._pins = +self._pins  # drop released paths
+
+    def get(self, key: str, lease: Optional[List[str]] = None) -> Optional[str]:
+        '''
+        Look up a cached parquet, marking it as recently used
+        :param lease: a lease to pin the entry with, see lease()
+        :return: path to the cached parquet, or None on a miss
+        '''
+        path = self.path(key)
+        with self._evict_lock:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            self._pin(path, lease)
+        print(f"[INFO] cache hit for '{key}'")
+        return path
+
+    def get_or_create(self, key: str, build: Callable[[str], str], lease: Optional[List[str]] = None) -> str:
+        '''
+        Look up a cached parquet, building it on a miss. Concurrent callers of the same key wait for one build.
+        :param key: cache key
+        :param build: builds the parquet at the path it is given, returns that path or empty string on failure
+        :param lease: a lease to pin the entry with, see lease()
+        :return: path to the cached parquet, or empty string if the build failed
+        '''
+        with self._locks[hash(key) % len(self._locks)]:
+            cached = self.get(key, lease=lease)
+            if cached is not None:
+                return cached
+
+            # build next to the final path and swap in atomically, readers never see a partial file
+            path = self.path(key)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            try:
+                if not build(tmp_path):
+                    return ''
+                with self._evict_lock:
+                    os.replace(tmp_path, path)
+                    self._pin(path, lease)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            print(f"[INFO] cached '{key}'")
+
+        self.evict(keep=path)
+        return path
+
+    def _pin(self, path: str, lease: Optional[List[str]]):
+        if lease is not None:
+            lease.append(path)
+            self._pins[path] += 1
+
+    def size(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.cache_dir, name))
+                   for name in os.listdir(self.cache_dir) if name.endswith('.parquet'))
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        '''
+        Remove least recently used parquets until the cache fits in max_bytes, leased ones are never removed
+        :param keep: a path never to evict, e.g. the entry just handed to a caller
+        :return: number of evicted entries
+        '''
+        with self._evict_lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.parquet'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep or self._pins[path]:
+                    continue
+                os.remove(path)
+                total -= size
+                evicted += 1
+            if evicted:
+                print(f"[INFO] evicted {evicted} cache entries, cache is now {total} bytes")
+            return evicted
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,99 @@
+""" DuckDB connection pooling with preloaded lookup tables boiled down to one definition file"""
+
+# proj imports
+from .lookups import LookupIndex, LookupStore
+
+# lib imports
+import duckdb
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+
+class DuckDBConnectionPool:
+    '''
+    A fixed size pool of DuckDB connections over one shared in-memory database, holding the machines and
+    sensors lookups as the tables `machines` and `sensors`, loaded from the LookupStore's current index whenever
+    a new one is swapped in (only when a lookup file changes).
+    '''
+
+    def __init__(self, size: int, machines_csv: str, sensors_csv: str):
+        '''
+        :param size: number of connections that can be borrowed concurrently
+        :param machines_csv: a csv containing the machines lookup
+        :param sensors_csv: a csv containing the sensors lookup
+        '''
+        self.size = size
+        self.machines_csv = machines_csv
+        self.sensors_csv = sensors_csv
+        self.lookups = LookupStore(machines_csv=machines_csv, sensors_csv=sensors_csv)
+        self._database = duckdb.connect()  # every pooled connection is a cursor over this database
+        self._reload_lock = threading.Lock()
+        self._loaded_versions: Dict[str, str] = {}  # lookup versions of the database's tables
+
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._database.cursor())
+
+        try:
+            self.refresh_lookups()
+        except FileNotFoundError as e:
+            print(f"[WARNING] lookups not loaded yet: {e}")
+
+    def refresh_lookups(self) -> bool:
+        '''
+        Reload the lookup tables whose files changed since they were last loaded
+        :return: True if anything was reloaded
+        '''
+        index = self.lookups.index
+        if index.versions == self._loaded_versions:
+            return False
+
+        with self._reload_lock:
+            reloaded = False
+            frames = {'machines': index.machines_df, 'sensors': index.sensors_df}
+            for table, df in frames.items():
+                if self._loaded_versions.get(table) == index.versions[table]:
+                    continue
+                self._database.from_df(df).create_view(f'{table}_reload')
+                self._database.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM {table}_reload")
+                self._database.execute(f"DROP VIEW {table}_reload")
+                self._loaded_versions[table] = index.versions[table]
+                print(f"[INFO] (re)loaded lookup table '{table}' (version {index.versions[table][:12]})")
+                reloaded = True
+            return reloaded
+
+    @property
+    def lookup_index(self) -> LookupIndex:
+        '''
+        The current lookup index, for the pandas onboarding engine. Take it once per onboarding, a reload swaps in
+        a new index rather than changing this one.
+        '''
+        self.refresh_lookups()
+        return self.lookups.index
+
+    @contextmanager
+    def connection(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        '''
+        Borrow a connection, blocking until one is free, with up to date lookup tables
+        :return: a duckdb connection, returned to the pool on exit
+        '''
+        self.refresh_lookups()
+        con = self._idle.get()
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+    def close(self):
+        '''
+        Close all pooled connections and the underlying database
+        '''
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+        self._database.close()
+
+
+if __name__ == '__main__':
+    pass
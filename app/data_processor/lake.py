@@ -0,0 +1,151 @@
+""" Date partitioned sensor data lake and its incremental daily aggregates boiled down to one definition file
+
+Layout under the lake dir:
+    readings/machine_code=<code>/date=<yyyy-mm-dd>/part-<uuid>.parquet   raw onboarded readings
+    aggregates/date=<yyyy-mm-dd>/part.parquet                            per (date, machine_code, coordinate) sums
+A day is always written (or re-written) as a whole, leaving the other days untouched.
+"""
+
+# annotations are not evaluated, so duckdb below is only imported by type checkers
+from __future__ import annotations
+
+# lib imports
+import datetime
+import glob
+import os
+import shutil
+import uuid
+from typing import TYPE_CHECKING, List, Optional
+
+# imported on first use, the api reads the lake's layout (dates, paths) without loading the engine
+if TYPE_CHECKING:
+    import duckdb
+
+READINGS_DIR = 'readings'
+AGGREGATES_DIR = 'aggregates'
+
+
+def parse_date(date: str) -> str:
+    '''
+    Validate an iso date, so it is safe to use as a partition value and SQL literal
+    :param date: date string, e.g. '2024-01-02'
+    :return: the date in iso format
+    '''
+    return datetime.date.fromisoformat(date).isoformat()
+
+
+def readings_glob(lake_dir: str) -> str:
+    return os.path.join(lake_dir, READINGS_DIR, '*', '*', '*.parquet')
+
+
+def aggregates_glob(lake_dir: str) -> str:
+    return os.path.join(lake_dir, AGGREGATES_DIR, '*', '*.parquet')
+
+
+def aggregates_parquet(lake_dir: str, date: str) -> str:
+    return os.path.join(lake_dir, AGGREGATES_DIR, f'date={parse_date(date)}', 'part.parquet')
+
+
+def _sql_string(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def list_lake_dates(lake_dir: str) -> List[str]:
+    '''
+    Dates that have landed in the lake, according to the aggregates table (a date's aggregates are published last)
+    :param lake_dir: sensor data lake directory
+    :return: sorted iso dates
+    '''
+    aggregate_parquets = glob.glob(os.path.join(lake_dir, AGGREGATES_DIR, 'date=*', 'part.parquet'))
+    return sorted(os.path.basename(os.path.dirname(parquet)).split('=', 1)[1] for parquet in aggregate_parquets)
+
+
+def load_day_to_lake(day_parquet: str, lake_dir: str, date: str,
+                     connection: Optional[duckdb.DuckDBPyConnection] = None) -> str:
+    '''
+    Land one onboarded day in the lake: its readings partitioned by machine_code and date, and its row of the
+    aggregates table. Loading a date that already exists replaces that date only (backfill / correction).
+    :param day_parquet: onboarded sensor data parquet of that day
+    :param lake_dir: sensor data lake directory, created if missing
+    :param date: iso date the readings belong to
+    :param connection: duckdb connection to run on, defaults to the global one
+    :return: the date landed, or empty string on failure
+    '''
+    import duckdb
+    con = connection or duckdb
+    tmp_parquet = staging_dir = None
+    try:
+        date = parse_date(date)
+        readings_dir = os.path.join(lake_dir, READINGS_DIR)
+        aggregate_parquet = aggregates_parquet(lake_dir, date)
+        aggregate_dir = os.path.dirname(aggregate_parquet)
+        os.makedirs(readings_dir, exist_ok=True)
+        os.makedirs(aggregate_dir, exist_ok=True)
+        print(f"[INFO] landing '{day_parquet}' in lake '{lake_dir}' as {date}..")
+
+        # The aggregates partition is what marks a date landed: built aside, unpublished while the readings are
+        # replaced and only published last, so a failure (or kill) halfway leaves the date unlanded for a retry
+        tmp_parquet = os.path.join(aggregate_dir, f'.part-{uuid.uuid4().hex}.tmp')
+        con.execute(f"""
+        COPY (
+            SELECT
+                machine_code,
+                coordinate,
+                SUM(value) AS value_sum,
+                COUNT(value) AS value_cnt,
+                COUNT(*) AS sample_cnt
+            FROM read_parquet($day_parquet)
+            GROUP BY machine_code, coordinate
+        ) TO {_sql_string(tmp_parquet)} (FORMAT parquet)
+        """, {'day_parquet': day_parquet})
+        if os.path.exists(aggregate_parquet):
+            os.remove(aggregate_parquet)
+
+        # Raw readings, staged outside the readings table then swapped in for the date's partitions of every machine
+        staging_dir = os.path.join(lake_dir, f'.staging-{uuid.uuid4().hex}')
+        con.execute(f"""
+        COPY (
+            SELECT *, DATE '{date}' AS date
+            FROM read_parquet($day_parquet)
+        ) TO {_sql_string(staging_dir)}
+            (FORMAT parquet, PARTITION_BY (machine_code, date), FILENAME_PATTERN 'part-{{uuid}}')
+        """, {'day_parquet': day_parquet})
+        for partition in glob.glob(os.path.join(readings_dir, 'machine_code=*', f'date={date}')):
+            shutil.rmtree(partition)
+        for partition in glob.glob(os.path.join(staging_dir, 'machine_code=*', f'date={date}')):
+            machine_dir = os.path.join(readings_dir, os.path.basename(os.path.dirname(partition)))
+            os.makedirs(machine_dir, exist_ok=True)
+            os.replace(partition, os.path.join(machine_dir, f'date={date}'))
+
+        os.replace(tmp_parquet, aggregate_parquet)
+        print(f"[INFO] successfully landed {date} in lake '{lake_dir}'!")
+        return date
+
+    except Exception as e:
+        print(f"[ERROR] failed to land '{day_parquet}' in lake '{lake_dir}': {e}")
+        return ''
+
+    finally:
+        if tmp_parquet is not None and os.path.exists(tmp_parquet):
+            os.remove(tmp_parquet)
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def remove_day_from_lake(lake_dir: str, date: str) -> bool:
+    '''
+    Drop a date from the lake, both its readings and its aggregates
+    :param lake_dir: sensor data lake directory
+    :param date: iso date to drop
+    :return: True if anything was removed
+    '''
+    date = parse_date(date)
+    partitions = glob.glob(os.path.join(lake_dir, READINGS_DIR, 'machine_code=*', f'date={date}'))
+    partitions += glob.glob(os.path.join(lake_dir, AGGREGATES_DIR, f'date={date}'))
+    for partition in partitions:
+        shutil.rmtree(partition)
+    return bool(partitions)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,169 @@
+""" Live intra-day ingestion: running per coordinate aggregates of the current day boiled down to one definition file
+
+Readings arrive in small batches, are mapped through the sensors lookup like a day file and folded into running
+value_sum / value_cnt / sample_cnt per (machine_code, coordinate), the same columns as the lake's daily aggregates.
+The aggregates are flushed as `<flush_dir>/aggregates/date=<yyyy-mm-dd>/part.parquet` (the lake's layout), so a
+restart resumes from the last flush and yesterday's final flush can serve as tomorrow's baseline.
+"""
+
+# proj imports
+from .lake import aggregates_parquet, list_lake_dates
+from .lookups import LookupIndex
+from .metrics import stage
+from .transform import transform_sensor_data
+
+# lib imports
+import datetime
+import os
+import threading
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Dict, Optional, Tuple, Union
+
+LIVE_AGGREGATES_SCHEMA = pa.schema([
+    ('machine_code', pa.string()),
+    ('coordinate', pa.string()),
+    ('value_sum', pa.float64()),
+    ('value_cnt', pa.int64()),
+    ('sample_cnt', pa.int64()),
+])
+
+_MICROSECONDS_PER_DAY = 86_400 * 1_000_000
+
+
+class LiveDayAggregates:
+    '''
+    Running per (machine_code, coordinate) aggregates of the latest day readings arrived for. Readings of a later
+    day roll the aggregates over to it (the finished day is flushed first), readings of an earlier day are
+    dropped as late. Thread safe, appends may come from several workers.
+    '''
+
+    def __init__(self, flush_dir: Optional[str] = None):
+        '''
+        :param flush_dir: directory the aggregates are flushed to and restored from, kept in memory only if omitted
+        '''
+        self.flush_dir = flush_dir
+        self._lock = threading.Lock()
+        self._date: Optional[str] = None
+        self._aggregates: Dict[Tuple[str, str], list] = {}  # (machine_code, coordinate) -> [sum, cnt, samples]
+        self._last_sample_time: Optional[int] = None
+        self._dirty = False
+
+        if flush_dir is not None and list_lake_dates(flush_dir):
+            self._restore(list_lake_dates(flush_dir)[-1])
+
+    @property
+    def date(self) -> Optional[str]:
+        return self._date
+
+    @property
+    def last_sample_time(self) -> Optional[int]:
+        return self._last_sample_time
+
+    def append(self, machine_reading_df: pd.DataFrame, sensors_lookup_df: Union[pd.DataFrame, LookupIndex]) -> Dict:
+        '''
+        Fold a batch of machine readings into the day's aggregates
+        :param machine_reading_df: readings with Tag Name, Timestamp and Value columns, as in a day file
+        :param sensors_lookup_df: a lookup table used to describe a sensor, or its index
+        :return: the day the aggregates are for, and the batch's rows added, dropped as late and not in the lookup
+        '''
+        df = transform_sensor_data(machine_reading_df=machine_reading_df, sensors_lookup_df=sensors_lookup_df)
+        with stage('live', rows_in=df.shape[0]) as record, self._lock:
+            # a day at a time in order, so a batch crossing midnight completes the day before rolling over from it
+            rows = unmapped_rows = 0
+            for day, day_df in df.groupby(df['sample_time'] // _MICROSECONDS_PER_DAY, sort=True):
+                if self._date is not None and day < self._day_number():
+                    continue
+                if self._date is None or day > self._day_number():
+                    self._roll_over(_day_date(int(day)))
+                mapped_rows = self._fold(day_df)
+                rows += mapped_rows
+                unmapped_rows += day_df.shape[0] - mapped_rows
+            if self._date is None:
+                return {'date': None, 'rows': 0, 'late_rows': 0, 'unmapped_rows': 0}
+
+            record.rows_out = rows
+            return {'date': self._date, 'rows': rows, 'late_rows': int(df.shape[0] - rows - unmapped_rows),
+                    'unmapped_rows': unmapped_rows}
+
+    def _fold(self, df: pd.DataFrame) -> int:
+        '''
+        Fold readings of the current day into its aggregates
+        :return: the number of readings mapped to a machine coordinate
+        '''
+        mapped = df.dropna(subset=['machine_code', 'coordinate'])
+        grouped = mapped.groupby(['machine_code', 'coordinate'], sort=False)['value'].agg(['sum', 'count', 'size'])
+        for (machine_code, coordinate), value_sum, value_cnt, sample_cnt in grouped.itertuples(name=None):
+            aggregate = self._aggregates.setdefault((machine_code, coordinate), [0.0, 0, 0])
+            aggregate[0] += value_sum
+            aggregate[1] += value_cnt
+            aggregate[2] += sample_cnt
+        if df.shape[0]:
+            last_sample_time = int(df['sample_time'].max())
+            self._last_sample_time = max(self._last_sample_time or last_sample_time, last_sample_time)
+            self._dirty = True
+        return int(mapped.shape[0])
+
+    def snapshot(self) -> pa.Table:
+        '''
+        The day's aggregates so far, one row per (machine_code, coordinate)
+        :return: an Arrow table following LIVE_AGGREGATES_SCHEMA
+        '''
+        with self._lock:
+            return self._table()
+
+    def flush(self) -> str:
+        '''
+        Persist the day's aggregates to the flush dir, swapped in whole, if they changed since the last flush
+        :return: path to the flushed parquet, or empty string if there was nothing to flush
+        '''
+        with self._lock:
+            return self._flush()
+
+    def _flush(self) -> str:
+        if self.flush_dir is None or self._date is None or not self._dirty:
+            return ''
+        parquet_path = aggregates_parquet(self.flush_dir, self._date)
+        os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+        tmp_parquet = os.path.join(os.path.dirname(parquet_path), f'.part-{uuid.uuid4().hex}.tmp')
+        pq.write_table(self._table(), tmp_parquet)
+        os.replace(tmp_parquet, parquet_path)
+        self._dirty = False
+        return parquet_path
+
+    def _roll_over(self, date: str):
+        self._flush()
+        print(f"[INFO] live aggregates rolled over from {self._date} to {date}")
+        self._date = date
+        self._aggregates = {}
+        self._last_sample_time = None
+
+    def _restore(self, date: str):
+        table = pq.read_table(aggregates_parquet(self.flush_dir, date))
+        for machine_code, coordinate, value_sum, value_cnt, sample_cnt in zip(
+                *table.select(LIVE_AGGREGATES_SCHEMA.names).to_pydict().values()):
+            self._aggregates[(machine_code, coordinate)] = [value_sum, value_cnt, sample_cnt]
+        self._date = date
+        print(f"[INFO] restored live aggregates of {date} ({table.num_rows} coordinates)")
+
+    def _table(self) -> pa.Table:
+        keys, aggregates = list(self._aggregates), list(self._aggregates.values())
+        return pa.Table.from_arrays([pa.array([key[0] for key in keys], pa.string()),
+                                     pa.array([key[1] for key in keys], pa.string()),
+                                     pa.array([aggregate[0] for aggregate in aggregates], pa.float64()),
+                                     pa.array([aggregate[1] for aggregate in aggregates], pa.int64()),
+                                     pa.array([aggregate[2] for aggregate in aggregates], pa.int64())],
+                                    schema=LIVE_AGGREGATES_SCHEMA)
+
+    def _day_number(self) -> int:
+        return (datetime.date.fromisoformat(self._date) - datetime.date(1970, 1, 1)).days
+
+
+def _day_date(day_number: int) -> str:
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day_number)).isoformat()
+
+
+if __name__ == '__main__':
+    pass
@@ -1,15 +1,74 @@
 """ Offloading methods to different sources boiled down to one definition file"""
 
+# proj imports
+from .metrics import stage
+
 # lib imports
+import duckdb
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+import tempfile
+from typing import Dict, Iterable, List, Optional, Union
+
+# onboarded sensor data layout: rows clustered by machine/coordinate/time so row group min/max statistics prune
+# well, repetitive columns dictionary encoded and the (sorted) sample times delta encoded
+SENSOR_DATA_SORT_KEY = ['machine_code', 'coordinate', 'sample_time']
+SENSOR_DATA_DICTIONARY_COLUMNS = ['machine_code', 'component_code', 'coordinate', 'value', 'inserted_at']
+DEFAULT_ROW_GROUP_SIZE = 128 * 1024
+
+# onboarded sensor data columns, fixed rather than inferred (a chunk of only unknown tags has all null lookup columns)
+SENSOR_DATA_SCHEMA = pa.schema([
+    ('machine_code', pa.string()),
+    ('component_code', pa.string()),
+    ('coordinate', pa.string()),
+    ('sample_time', pa.int64()),
+    ('value', pa.float64()),
+    ('inserted_at', pa.int64()),
+])
+
+# memory DuckDB may use for out of core sorts, beyond it sorted runs spill to disk
+DEFAULT_SORT_MEMORY_LIMIT = os.environ.get('SORT_MEMORY_LIMIT', '512MB')
+
+
+def sensor_data_write_options(row_group_size: int = DEFAULT_ROW_GROUP_SIZE) -> Dict:
+    '''
+    Parquet writer options of the onboarded sensor data layout
+    :param row_group_size: rows per row group
+    :return: keyword arguments for pyarrow's parquet writer
+    '''
+    return {'compression': 'zstd',
+            'use_dictionary': SENSOR_DATA_DICTIONARY_COLUMNS,  # falls back to plain when a dictionary grows large
+            'column_encoding': {'sample_time': 'DELTA_BINARY_PACKED'},
+            'write_statistics': True,
+            'row_group_size': row_group_size}
 
 
-def load_parquet(parquet_path: str, df: pd.DataFrame) -> str:
+def sort_sensor_data(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Stable sort of onboarded sensor data by SENSOR_DATA_SORT_KEY, missing values last. String columns are compared
+    through their (sorted) dictionary codes rather than string by string.
+    :param df: onboarded sensor data
+    :return: the sorted df, with a fresh index
+    '''
+    keys = []
+    for column in reversed(SENSOR_DATA_SORT_KEY):  # lexsort's primary key is the last one
+        values = df[column]
+        if values.dtype == object:
+            codes, _ = pd.factorize(values, sort=True)
+            values = np.where(codes < 0, len(codes), codes)  # missing (-1) last
+        keys.append(np.asarray(values))
+    return df.take(np.lexsort(keys)).reset_index(drop=True)
+
+
+def load_parquet(parquet_path: str, df: Union[pd.DataFrame, pa.Table], **write_options) -> str:
     '''
     Load df to parquet at given path
     :param parquet_path: desired parquet file
-    :param df: df to load as parquet
+    :param df: df (or Arrow table) to load as parquet
+    :param write_options: pyarrow parquet writer options, e.g. sensor_data_write_options()
     :return: None!
     '''
     # Save to parquet
@@ -21,7 +80,12 @@ def load_parquet(parquet_path: str, df: pd.DataFrame) -> str:
 
         # try saving file
         print(f"[INFO] saving '{parquet_path}'..")
-        df.to_parquet(parquet_path, index=False)
+        with stage('load', rows_in=df.shape[0]) as record:
+            if isinstance(df, pa.Table):
+                pq.write_table(df, parquet_path, **write_options)
+            else:
+                df.to_parquet(parquet_path, index=False, **write_options)
+            record.bytes_written = os.path.getsize(parquet_path)
         print(f"[INFO] successfully saved as parquet: '{parquet_path}'!")
         return parquet_path
 
@@ -30,5 +94,84 @@ def load_parquet(parquet_path: str, df: pd.DataFrame) -> str:
         return ''
 
 
+def load_parquet_sorted(parquet_path: str, dfs: Iterable[pd.DataFrame], sort_key: List[str],
+                        memory_limit: str = DEFAULT_SORT_MEMORY_LIMIT, metadata: Optional[Dict[bytes, bytes]] = None,
+                        schema: Optional[pa.Schema] = None, **write_options) -> str:
+    '''
+    Load dataframe chunks to parquet at given path, sorted by sort_key across all chunks, out of core: chunks are
+    spilled to disk as they come, sorted by DuckDB within memory_limit (its sorted runs spill to disk beyond it)
+    and streamed back into the writer, so memory stays flat whatever the input size. The sort is stable with
+    missing keys last, so the output is the same as sort_sensor_data on the whole data at once.
+    :param parquet_path: desired parquet file
+    :param dfs: iterable of dfs sharing the same columns, consumed lazily
+    :param sort_key: columns to sort by
+    :param memory_limit: DuckDB memory limit of the sort, e.g. '512MB'
+    :param metadata: key-value metadata added to the parquet's schema
+    :param schema: schema the chunks are converted to, e.g. SENSOR_DATA_SCHEMA, inferred from the first chunk when
+     omitted
+    :param write_options: pyarrow parquet writer options, e.g. sensor_data_write_options()
+    :return: path to the parquet, or empty string on failure
+    '''
+    writer = None
+    row_group_size = write_options.pop('row_group_size', None) or DEFAULT_ROW_GROUP_SIZE
+    parquet_dir = os.path.dirname(os.path.abspath(parquet_path))
+    try:
+
+        # Check for target file existence
+        if os.path.exists(parquet_path):
+            print(f"[WARNING] file '{parquet_path}' already exists, overwriting existing file!")
+
+        print(f"[INFO] streaming '{parquet_path}' through an out of core sort..")
+        with tempfile.TemporaryDirectory(dir=parquet_dir, prefix='.sort-') as spill_dir:
+
+            # Spill the chunks unsorted, numbering rows so ties keep their input order
+            spill_parquet = os.path.join(spill_dir, 'spill.parquet')
+            spill_writer, rows = None, 0
+            try:
+                for df in dfs:
+                    with stage('load', rows_in=df.shape[0]):
+                        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                        schema = table.schema  # fixed by the first chunk, when not given
+                        table = table.append_column('__row', pa.array(np.arange(rows, rows + df.shape[0])))
+                        if spill_writer is None:
+                            spill_writer = pq.ParquetWriter(spill_parquet, table.schema)
+                        spill_writer.write_table(table)
+                        rows += df.shape[0]
+            finally:
+                if spill_writer is not None:
+                    spill_writer.close()
+
+            if spill_writer is None:
+                print(f"[WARNING] no data to save for '{parquet_path}'!")
+                return ''
+
+            # Sort and stream the sorted batches into the final layout
+            schema = schema.with_metadata({**(schema.metadata or {}), **(metadata or {})})
+            order_by = ', '.join(f'"{column}" NULLS LAST' for column in sort_key)
+            with stage('load', rows_in=rows) as record, duckdb.connect() as con:
+                con.execute(f"SET memory_limit = '{memory_limit}'")
+                con.execute("SET temp_directory = $temp_directory", {'temp_directory': spill_dir})
+                reader = con.execute(f"""
+                SELECT * EXCLUDE (__row)
+                FROM read_parquet($spill_parquet)
+                ORDER BY {order_by}, __row
+                """, {'spill_parquet': spill_parquet}).fetch_record_batch(row_group_size)
+                writer = pq.ParquetWriter(parquet_path, schema, **write_options)
+                for batch in reader:
+                    writer.write_table(pa.Table.from_batches([batch]).cast(schema), row_group_size=row_group_size)
+                writer.close()
+                record.bytes_written = os.path.getsize(parquet_path)
+
+        print(f"[INFO] successfully saved as parquet: '{parquet_path}' ({rows} rows)!")
+        return parquet_path
+
+    except Exception as e:
+        print(f"[ERROR] failed to save '{parquet_path}': {e}")
+        if writer is not None:
+            writer.close()
+            os.remove(parquet_path)  # don't leave a truncated file behind for the exists check
+        return ''
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
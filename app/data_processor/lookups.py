@@ -0,0 +1,172 @@
+""" Integer keyed sensors and machines lookup index, swapped in whole when its files change, boiled down to one
+definition file
+
+The lookups are loaded once into a LookupIndex: every tag gets a sensor id (its row in the sensors lookup), and
+every sensor the ids of its machine, component and coordinate in small dictionaries of their distinct codes.
+Readings are joined by resolving their few distinct tags to sensor ids, everything after that is integer gathers,
+and strings are only materialised from the dictionaries at the very end. A LookupStore watches the lookup files
+and replaces its index by a freshly built one, so whoever took an index keeps a consistent one throughout.
+"""
+
+# proj imports
+from .cache import hash_file
+from .extract import extract_csv
+
+# lib imports
+import hashlib
+import os
+import threading
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import take
+from typing import Dict, List, Optional
+
+# sensors lookup columns readings are mapped to, by tag_name
+LOOKUP_COLUMNS = ['machine_code', 'component_code', 'coordinate']
+
+# parquet key-value metadata of onboarded sensor data: the version of the sensors lookup its tags were mapped with
+LOOKUP_VERSION_METADATA_KEY = b'lookup_version'
+
+
+class LookupIndex:
+    '''
+    An immutable, integer keyed index of the sensors lookup (and the machines lookup alongside), versioned by the
+    content of the lookups it was built from
+    '''
+
+    def __init__(self, sensors_df: pd.DataFrame, machines_df: Optional[pd.DataFrame] = None,
+                 versions: Optional[Dict[str, str]] = None):
+        '''
+        :param sensors_df: the sensors lookup, tag_name and LOOKUP_COLUMNS
+        :param machines_df: the machines lookup, machine_code and machine_name
+        :param versions: content hash per lookup table ('sensors', 'machines'), e.g. of their files, hashed from
+         the frames when omitted
+        '''
+        self.sensors_df = sensors_df
+        self.machines_df = machines_df
+        self._versions = dict(versions) if versions is not None else None
+
+        # tag -> sensor id, only usable as a plain mapping when tags are unique and present
+        tags = sensors_df['tag_name']
+        self.unique = bool(tags.is_unique and not tags.isna().any())
+        self._tag_index = pd.Index(tags)
+
+        # sensor id -> machine / component / coordinate id, -1 when the lookup has no value
+        self.codes: Dict[str, np.ndarray] = {}  # column -> distinct values, an id is a position in it
+        self.sensor_ids: Dict[str, np.ndarray] = {}
+        for column in LOOKUP_COLUMNS:
+            ids, codes = pd.factorize(sensors_df[column])
+            self.codes[column] = np.asarray(codes, dtype=object)
+            self.sensor_ids[column] = ids.astype(np.int32)
+
+    @property
+    def versions(self) -> Dict[str, str]:
+        if self._versions is None:
+            frames = {'sensors': self.sensors_df, 'machines': self.machines_df}
+            self._versions = {table: hashlib.sha256(pd.util.hash_pandas_object(df, index=False).to_numpy()).hexdigest()
+                              for table, df in frames.items() if df is not None}
+        return self._versions
+
+    @property
+    def version(self) -> str:
+        '''
+        Version onboarded sensor data is stamped with, the sensors lookup's (the machines lookup isn't part of it)
+        '''
+        return self.versions['sensors']
+
+    def map_tags(self, tag_names: pd.Series, columns: List[str] = LOOKUP_COLUMNS) -> Optional[Dict[str, np.ndarray]]:
+        '''
+        Left join of the lookup on tag_name, through integer ids: the readings' tags are factorized, the distinct
+        ones resolved to sensor ids once, and every column's ids gathered per reading, values are only taken from
+        the column's dictionary at the end
+        :param tag_names: tag name of every reading
+        :param columns: lookup columns to attach, of LOOKUP_COLUMNS
+        :return: column name to values (missing where the tag or its value is not in the lookup), or None when the
+         lookup can't be used as a plain mapping (duplicate or missing tag names, where a merge behaves differently)
+        '''
+        if not self.unique:
+            return None
+
+        codes, distinct_tags = pd.factorize(tag_names)  # missing tags get code -1
+        sensor_ids = self._tag_index.get_indexer(distinct_tags)  # unknown tags get -1
+        mapped = {}
+        for column in columns:
+            # ids per distinct tag, with a trailing -1 the missing tags' code points at
+            tag_ids = np.append(take(self.sensor_ids[column], sensor_ids, allow_fill=True, fill_value=-1), -1)
+            mapped[column] = take(self.codes[column], tag_ids[codes], allow_fill=True)
+        return mapped
+
+    def __repr__(self) -> str:
+        return f"LookupIndex(sensors={len(self.sensors_df)}, version={self.version[:12]})"
+
+
+def sensors_lookup(sensors_csv) -> LookupIndex:
+    '''
+    :param sensors_csv: a csv containing the sensors lookup, the lookup itself, or an already built index
+    :return: its lookup index, versioned by the csv's content when given a csv
+    '''
+    if isinstance(sensors_csv, LookupIndex):
+        return sensors_csv
+    if isinstance(sensors_csv, pd.DataFrame):
+        return LookupIndex(sensors_csv)
+    return LookupIndex(extract_csv(sensors_csv), versions={'sensors': hash_file(sensors_csv)})
+
+
+class LookupStore:
+    '''
+    The current LookupIndex of a machines and a sensors lookup file. Files are watched through their mtimes, a
+    change builds a whole new index aside and swaps it in, readers are never blocked by a reload.
+    '''
+
+    def __init__(self, machines_csv: str, sensors_csv: str):
+        '''
+        :param machines_csv: a csv containing the machines lookup
+        :param sensors_csv: a csv containing the sensors lookup
+        '''
+        self.files = {'machines': machines_csv, 'sensors': sensors_csv}
+        self._reload_lock = threading.Lock()
+        self._mtimes: Dict[str, float] = {}
+        self._index: Optional[LookupIndex] = None
+
+    @property
+    def index(self) -> LookupIndex:
+        '''
+        The current index, reloaded first if a lookup file changed
+        :raise FileNotFoundError: if a lookup file is missing
+        '''
+        self.refresh()
+        return self._index
+
+    def refresh(self) -> bool:
+        '''
+        Rebuild the index if a lookup file changed since it was last loaded
+        :return: True if a new index was swapped in
+        :raise FileNotFoundError: if a lookup file is missing
+        '''
+        mtimes = {}
+        for table, csv_file in self.files.items():
+            if not os.path.exists(csv_file):
+                raise FileNotFoundError(f"Lookup file '{csv_file}' for table '{table}' not found")
+            mtimes[table] = os.path.getmtime(csv_file)
+        if mtimes == self._mtimes:
+            return False
+
+        with self._reload_lock:
+            if mtimes == self._mtimes:  # reloaded meanwhile
+                return False
+            previous = self._index
+            frames = {'sensors': previous.sensors_df, 'machines': previous.machines_df} if previous else {}
+            versions = dict(previous.versions) if previous else {}
+            for table, csv_file in self.files.items():
+                if self._mtimes.get(table) == mtimes[table]:
+                    continue
+                frames[table], versions[table] = extract_csv(csv_file), hash_file(csv_file)
+                print(f"[INFO] (re)loaded lookup '{table}' from '{csv_file}'")
+            self._index = LookupIndex(sensors_df=frames['sensors'], machines_df=frames['machines'],
+                                      versions=versions)
+            self._mtimes = mtimes
+            return True
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,237 @@
+""" Lightweight per stage instrumentation of the pipeline boiled down to one definition file
+
+Every stage (extract/transform/load/analysis) is wrapped in `stage(...)`, which records wall time, rows in/out,
+bytes read/written and the process' current RSS sampled when the stage starts and ends. Records are aggregated into the process wide
+METRICS registry (exposed in Prometheus text format) and, when a request collector is active, kept per request.
+The cost is a couple of clock/procfs reads and a lock per stage, so it can stay on in production.
+"""
+
+# lib imports
+import resource
+import sys
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# ru_maxrss is in KiB on linux, bytes on macOS
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+_PAGE_SIZE = resource.getpagesize()
+_MIB = 1024 ** 2
+
+
+@dataclass
+class StageRecord:
+    '''
+    Measurements of one run of a pipeline stage
+    '''
+    stage: str
+    seconds: float = 0.0
+    rows_in: int = 0
+    rows_out: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    rss_bytes: int = 0  # the larger of the RSS sampled at the stage's start and end
+    rss_growth_bytes: int = 0  # RSS at the end less RSS at the start, negative when memory was given back
+
+
+@dataclass
+class _StageTotals:
+    calls: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+    rows_in: int = 0
+    rows_out: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    max_rss_bytes: int = 0
+    max_rss_growth_bytes: int = 0
+
+
+@dataclass
+class MetricsRegistry:
+    '''
+    Process wide totals per stage and per request route, rendered in Prometheus text exposition format
+    '''
+    enabled: bool = True
+    _stages: Dict[str, _StageTotals] = field(default_factory=dict)
+    _requests: Dict[Tuple[str, str, int], List[float]] = field(default_factory=dict)  # -> [count, seconds]
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record_stage(self, record: StageRecord, failed: bool = False):
+        with self._lock:
+            totals = self._stages.setdefault(record.stage, _StageTotals())
+            totals.calls += 1
+            totals.errors += failed
+            totals.seconds += record.seconds
+            totals.rows_in += record.rows_in
+            totals.rows_out += record.rows_out
+            totals.bytes_read += record.bytes_read
+            totals.bytes_written += record.bytes_written
+            totals.max_rss_bytes = max(totals.max_rss_bytes, record.rss_bytes)
+            totals.max_rss_growth_bytes = max(totals.max_rss_growth_bytes, record.rss_growth_bytes)
+
+    def record_request(self, method: str, route: str, status: int, seconds: float):
+        with self._lock:
+            totals = self._requests.setdefault((method, route, status), [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._requests.clear()
+
+    def render(self) -> str:
+        '''
+        :return: all metrics in Prometheus text exposition format
+        '''
+        stage_metrics = [
+            ('etl_stage_calls_total', 'counter', 'Runs of the pipeline stage', 'calls'),
+            ('etl_stage_errors_total', 'counter', 'Failed runs of the pipeline stage', 'errors'),
+            ('etl_stage_seconds_total', 'counter', 'Wall time spent in the pipeline stage', 'seconds'),
+            ('etl_stage_rows_in_total', 'counter', 'Rows consumed by the pipeline stage', 'rows_in'),
+            ('etl_stage_rows_out_total', 'counter', 'Rows produced by the pipeline stage', 'rows_out'),
+            ('etl_stage_bytes_read_total', 'counter', 'Bytes read by the pipeline stage', 'bytes_read'),
+            ('etl_stage_bytes_written_total', 'counter', 'Bytes written by the pipeline stage', 'bytes_written'),
+            ('etl_stage_max_rss_bytes', 'gauge', 'Largest process RSS sampled around a run of the pipeline stage',
+             'max_rss_bytes'),
+            ('etl_stage_max_rss_growth_bytes', 'gauge', 'Largest process RSS growth over a run of the pipeline stage',
+             'max_rss_growth_bytes'),
+        ]
+        with self._lock:
+            stages = {name: _StageTotals(**vars(totals)) for name, totals in self._stages.items()}
+            requests = {key: list(totals) for key, totals in self._requests.items()}
+
+        lines = []
+        for metric, metric_type, description, attribute in stage_metrics:
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {metric_type}']
+            lines += [f'{metric}{{stage="{name}"}} {getattr(totals, attribute)}' for name, totals in sorted(stages.items())]
+
+        for metric, description, index in [('http_requests_total', 'Handled requests', 0),
+                                           ('http_request_seconds_total', 'Wall time spent handling requests', 1)]:
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} counter']
+            lines += [f'{metric}{{method="{method}",route="{route}",status="{status}"}} {totals[index]}'
+                      for (method, route, status), totals in sorted(requests.items())]
+
+        lines += ['# HELP process_peak_rss_bytes Peak resident set size of the process',
+                  '# TYPE process_peak_rss_bytes gauge',
+                  f'process_peak_rss_bytes {peak_rss_bytes()}']
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+# stage records of the current request, shared with the worker threads it runs stages on
+_request_records: ContextVar[Optional[List[StageRecord]]] = ContextVar('request_stage_records', default=None)
+
+# set while running work that shouldn't count towards the metrics (e.g. the startup warm-up)
+_unrecorded: ContextVar[bool] = ContextVar('unrecorded_stages', default=False)
+
+
+def peak_rss_bytes() -> int:
+    '''
+    The process' RSS high-water mark, over its whole lifetime
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+def current_rss_bytes() -> int:
+    '''
+    The process' RSS right now, from procfs; without one (e.g. macOS) the high-water mark is the best there is
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+@contextmanager
+def stage(name: str, rows_in: int = 0, bytes_read: int = 0) -> Iterator[StageRecord]:
+    '''
+    Measure a pipeline stage. The caller fills in what it only knows at the end (rows_out, bytes_written...).
+    :param name: stage name, e.g. 'extract'
+    :param rows_in: rows consumed, when known upfront
+    :param bytes_read: bytes read, when known upfront
+    :return: the stage's record
+    '''
+    record = StageRecord(stage=name, rows_in=rows_in, bytes_read=bytes_read)
+    if not METRICS.enabled or _unrecorded.get():
+        yield record
+        return
+
+    started_rss = current_rss_bytes()
+    started = perf_counter()
+    failed = True
+    try:
+        yield record
+        failed = False
+    finally:
+        record.seconds = perf_counter() - started
+        ended_rss = current_rss_bytes()
+        record.rss_bytes = max(started_rss, ended_rss)
+        record.rss_growth_bytes = ended_rss - started_rss
+        METRICS.record_stage(record, failed=failed)
+        request_records = _request_records.get()
+        if request_records is not None:
+            request_records.append(record)
+
+
+@contextmanager
+def collect_request_stages() -> Iterator[List[StageRecord]]:
+    '''
+    Collect the stage records of everything run within the context (including worker threads the context is
+    copied to), e.g. to report them back on a request
+    :return: the list records are appended to
+    '''
+    records: List[StageRecord] = []
+    token = _request_records.set(records)
+    try:
+        yield records
+    finally:
+        _request_records.reset(token)
+
+
+@contextmanager
+def unrecorded() -> Iterator[None]:
+    '''
+    Run stages within the context (including worker threads the context is copied to) without recording them
+    '''
+    token = _unrecorded.set(True)
+    try:
+        yield
+    finally:
+        _unrecorded.reset(token)
+
+
+def server_timing(records: List[StageRecord], total_seconds: Optional[float] = None) -> str:
+    '''
+    Format stage records as a Server-Timing header value, durations and rows summed per stage, with the largest RSS
+    and RSS growth of its runs
+    :param records: stage records of a request
+    :param total_seconds: wall time of the whole request
+    :return: e.g. 'transform;dur=30.4;desc="2 calls / 1000 rows / 80.1 MiB rss (+12.3)", total;dur=51.0;desc=...'
+    '''
+    per_stage: Dict[str, _StageTotals] = {}
+    for record in records:
+        totals = per_stage.setdefault(record.stage, _StageTotals(max_rss_growth_bytes=record.rss_growth_bytes))
+        totals.calls += 1
+        totals.seconds += record.seconds
+        totals.rows_out += record.rows_out
+        totals.max_rss_bytes = max(totals.max_rss_bytes, record.rss_bytes)
+        totals.max_rss_growth_bytes = max(totals.max_rss_growth_bytes, record.rss_growth_bytes)
+    entries = [f'{name};dur={totals.seconds * 1000:.1f};desc="{totals.calls} calls / {totals.rows_out} rows / '
+               f'{totals.max_rss_bytes / _MIB:.1f} MiB rss ({totals.max_rss_growth_bytes / _MIB:+.1f})"'
+               for name, totals in per_stage.items()]
+    if total_seconds is not None:
+        peak_rss = max((record.rss_bytes for record in records), default=0)
+        entries.append(f'total;dur={total_seconds * 1000:.1f}' +
+                       (f';desc="{peak_rss / _MIB:.1f} MiB peak rss"' if records else ''))
+    return ', '.join(entries)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,20 @@
+""" Report options shared by the analysis and the api boiled down to one definition file
+
+Kept free of the data stack (pandas, pyarrow, duckdb), so the api can declare its parameters without loading it.
+"""
+
+# window report modes: today vs the trailing window's average, or the last window vs the window before it
+WINDOW_REPORT_MODES = ('trailing', 'period')
+
+# summary ranking: increases measured in value units or relative to yesterday's average, and the report's orderings
+INCREASE_MODES = ('absolute', 'relative')
+SUMMARY_SORT_KEYS = {
+    'increase': 'top_ranked.ranking_increase DESC',
+    'value': 'top_ranked.today_avg_value DESC',
+    'sample_cnt': 'top_ranked.sample_cnt DESC',
+    'machine': 'machines.machine_name, top_ranked.coordinate',
+}
+
+
+if __name__ == '__main__':
+    pass
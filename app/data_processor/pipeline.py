@@ -1,20 +1,45 @@
 """ Master Pipeline Orchestrator, handles lifecycle of the pipeline and its flows"""
 
 # onboard machine reading
-from .extract import extract_csv
-from .transform import transform_sensor_data
-from .load import load_parquet
+from .extract import extract_csv, extract_csv_chunks
+from .transform import transform_sensor_data, transform_sensor_data_duckdb
+from .load import load_parquet, load_parquet_sorted, sort_sensor_data, sensor_data_write_options, \
+    DEFAULT_ROW_GROUP_SIZE, SENSOR_DATA_SCHEMA, SENSOR_DATA_SORT_KEY
+from .lake import load_day_to_lake
+from .lookups import LookupIndex, LOOKUP_VERSION_METADATA_KEY, sensors_lookup
 
 # summary report production
-from .analysis import make_summary_report
+from .analysis import make_summary_report, make_summary_report_from_lake
 
 # lib imports
+import itertools
 import os
-from typing import List
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import time
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import duckdb
 import logging
+import pandas as pd
+import pyarrow as pa
 
+# onboarding engines selectable per call
+ONBOARD_ENGINES = ('pandas', 'duckdb')
 
-def onboard_machine_readings_etl(machine_readings_csv: str, sensors_csv: str, output_parquet: str) -> str:
+# a day's readings, in one csv or split over several part files (e.g. one per machine)
+MachineReadings = Union[str, BinaryIO, Sequence[Union[str, BinaryIO]]]
+
+
+# the sensors lookup: its csv, the lookup itself or its (prebuilt, versioned) index
+SensorsLookup = Union[str, pd.DataFrame, LookupIndex]
+
+
+def onboard_machine_readings_etl(machine_readings_csv: MachineReadings, sensors_csv: SensorsLookup,
+                                 output_parquet: str, chunk_size: Optional[int] = None, engine: str = 'pandas',
+                                 row_group_size: int = DEFAULT_ROW_GROUP_SIZE) -> str:
+
+    if engine not in ONBOARD_ENGINES:
+        raise ValueError(f"Unknown onboarding engine '{engine}', expected one of {ONBOARD_ENGINES}")
 
     # Early terminate if exists
     if os.path.exists(output_parquet):
@@ -22,50 +47,208 @@ def onboard_machine_readings_etl(machine_readings_csv: str, sensors_csv: str, ou
         return ''
     print(f"[INFO] Onboarding process for '{machine_readings_csv}' started..")
 
-    # Extract
-    df_machine = extract_csv(machine_readings_csv)
-    df_lookup = extract_csv(sensors_csv)
-
-    # Transform
-    df_transformed = transform_sensor_data(machine_reading_df=df_machine,
-                                           sensors_lookup_df=df_lookup)
-
-    # Load
-    onboarded_data = load_parquet(parquet_path=output_parquet, df=df_transformed)
+    # DuckDB mode, extract/transform/load in a single statement
+    if engine == 'duckdb':
+        if not isinstance(machine_readings_csv, str) or not isinstance(sensors_csv, str) or chunk_size is not None:
+            raise ValueError("The duckdb engine reads csv files by path and does not take a chunk size")
+        return transform_sensor_data_duckdb(machine_readings_csv=machine_readings_csv,
+                                            sensors_csv=sensors_csv,
+                                            output_parquet=output_parquet,
+                                            row_group_size=row_group_size)
+
+    # Sensors lookup index, unless already built by the caller
+    df_lookup = sensors_lookup(sensors_csv)
+
+    # Streaming mode, memory is bounded by chunk size rather than file size, the out of core sort gives the same
+    # output as the in memory mode (part files are streamed one after the other)
+    if chunk_size is not None:
+        inserted_at = int(time() * 1_000_000)
+        transformed_chunks = (transform_sensor_data(machine_reading_df=df_chunk,
+                                                    sensors_lookup_df=df_lookup,
+                                                    inserted_at=inserted_at)
+                              for df_chunk in itertools.chain.from_iterable(
+                                  extract_csv_chunks(part_csv, chunk_size=chunk_size)
+                                  for part_csv in _reading_parts(machine_readings_csv)))
+        return load_parquet_sorted(parquet_path=output_parquet, dfs=transformed_chunks, sort_key=SENSOR_DATA_SORT_KEY,
+                                   metadata={LOOKUP_VERSION_METADATA_KEY: df_lookup.version.encode()},
+                                   schema=SENSOR_DATA_SCHEMA,
+                                   **sensor_data_write_options(row_group_size))
+
+    # Extract & Transform, part files concurrently
+    parts = _reading_parts(machine_readings_csv)
+    if len(parts) == 1:
+        onboarded_table = onboard_machine_readings(machine_readings_csv=parts[0], sensors_csv=df_lookup)
+    else:
+        onboarded_table = onboard_machine_reading_parts(machine_readings_parts=parts, sensors_csv=df_lookup)
+
+    # Load, in the compact sorted layout
+    onboarded_data = load_parquet(parquet_path=output_parquet, df=onboarded_table,
+                                  **sensor_data_write_options(row_group_size))
     return onboarded_data
 
 
-def produce_summary_report_etl(sensor_data_parquets: List[str], machines_lookup_csv: str, output_path: str) -> str:
+def onboard_machine_readings(machine_readings_csv: Union[str, BinaryIO], sensors_csv: SensorsLookup,
+                             chunk_size: Optional[int] = None, inserted_at: Optional[int] = None) -> pa.Table:
+    '''
+    Onboard machine readings in memory, for callers that query them right away (e.g. make_summary_report) and
+    only persist them when they want to (load_parquet takes the table as is)
+    :param machine_readings_csv: machine reading csv path or binary file-like object, plain, gzip or zstd compressed
+    :param sensors_csv: a csv containing the sensors lookup, the lookup itself or its index
+    :param chunk_size: extract and transform this many rows at a time, only the Arrow copy is kept
+    :param inserted_at: insertion time in epoch microseconds, defaults to now
+    :return: the onboarded sensor data, in the sorted layout, as an Arrow table stamped with the lookup version
+    '''
+    df_lookup = sensors_lookup(sensors_csv)
+
+    # Chunks are converted to Arrow as they come, only the compact columnar copy is kept
+    if chunk_size is not None:
+        inserted_at = inserted_at if inserted_at is not None else int(time() * 1_000_000)
+        tables = []
+        for df_chunk in extract_csv_chunks(machine_readings_csv, chunk_size=chunk_size):
+            df_transformed = transform_sensor_data(machine_reading_df=df_chunk, sensors_lookup_df=df_lookup,
+                                                   inserted_at=inserted_at)
+            tables.append(pa.Table.from_pandas(df_transformed, schema=SENSOR_DATA_SCHEMA, preserve_index=False))
+        if not tables:
+            raise ValueError(f"No machine readings in '{machine_readings_csv}'")
+        table = pa.concat_tables(tables).sort_by([(column, 'ascending') for column in SENSOR_DATA_SORT_KEY])
+    else:
+        df_transformed = transform_sensor_data(machine_reading_df=extract_csv(machine_readings_csv),
+                                               sensors_lookup_df=df_lookup, inserted_at=inserted_at)
+        table = pa.Table.from_pandas(sort_sensor_data(df_transformed), schema=SENSOR_DATA_SCHEMA,
+                                     preserve_index=False)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                          LOOKUP_VERSION_METADATA_KEY: df_lookup.version.encode()})
+
+
+def onboard_machine_reading_parts(machine_readings_parts: Sequence[Union[str, BinaryIO]],
+                                  sensors_csv: SensorsLookup, chunk_size: Optional[int] = None,
+                                  max_workers: Optional[int] = None) -> pa.Table:
+    '''
+    Onboard a day split over several part files (e.g. one per machine) concurrently, into one day dataset
+    :param machine_readings_parts: the day's machine reading csvs, paths or binary file-like objects
+    :param sensors_csv: a csv containing the sensors lookup, the lookup itself or its index
+    :param chunk_size: extract and transform this many rows at a time, per part
+    :param max_workers: parts onboarded at once, defaults to one thread per part
+    :return: the onboarded sensor data of the whole day, see onboard_machine_readings
+    '''
+    parts = _reading_parts(machine_readings_parts)
+    df_lookup = sensors_lookup(sensors_csv)
+    inserted_at = int(time() * 1_000_000)  # one insertion time for the whole day
+    with ThreadPoolExecutor(max_workers=max_workers or len(parts)) as executor:
+        tables = list(executor.map(lambda part_csv: onboard_machine_readings(machine_readings_csv=part_csv,
+                                                                            sensors_csv=df_lookup,
+                                                                            chunk_size=chunk_size,
+                                                                            inserted_at=inserted_at), parts))
+    return merge_onboarded_parts(tables)
+
+
+def merge_onboarded_parts(tables: Sequence[pa.Table]) -> pa.Table:
+    '''
+    Merge onboarded part files of a day back into the sorted layout, same rows and order as onboarding the
+    parts concatenated into a single csv
+    :param tables: onboarded parts, in part order
+    :return: the onboarded day
+    '''
+    if len(tables) == 1:
+        return tables[0]
+    table = pa.concat_tables(tables, promote_options='permissive')
+    return table.sort_by([(column, 'ascending') for column in SENSOR_DATA_SORT_KEY])
+
+
+def _reading_parts(machine_readings_csv: MachineReadings) -> List[Union[str, BinaryIO]]:
+    if isinstance(machine_readings_csv, str) or hasattr(machine_readings_csv, 'read'):
+        return [machine_readings_csv]
+    if not machine_readings_csv:
+        raise ValueError("Expected at least one machine readings csv")
+    return list(machine_readings_csv)
+
+
+def produce_summary_report_etl(sensor_data_parquets: List[str], machines_lookup_csv: Optional[str], output_path: str,
+                               connection: Optional[duckdb.DuckDBPyConnection] = None) -> str:
 
     # Transform
     df_report = make_summary_report(sensor_data_parquets=sensor_data_parquets,
-                                    machines_lookup_csv=machines_lookup_csv)
+                                    machines_lookup_csv=machines_lookup_csv,
+                                    connection=connection)
 
     # Load
     summary_report = load_parquet(parquet_path=output_path, df=df_report)
     return summary_report
 
-if __name__ == '__main__':
-    pass
-
-    # dir for the general data
-    data_dir = r"C:\\Users\\zivg\\Documents\\Repos\\razorlabs-homeassignment\\data"
-
-    # paths to files
-    machine_readings_csvs_list = [os.path.join(data_dir, 'csv', '2024-01-01.csv'),
-                                  os.path.join(data_dir, 'csv', '2024-01-02.csv')]
-    sensors_csv = os.path.join(data_dir, 'csv', 'Sensors.csv')
-    output_parquets = [os.path.join(data_dir, 'parquet', '2024-01-01.parquet'),
-                       os.path.join(data_dir, 'parquet', '2024-01-02.parquet')]
-
-    for machine_readings_csv, output_parquet in zip(machine_readings_csvs_list, output_parquets):
+def produce_batch_summary_reports(sites: Sequence[Tuple[str, MachineReadings, MachineReadings]],
+                                  sensors_csv: SensorsLookup, machines_lookup_csv: str,
+                                  chunk_size: Optional[int] = None, max_workers: Optional[int] = None,
+                                  **ranking) -> Iterator[Tuple[str, Union[pa.Table, Exception]]]:
+    '''
+    Summary reports of many sites at once, e.g. a nightly run over every plant: sites are onboarded and summarized
+    concurrently on a bounded pool sharing one lookup index, so the batch takes about as long as its slowest site
+    :param sites: (site, yesterday's readings, today's readings) of every site, readings as for
+     onboard_machine_readings_etl (a csv, or a day's part files)
+    :param sensors_csv: a csv containing the sensors lookup, the lookup itself or its index
+    :param machines_lookup_csv: a csv containing the machines lookup
+    :param chunk_size: extract and transform this many rows at a time, per file
+    :param max_workers: sites processed at once, defaults to one per cpu
+    :param ranking: make_summary_report ranking keyword arguments (top_k, min_increase..)
+    :return: (site, its summary report as an Arrow table) as each site finishes, or the exception it failed with;
+     a failing site doesn't fail the others
+    '''
+    lookup = sensors_lookup(sensors_csv)  # one index for the whole batch
+    executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 4, thread_name_prefix='batch-site')
+    try:
+        futures = {executor.submit(_site_summary_report, yesterday, today, lookup, machines_lookup_csv, chunk_size,
+                                   ranking): site for site, yesterday, today in sites}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                print(f"[ERROR] failed producing the summary report of site '{futures[future]}': {e}")
+                yield futures[future], e
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)  # the caller may stop early
+
+
+def _site_summary_report(yesterday: MachineReadings, today: MachineReadings, lookup: LookupIndex,
+                         machines_lookup_csv: str, chunk_size: Optional[int], ranking: Dict) -> pa.Table:
+    days = []
+    for readings in (yesterday, today):
+        parts = _reading_parts(readings)
+        days.append(onboard_machine_readings(machine_readings_csv=parts[0], sensors_csv=lookup, chunk_size=chunk_size)
+                    if len(parts) == 1 else
+                    onboard_machine_reading_parts(machine_readings_parts=parts, sensors_csv=lookup,
+                                                  chunk_size=chunk_size))
+    return make_summary_report(sensor_data_parquets=days, machines_lookup_csv=machines_lookup_csv, as_arrow=True,
+                               **ranking)
+
+
+def onboard_day_to_lake_etl(machine_readings_csv: MachineReadings, sensors_csv: SensorsLookup,
+                            lake_dir: str, date: str, chunk_size: Optional[int] = None, engine: str = 'pandas') -> str:
+
+    # Onboard aside, then land the day in the lake (replacing it if it was already there)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        day_parquet = onboard_machine_readings_etl(machine_readings_csv=machine_readings_csv,
+                                                   sensors_csv=sensors_csv,
+                                                   output_parquet=os.path.join(tmpdir, 'day.parquet'),
+                                                   chunk_size=chunk_size,
+                                                   engine=engine)
+        if not day_parquet:
+            return ''
+        return load_day_to_lake(day_parquet=day_parquet, lake_dir=lake_dir, date=date)
+
+
+def produce_summary_report_from_lake_etl(lake_dir: str, yesterday_date: str, today_date: str,
+                                         machines_lookup_csv: Optional[str], output_path: str,
+                                         connection: Optional[duckdb.DuckDBPyConnection] = None) -> str:
+
+    # Transform, answered from the daily aggregates only
+    df_report = make_summary_report_from_lake(lake_dir=lake_dir,
+                                              yesterday_date=yesterday_date,
+                                              today_date=today_date,
+                                              machines_lookup_csv=machines_lookup_csv,
+                                              connection=connection)
 
-        onboard_machine_readings_etl(machine_readings_csv=machine_readings_csv,
-                                     sensors_csv=sensors_csv,
-                                     output_parquet=output_parquet)
+    # Load
+    summary_report = load_parquet(parquet_path=output_path, df=df_report)
+    return summary_report
 
-    machines_lookup_csv = os.path.join(data_dir, 'csv', 'Machines.csv')
-    output_summary = os.path.join(data_dir, 'parquet', 'summary-2024-01-02.parquet')
-    produce_summary_report_etl(sensor_data_parquets=output_parquets,
-                               machines_lookup_csv=machines_lookup_csv,
-                               output_path=output_summary)
+if __name__ == '__main__':
+    pass  # batch onboarding lives in backfill.py: python -m app.data_processor.backfill --help
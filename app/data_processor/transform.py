@@ -1,50 +1,152 @@
 """ Transformation methods from different sources boiled down to one definition file"""
 
+# proj imports
+from .metrics import stage
+from .load import SENSOR_DATA_SORT_KEY, DEFAULT_ROW_GROUP_SIZE
+from .lookups import LookupIndex, LOOKUP_COLUMNS, LOOKUP_VERSION_METADATA_KEY
+from .cache import hash_file
+
 # lib imports
+import duckdb
+import numpy as np
 import pandas as pd
+import os
+import warnings
 from time import time
+from typing import Optional, Union
 
-def transform_sensor_data(machine_reading_df: pd.DataFrame, sensors_lookup_df: pd.DataFrame) -> pd.DataFrame:
+def transform_sensor_data(machine_reading_df: pd.DataFrame, sensors_lookup_df: Union[pd.DataFrame, LookupIndex],
+                          inserted_at: Optional[int] = None, fast_path: bool = True) -> pd.DataFrame:
     '''
     Transforms machine reading data frame, and a sensors lookup table, to a parquet containing the relevant
     operations per defined in the docs of the assignment.
     :param machine_reading_df: machine reading data frame of a day
-    :param sensors_lookup_df: a lookup table used to describe a sensor
+    :param sensors_lookup_df: a lookup table used to describe a sensor, or its LookupIndex (pass the index when
+     transforming several chunks, it is built once)
+    :param inserted_at: insertion time in epoch microseconds, defaults to now (pass it to keep chunks consistent)
+    :param fast_path: use the vectorised timestamp parsing and the integer keyed tag mapping where the input allows
+     it, the generic pandas path is used otherwise
     :return: a pandas dataframe
     '''
 
-    # Normalize columns to lowercase and underscore style (sensors lookup style)
-    machine_reading_df = machine_reading_df.rename(columns={
-        'Tag Name': 'tag_name',
-        'Timestamp': 'timestamp',
-        'Value': 'value'
-    })
-    machine_reading_df['sample_time'] = \
-        pd.to_datetime(machine_reading_df['timestamp'], utc=True).astype('int64') // 1000  # Epoch in microseconds
-
-    # force value field to be float64
-    machine_reading_df['value'] = pd.to_numeric(machine_reading_df['value'], errors='coerce')
-
-    # Join relevant cols based on tag_name
-    join_col = ['tag_name']
-    relevant_machine_reading_cols = ['sample_time', 'value'] + join_col
-    relevant_sensors_lookup_cols = ['machine_code', 'component_code', 'coordinate'] + join_col
-    joined_df = machine_reading_df[relevant_machine_reading_cols].merge(
-                sensors_lookup_df[relevant_sensors_lookup_cols], on='tag_name', how='left').drop(columns=join_col)
-
-    # Add insertion time
-    joined_df['inserted_at'] = int(time() * 1_000_000)
-
-    # Sort columns
-    sorted_columns = [
-        'machine_code',
-        'component_code',
-        'coordinate',
-        'sample_time',
-        'value',
-        'inserted_at']
-
-    return joined_df[sorted_columns]
+    with stage('transform', rows_in=machine_reading_df.shape[0]) as record:
+
+        # Normalize columns to lowercase and underscore style (sensors lookup style)
+        machine_reading_df = machine_reading_df.rename(columns={
+            'Tag Name': 'tag_name',
+            'Timestamp': 'timestamp',
+            'Value': 'value'
+        })
+        sample_time = _parse_iso_timestamps(machine_reading_df['timestamp']) if fast_path else None
+        if sample_time is None:
+            sample_time = pd.to_datetime(machine_reading_df['timestamp'], utc=True).astype('int64') // 1000
+        machine_reading_df['sample_time'] = sample_time  # Epoch in microseconds
+
+        # force value field to be float64
+        machine_reading_df['value'] = pd.to_numeric(machine_reading_df['value'], errors='coerce')
+
+        # Join relevant cols based on tag_name
+        lookup = sensors_lookup_df if isinstance(sensors_lookup_df, LookupIndex) else LookupIndex(sensors_lookup_df)
+        join_col = ['tag_name']
+        relevant_machine_reading_cols = ['sample_time', 'value'] + join_col
+        relevant_sensors_lookup_cols = LOOKUP_COLUMNS + join_col
+        mapped_cols = lookup.map_tags(machine_reading_df['tag_name']) if fast_path else None
+        if mapped_cols is not None:
+            joined_df = pd.DataFrame({'sample_time': machine_reading_df['sample_time'].to_numpy(),
+                                      'value': machine_reading_df['value'].to_numpy(),
+                                      **mapped_cols})
+        else:
+            joined_df = machine_reading_df[relevant_machine_reading_cols].merge(
+                        lookup.sensors_df[relevant_sensors_lookup_cols], on='tag_name', how='left').drop(columns=join_col)
+
+        # Add insertion time
+        joined_df['inserted_at'] = int(time() * 1_000_000) if inserted_at is None else inserted_at
+
+        # Sort columns
+        sorted_columns = [
+            'machine_code',
+            'component_code',
+            'coordinate',
+            'sample_time',
+            'value',
+            'inserted_at']
+
+        record.rows_out = joined_df.shape[0]
+        return joined_df[sorted_columns]
+
+
+def _parse_iso_timestamps(timestamps: pd.Series) -> Optional[np.ndarray]:
+    '''
+    Fast path for naive ISO-8601 timestamps (e.g. 2024-01-01T00:10:00), parsed by numpy's vectorised parser as UTC
+    :param timestamps: timestamp strings
+    :return: epoch microseconds, or None when the input needs the generic parser (time zones, other formats,
+     missing values)
+    '''
+    if timestamps.dtype != object or (len(timestamps) and not isinstance(timestamps.iloc[0], str)):
+        return None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')  # numpy only warns on time zone offsets, those go the generic way
+            parsed = timestamps.to_numpy().astype('datetime64[us]')
+    except (ValueError, TypeError, OverflowError, Warning):
+        return None
+    if np.isnat(parsed).any():
+        return None
+    return parsed.astype('int64')
+
+
+def transform_sensor_data_duckdb(machine_readings_csv: str, sensors_csv: str, output_parquet: str,
+                                 row_group_size: int = DEFAULT_ROW_GROUP_SIZE) -> str:
+    '''
+    Same transformation as transform_sensor_data, done natively in DuckDB: csv in, parquet out in a single
+    COPY statement, without materialising pandas frames. Output schema, layout and lookup version stamp match the
+    pandas path.
+    :param machine_readings_csv: machine reading csv of a day
+    :param sensors_csv: a csv containing the sensors lookup
+    :param output_parquet: desired parquet file
+    :param row_group_size: rows per row group
+    :return: path to the parquet, or empty string on failure
+    '''
+    copy_query = """
+    COPY (
+        SELECT
+            sensors.machine_code,
+            sensors.component_code,
+            sensors.coordinate,
+            epoch_us(CAST(readings."Timestamp" AS TIMESTAMPTZ)) AS sample_time,  -- Epoch in microseconds
+            TRY_CAST(readings."Value" AS DOUBLE) AS value,
+            epoch_us(get_current_timestamp()) AS inserted_at
+        FROM read_csv($machine_readings_csv, header = true, all_varchar = true) AS readings
+        LEFT JOIN read_csv($sensors_csv, header = true, all_varchar = true) AS sensors
+            ON readings."Tag Name" = sensors.tag_name
+        ORDER BY {sort_key}
+    ) TO {output_parquet} (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE {row_group_size},
+                           KV_METADATA {{{metadata_key}: '{lookup_version}'}})
+    """
+    try:
+
+        # Check for target file existence
+        if os.path.exists(output_parquet):
+            print(f"[WARNING] file '{output_parquet}' already exists, overwriting existing file!")
+
+        print(f"[INFO] transforming '{machine_readings_csv}' into '{output_parquet}' with duckdb..")
+        with stage('transform', bytes_read=os.path.getsize(machine_readings_csv)) as record, duckdb.connect() as con:
+            con.execute("SET TimeZone = 'UTC'")  # naive timestamps are UTC, same as pd.to_datetime(utc=True)
+            copied_rows, = con.execute(copy_query.format(output_parquet="'{}'".format(output_parquet.replace("'", "''")),
+                                                         sort_key=', '.join(SENSOR_DATA_SORT_KEY),
+                                                         row_group_size=int(row_group_size),
+                                                         metadata_key=LOOKUP_VERSION_METADATA_KEY.decode(),
+                                                         lookup_version=hash_file(sensors_csv)),
+                                       {'machine_readings_csv': machine_readings_csv,
+                                        'sensors_csv': sensors_csv}).fetchone()
+            record.rows_in = record.rows_out = copied_rows
+            record.bytes_written = os.path.getsize(output_parquet)
+        print(f"[INFO] successfully saved as parquet: '{output_parquet}'!")
+        return output_parquet
+
+    except Exception as e:
+        print(f"[ERROR] failed to transform '{machine_readings_csv}' with duckdb: {e}")
+        return ''
 
 
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+""" Benchmark of transform_sensor_data's vectorised fast path against the generic pandas path
+
+usage: python -m benchmarks.bench_transform --rows 3000000
+"""
+
+# proj imports
+from app.data_processor.transform import transform_sensor_data
+
+# lib imports
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from time import perf_counter
+
+SENSORS_CSV = os.path.join(os.path.dirname(__file__), '..', 'data', 'csv', 'Sensors.csv')
+
+
+def make_readings(rows: int, sensors_lookup_df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Readings of every tag in the lookup (plus an unknown one) every second, as read from a daily csv
+    '''
+    tags = np.append(sensors_lookup_df['tag_name'].to_numpy(), 'RZR__UNKNOWN')
+    start = np.datetime64('2024-01-01T00:00:00')
+    return pd.DataFrame({
+        'Tag Name': tags[np.arange(rows) % len(tags)],
+        'Timestamp': (start + (np.arange(rows) // len(tags)).astype('timedelta64[s]')).astype(str).astype(object),
+        'Value': np.random.default_rng(0).normal(15, 3, rows).round(3)
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=3_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    sensors_lookup_df = pd.read_csv(SENSORS_CSV)
+    readings_df = make_readings(args.rows, sensors_lookup_df)
+
+    timings, outputs = {}, {}
+    for fast_path in (False, True):
+        best = float('inf')
+        for _ in range(args.repeat):
+            started = perf_counter()
+            outputs[fast_path] = transform_sensor_data(readings_df, sensors_lookup_df, inserted_at=0,
+                                                       fast_path=fast_path)
+            best = min(best, perf_counter() - started)
+        timings[fast_path] = best
+
+    pd.testing.assert_frame_equal(outputs[True], outputs[False])
+    print(f"rows: {args.rows}")
+    print(f"generic path: {timings[False]:.3f}s")
+    print(f"fast path:    {timings[True]:.3f}s ({timings[False] / timings[True]:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
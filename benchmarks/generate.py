@@ -0,0 +1,143 @@
+""" Synthetic plant data generator, daily csvs in the `Tag Name,Timestamp,Value` format plus matching lookups
+
+usage: python -m benchmarks.generate --output-dir /tmp/plant --machines 20 --tags-per-machine 50 --interval 10 --days 2
+(20 machines x 50 tags sampled every 10 seconds = 8.64M rows a day)
+"""
+
+# lib imports
+import argparse
+import datetime
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from typing import Dict, List
+
+COMPONENTS = ['Motor', 'Gearbox', 'Pump', 'Bearing']
+BLOCK_ROWS = 1_000_000  # rows generated and written at a time, keeps memory flat at any scale
+
+# description of a generated dataset, written last so a partially generated one is never reused
+DATASET_JSON = 'dataset.json'
+
+
+def make_lookups(machines: int, tags_per_machine: int) -> Dict[str, pd.DataFrame]:
+    '''
+    Machines and sensors lookups of a synthetic plant
+    :param machines: number of machines
+    :param tags_per_machine: number of sensor tags on every machine
+    :return: {'machines': machines lookup, 'sensors': sensors lookup}
+    '''
+    machine_codes = [f'M{machine:04d}' for machine in range(machines)]
+    machines_df = pd.DataFrame({'machine_code': machine_codes,
+                                'machine_name': [f'Machine {code}' for code in machine_codes]})
+    sensors_df = pd.DataFrame([{'tag_name': f'RZR__{code}_{tag:04d}',
+                                'machine_code': code,
+                                'component_code': COMPONENTS[tag % len(COMPONENTS)],
+                                'coordinate': f'{tag}{"VHA"[tag % 3]}'}
+                               for code in machine_codes for tag in range(tags_per_machine)])
+    return {'machines': machines_df, 'sensors': sensors_df}
+
+
+def write_day_csv(csv_path: str, date: datetime.date, tag_names: List[str], interval: int, seed: int) -> int:
+    '''
+    Write one day of readings, every tag sampled every `interval` seconds, block by block
+    :return: number of rows written
+    '''
+    rng = np.random.default_rng(seed)
+    tags = np.asarray(tag_names, dtype=object)
+    tag_levels = np.random.default_rng(0).uniform(5, 25, len(tags))  # stable per tag across days
+    tag_drifts = rng.normal(0, 1, len(tags))  # day to day change, so summaries have increases to rank
+    start = np.datetime64(date.isoformat(), 's')
+    total_rows = len(tags) * (86_400 // interval)
+
+    schema = pa.schema([('Tag Name', pa.string()), ('Timestamp', pa.string()), ('Value', pa.float64())])
+    options = pa_csv.WriteOptions(include_header=False, quoting_style='none')
+    with open(csv_path, 'wb') as f, pa_csv.CSVWriter(f, schema, write_options=options) as writer:
+        f.write(','.join(schema.names).encode() + b'\n')  # unquoted header, like the plant exports
+        for block_start in range(0, total_rows, BLOCK_ROWS):
+            rows = np.arange(block_start, min(block_start + BLOCK_ROWS, total_rows))
+            tag_idx = rows % len(tags)
+            timestamps = start + (rows // len(tags)) * np.timedelta64(interval, 's')
+            values = np.round(tag_levels[tag_idx] + tag_drifts[tag_idx] + rng.normal(0, 2, len(rows)), 3)
+            writer.write_table(pa.table({'Tag Name': tags[tag_idx],
+                                         'Timestamp': timestamps.astype(str),
+                                         'Value': values}))
+    return total_rows
+
+
+def generate(output_dir: str, machines: int, tags_per_machine: int, interval: int, days: int,
+             start_date: str = '2024-01-01', seed: int = 0) -> Dict:
+    '''
+    Generate a synthetic plant: Machines.csv, Sensors.csv and one <yyyy-mm-dd>.csv per day
+    :param output_dir: directory written to, created if missing
+    :param machines: number of machines
+    :param tags_per_machine: number of sensor tags on every machine
+    :param interval: sampling interval in seconds
+    :param days: number of consecutive days
+    :param start_date: iso date of the first day
+    :param seed: random seed, same parameters and seed give the same data
+    :return: description of the generated dataset
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    lookups = make_lookups(machines, tags_per_machine)
+    lookups['machines'].to_csv(os.path.join(output_dir, 'Machines.csv'), index=False)
+    lookups['sensors'].to_csv(os.path.join(output_dir, 'Sensors.csv'), index=False)
+
+    first_day = datetime.date.fromisoformat(start_date)
+    day_csvs, rows = [], 0
+    for day in range(days):
+        date = first_day + datetime.timedelta(days=day)
+        csv_path = os.path.join(output_dir, f'{date.isoformat()}.csv')
+        rows += write_day_csv(csv_path, date, list(lookups['sensors']['tag_name']), interval, seed + day)
+        day_csvs.append(csv_path)
+
+    dataset = {'output_dir': output_dir, 'machines': machines, 'tags_per_machine': tags_per_machine,
+               'interval': interval, 'days': days, 'start_date': start_date, 'rows_per_day': rows // days,
+               'seed': seed, 'day_csvs': day_csvs,
+               'machines_csv': os.path.join(output_dir, 'Machines.csv'),
+               'sensors_csv': os.path.join(output_dir, 'Sensors.csv')}
+    with open(os.path.join(output_dir, DATASET_JSON), 'w') as f:
+        json.dump(dataset, f, indent=2)
+    return dataset
+
+
+def load_or_generate(output_dir: str, machines: int, tags_per_machine: int, interval: int, days: int,
+                     start_date: str = '2024-01-01', seed: int = 0) -> Dict:
+    '''
+    Reuse the dataset already generated in output_dir with the same parameters, generate it otherwise
+    :return: description of the dataset, see generate
+    '''
+    parameters = {'machines': machines, 'tags_per_machine': tags_per_machine, 'interval': interval, 'days': days,
+                  'start_date': start_date, 'seed': seed}
+    try:
+        with open(os.path.join(output_dir, DATASET_JSON)) as f:
+            dataset = json.load(f)
+    except (OSError, ValueError):
+        dataset = {}
+    paths = dataset.get('day_csvs', []) + [dataset.get('machines_csv', ''), dataset.get('sensors_csv', '')]
+    if all(dataset.get(key) == value for key, value in parameters.items()) and all(map(os.path.exists, paths)):
+        print(f"[INFO] reusing the dataset generated in '{output_dir}'")
+        return dataset
+    return generate(output_dir=output_dir, **parameters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic daily sensor data csvs')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--machines', type=int, default=10)
+    parser.add_argument('--tags-per-machine', type=int, default=20)
+    parser.add_argument('--interval', type=int, default=60, help='sampling interval in seconds')
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--start-date', default='2024-01-01')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = generate(output_dir=args.output_dir, machines=args.machines, tags_per_machine=args.tags_per_machine,
+                       interval=args.interval, days=args.days, start_date=args.start_date, seed=args.seed)
+    print(f"[INFO] generated {dataset['days']} days of {dataset['rows_per_day']} rows in '{args.output_dir}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+""" Benchmark harness: times every pipeline stage, the /report endpoint and the app startup on synthetic plant data
+
+Every stage runs in a fresh process, so its peak RSS is its own. Results are written as json; pass a previous
+results file with --compare to print the change per stage.
+
+usage: python -m benchmarks.run --machines 20 --tags-per-machine 50 --interval 10 --output results.json
+       python -m benchmarks.run ... --output new.json --compare results.json
+"""
+
+# proj imports
+from benchmarks.generate import load_or_generate
+
+# lib imports
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+CHUNK_SIZE = 250_000
+
+
+def _stage_extract(dataset: Dict, workdir: str) -> Dict:
+    from app.data_processor.extract import extract_csv
+    started = perf_counter()
+    df = extract_csv(dataset['day_csvs'][-1])
+    return {'seconds': perf_counter() - started, 'rows_in': len(df), 'rows_out': len(df)}
+
+
+def _stage_transform(dataset: Dict, workdir: str) -> Dict:
+    from app.data_processor.extract import extract_csv
+    from app.data_processor.transform import transform_sensor_data
+    readings_df, sensors_df = extract_csv(dataset['day_csvs'][-1]), extract_csv(dataset['sensors_csv'])
+    started = perf_counter()
+    df = transform_sensor_data(machine_reading_df=readings_df, sensors_lookup_df=sensors_df)
+    return {'seconds': perf_counter() - started, 'rows_in': len(readings_df), 'rows_out': len(df)}
+
+
+def _stage_load(dataset: Dict, workdir: str) -> Dict:
+    from app.data_processor.extract import extract_csv
+    from app.data_processor.transform import transform_sensor_data
+    from app.data_processor.load import load_parquet, sort_sensor_data, sensor_data_write_options
+    df = transform_sensor_data(machine_reading_df=extract_csv(dataset['day_csvs'][-1]),
+                               sensors_lookup_df=extract_csv(dataset['sensors_csv']))
+    output_parquet = os.path.join(workdir, 'load.parquet')
+    started = perf_counter()
+    load_parquet(parquet_path=output_parquet, df=sort_sensor_data(df), **sensor_data_write_options())
+    return {'seconds': perf_counter() - started, 'rows_in': len(df), 'rows_out': len(df),
+            'bytes_out': os.path.getsize(output_parquet)}
+
+
+def _onboard(dataset: Dict, workdir: str, name: str, **kwargs) -> Dict:
+    from app.data_processor.pipeline import onboard_machine_readings_etl
+    csv_file = dataset['day_csvs'][-1]
+    output_parquet = os.path.join(workdir, f'{name}.parquet')
+    started = perf_counter()
+    if kwargs.get('chunk_size') is not None:
+        with open(csv_file, 'rb') as f:
+            onboard_machine_readings_etl(machine_readings_csv=f, sensors_csv=dataset['sensors_csv'],
+                                         output_parquet=output_parquet, **kwargs)
+    else:
+        onboard_machine_readings_etl(machine_readings_csv=csv_file, sensors_csv=dataset['sensors_csv'],
+                                     output_parquet=output_parquet, **kwargs)
+    return {'seconds': perf_counter() - started, 'rows_in': dataset['rows_per_day'],
+            'bytes_in': os.path.getsize(csv_file), 'bytes_out': os.path.getsize(output_parquet)}
+
+
+def _stage_onboard_pandas(dataset: Dict, workdir: str) -> Dict:
+    return _onboard(dataset, workdir, 'onboard_pandas', engine='pandas')
+
+
+def _stage_onboard_streaming(dataset: Dict, workdir: str) -> Dict:
+    return _onboard(dataset, workdir, 'onboard_streaming', chunk_size=CHUNK_SIZE)
+
+
+def _stage_onboard_duckdb(dataset: Dict, workdir: str) -> Dict:
+    return _onboard(dataset, workdir, 'onboard_duckdb', engine='duckdb')
+
+
+def _stage_summary(dataset: Dict, workdir: str) -> Dict:
+    from app.data_processor.pipeline import onboard_machine_readings_etl
+    from app.data_processor.analysis import make_summary_report
+    day_parquets = [os.path.join(workdir, f'summary-day-{day}.parquet') for day in range(2)]
+    for csv_file, day_parquet in zip(dataset['day_csvs'][-2:], day_parquets):
+        onboard_machine_readings_etl(machine_readings_csv=csv_file, sensors_csv=dataset['sensors_csv'],
+                                     output_parquet=day_parquet, engine='duckdb')
+    started = perf_counter()
+    df = make_summary_report(sensor_data_parquets=day_parquets, machines_lookup_csv=dataset['machines_csv'])
+    return {'seconds': perf_counter() - started, 'rows_in': 2 * dataset['rows_per_day'], 'rows_out': len(df)}
+
+
+def _stage_endpoint(dataset: Dict, workdir: str) -> Dict:
+    from fastapi.testclient import TestClient
+    from app.api import config
+    from app.api.api import app
+    config.SENSORS_CSV, config.MACHINES_CSV = dataset['sensors_csv'], dataset['machines_csv']
+    config.CACHE_DIR = os.path.join(workdir, 'cache')
+
+    def post(client: TestClient) -> float:
+        files = [('machine_readings_csv', (os.path.basename(csv_file), open(csv_file, 'rb'), 'text/csv'))
+                 for csv_file in dataset['day_csvs'][-2:]]
+        started = perf_counter()
+        response = client.post('/report', files=files)
+        response.raise_for_status()
+        return perf_counter() - started
+
+    with TestClient(app) as client:
+        seconds = post(client)
+        cached_seconds = post(client)
+    return {'seconds': seconds, 'cached_seconds': cached_seconds, 'rows_in': 2 * dataset['rows_per_day'],
+            'bytes_in': sum(os.path.getsize(csv_file) for csv_file in dataset['day_csvs'][-2:])}
+
+
+def _stage_startup(dataset: Dict, workdir: str) -> Dict:
+    '''
+    Import time, time to ready and first /report latency of a fresh app process, with the startup warm-up and
+    without it (the first request then pays for the warm-up itself)
+    '''
+    def probe(warm_up: bool, cache_dir: str) -> Dict:
+        command = [sys.executable, '-m', 'benchmarks.startup', '--sensors-csv', dataset['sensors_csv'],
+                   '--machines-csv', dataset['machines_csv'], '--cache-dir', cache_dir, *dataset['day_csvs'][-2:]]
+        completed = subprocess.run(command, capture_output=True, text=True, check=True,
+                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   env={**os.environ, 'WARM_UP_ENABLED': '1' if warm_up else '0'})
+        return json.loads(completed.stdout.splitlines()[-1])
+
+    warm = probe(warm_up=True, cache_dir=os.path.join(workdir, 'startup-cache-warm'))
+    cold = probe(warm_up=False, cache_dir=os.path.join(workdir, 'startup-cache-cold'))
+    return {'seconds': warm['import_seconds'], 'ready_seconds': warm['ready_seconds'],
+            'first_request_seconds': warm['first_request_seconds'],
+            'cold_first_request_seconds': cold['first_request_seconds'], 'rows_in': 2 * dataset['rows_per_day']}
+
+
+STAGES: Dict[str, Callable[[Dict, str], Dict]] = {
+    'extract': _stage_extract,
+    'transform': _stage_transform,
+    'load': _stage_load,
+    'onboard_pandas': _stage_onboard_pandas,
+    'onboard_streaming': _stage_onboard_streaming,
+    'onboard_duckdb': _stage_onboard_duckdb,
+    'summary': _stage_summary,
+    'endpoint': _stage_endpoint,
+    'startup': _stage_startup,
+}
+
+
+def _run_stage(name: str, dataset: Dict, workdir: str) -> Dict:
+    '''
+    Run one stage, in its own worker process
+    :return: the stage's record, with the process' peak RSS
+    '''
+    import contextlib
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):  # the pipeline's progress prints
+        record = STAGES[name](dataset, workdir)
+    record['peak_rss_mb'] = peak_rss_mb()
+    return {'stage': name, **record}
+
+
+def peak_rss_mb() -> float:
+    '''
+    Peak resident set size of this process. VmHWM where available: ru_maxrss survives exec on linux, so a
+    spawned worker would report its parent's peak when that was higher.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024  # kB
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on linux, bytes on macOS
+
+
+def run_stages(dataset: Dict, stages: List[str], workdir: str) -> List[Dict]:
+    records = []
+    for name in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            record = executor.submit(_run_stage, name, dataset, workdir).result()
+        print(f"{name:<18} {record['seconds']:>9.3f}s {record['peak_rss_mb']:>9.1f} MiB peak rss")
+        records.append(record)
+    return records
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict, baseline: Dict):
+    '''
+    Print the change of every stage against a baseline results file
+    '''
+    baseline_stages = {record['stage']: record for record in baseline['stages']}
+    print(f"compared with {baseline.get('commit')} ({baseline.get('created_at')}):")
+    for record in results['stages']:
+        previous = baseline_stages.get(record['stage'])
+        if previous is None:
+            continue
+        print(f"{record['stage']:<18} time x{record['seconds'] / previous['seconds']:.2f}  "
+              f"peak rss x{record['peak_rss_mb'] / previous['peak_rss_mb']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the etl stages and the /report endpoint')
+    parser.add_argument('--data-dir', default=None,
+                        help='generated dataset dir, reused when generated with the same parameters')
+    parser.add_argument('--machines', type=int, default=10)
+    parser.add_argument('--tags-per-machine', type=int, default=20)
+    parser.add_argument('--interval', type=int, default=10, help='sampling interval in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', default=None, help='previous results json to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        data_dir = args.data_dir or os.path.join(workdir, 'data')
+        started = perf_counter()
+        dataset = load_or_generate(output_dir=data_dir, machines=args.machines, tags_per_machine=args.tags_per_machine,
+                                   interval=args.interval, days=2, seed=args.seed)
+        print(f"2 days of {dataset['rows_per_day']} rows ready in {perf_counter() - started:.1f}s")
+        records = run_stages(dataset, args.stages, workdir)
+
+    results = {
+        'commit': _git_commit(),
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'dataset': {key: value for key, value in dataset.items() if key not in ('day_csvs', 'output_dir')
+                    and not key.endswith('_csv')},
+        'stages': records,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to '{args.output}'")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
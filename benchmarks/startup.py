@@ -0,0 +1,56 @@
+""" Startup probe: times the app's import, its warm-up and its first /report, in a process of its own
+
+The benchmark stages run in processes that already imported the data stack (the generator needs it), so the
+startup is measured in a fresh interpreter instead. Prints the record as json on stdout, the app's own prints go
+to stderr.
+
+usage: python -m benchmarks.startup --sensors-csv S.csv --machines-csv M.csv --cache-dir /tmp/cache y.csv t.csv
+       WARM_UP_ENABLED=0 python -m benchmarks.startup ...  (first request served cold)
+"""
+
+# lib imports
+import argparse
+import contextlib
+import json
+import os
+import sys
+from time import perf_counter, sleep
+
+READY_TIMEOUT_SECONDS = 120
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the app startup and its first /report')
+    parser.add_argument('--sensors-csv', required=True)
+    parser.add_argument('--machines-csv', required=True)
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('day_csvs', nargs=2, help="yesterday's and today's readings")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        started = perf_counter()
+        from app.api import config
+        from app.api.api import app
+        from fastapi.testclient import TestClient
+        record = {'import_seconds': perf_counter() - started}
+        config.SENSORS_CSV, config.MACHINES_CSV, config.CACHE_DIR = args.sensors_csv, args.machines_csv, args.cache_dir
+
+        started = perf_counter()
+        with TestClient(app) as client:
+            while client.get('/readyz').status_code != 200:
+                if perf_counter() - started > READY_TIMEOUT_SECONDS:
+                    raise TimeoutError(f"not ready after {READY_TIMEOUT_SECONDS}s")
+                sleep(0.01)
+            record['ready_seconds'] = perf_counter() - started
+
+            files = [('machine_readings_csv', (os.path.basename(csv_file), open(csv_file, 'rb'), 'text/csv'))
+                     for csv_file in args.day_csvs]
+            started = perf_counter()
+            client.post('/report', files=files).raise_for_status()
+            record['first_request_seconds'] = perf_counter() - started
+
+    print(json.dumps(record))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,21 @@
+import io
 import pandas as pd
 import pytest
 import os
-from app.data_processor.extract import extract_csv
+from app.data_processor.extract import extract_csv, extract_csv_chunks, csv_compression
 from app.data_processor.transform import transform_sensor_data
-from app.data_processor.load import load_parquet
-from app.data_processor.analysis import make_summary_report
-from app.data_processor.pipeline import onboard_machine_readings_etl, produce_summary_report_etl
+from app.data_processor.load import load_parquet, sort_sensor_data, sensor_data_write_options
+from app.data_processor.analysis import make_summary_report, make_summary_report_from_lake, make_window_report, \
+    make_summary_report_from_aggregates
+from app.data_processor.pipeline import onboard_machine_readings, onboard_machine_readings_etl, \
+    produce_summary_report_etl, onboard_day_to_lake_etl, onboard_machine_reading_parts, produce_batch_summary_reports
+from app.data_processor.lake import list_lake_dates, load_day_to_lake, remove_day_from_lake
+from app.data_processor.live import LiveDayAggregates
+from app.data_processor.backfill import main as backfill_main
+from app.data_processor.connections import DuckDBConnectionPool
+from app.data_processor.lookups import LookupIndex, LookupStore
+from app.data_processor.cache import ParquetCache, hash_file
+from app.data_processor.metrics import collect_request_stages, server_timing
 import tempfile
 
 # ------- Fixtures --------
@@ -63,6 +73,32 @@ def test_extract_csv(sample_yesterday_csv):
     assert list(df.columns) == list(pd.read_csv(sample_yesterday_csv).columns), "Check for correct columns"
 
 
+def test_extract_csv_chunks(sample_yesterday_csv):
+
+    with open(sample_yesterday_csv, 'rb') as f:
+        chunks = list(extract_csv_chunks(csv_file=f, chunk_size=1))
+    assert len(chunks) == 1, "Expected a single one-row chunk"
+    assert chunks[0].equals(pd.read_csv(sample_yesterday_csv)), "Chunk mismatch with the full read"
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_extract_compressed_csv(sample_yesterday_csv, tmp_path, compression):
+    import pyarrow as pa
+
+    compressed_csv = os.path.join(tmp_path, f'readings.csv.{compression}')
+    with open(sample_yesterday_csv, 'rb') as src, pa.output_stream(compressed_csv, compression=compression) as dst:
+        dst.write(src.read())
+    expected = pd.read_csv(sample_yesterday_csv)
+
+    assert csv_compression(compressed_csv) == compression
+    assert csv_compression(sample_yesterday_csv) is None
+    assert extract_csv(compressed_csv).equals(expected)
+    with open(compressed_csv, 'rb') as f:
+        chunks = list(extract_csv_chunks(csv_file=f, chunk_size=1))
+        assert not f.closed, "Expected the caller's stream to be left open"
+    assert pd.concat(chunks).equals(expected)
+
+
 def test_load_parquet(sample_yesterday_csv, tmp_path):
 
     df = pd.read_csv(sample_yesterday_csv)
@@ -77,6 +113,29 @@ def test_load_parquet(sample_yesterday_csv, tmp_path):
     assert list(loaded_df.columns) == list(df.columns), "Column mismatch"
     assert loaded_df.equals(df), "Data mismatch between input and loaded DataFrame"
 
+def test_load_parquet_sensor_data_layout(tmp_path):
+
+    df = pd.DataFrame({
+        "machine_code": ["CR1", None, "CONV", "CR1"],
+        "component_code": ["Motor", None, "Motor", "Motor"],
+        "coordinate": ["3V", None, "1A", "1V"],
+        "sample_time": [2, 1, 3, 1],
+        "value": [1.0, 2.0, 3.0, 4.0],
+        "inserted_at": [0, 0, 0, 0]
+    })
+    sorted_df = sort_sensor_data(df)
+    assert list(sorted_df["coordinate"]) == ["1A", "1V", "3V", None], "Expected machine/coordinate order, missing last"
+
+    output = os.path.join(tmp_path, 'sensor_data.parquet')
+    load_parquet(parquet_path=output, df=sorted_df, **sensor_data_write_options(row_group_size=2))
+    import pyarrow.parquet as pq
+    metadata = pq.ParquetFile(output).metadata
+    assert metadata.num_row_groups == 2, "Expected the configured row group size"
+    assert metadata.row_group(0).column(0).compression == 'ZSTD'
+    assert metadata.row_group(0).column(0).statistics.has_min_max
+    assert pd.read_parquet(output).equals(sorted_df), "Data mismatch after loading"
+
+
 def test_transform_sensor_data(sample_yesterday_csv, sample_sensors_csv):
 
     machine_reading_df = extract_csv(sample_yesterday_csv)
@@ -88,6 +147,23 @@ def test_transform_sensor_data(sample_yesterday_csv, sample_sensors_csv):
     assert set(expected_cols).issubset(df.columns), "Expected columns missing"
 
 
+def test_transform_sensor_data_fast_path(sample_sensors_csv):
+
+    sensors_lookup_df = extract_csv(sample_sensors_csv)
+    regular_df = pd.DataFrame({
+        "Tag Name": ["RZR__MTR_001", "RZR__UNKNOWN", None, "RZR__MTR_001"],
+        "Timestamp": ["2024-01-01T00:00:00", "2024-01-01T00:10:00", "2024-01-01T00:20:00", "2024-01-01T00:30:00"],
+        "Value": [10.642, 1.0, 2.0, "n/a"]
+    })
+    irregular_df = regular_df.assign(Timestamp=["2024-01-01T02:00:00+02:00", "2024-01-01T00:10:00+00:00",
+                                                "2024-01-01T00:20:00Z", "2023-12-31T23:30:00-01:00"])
+    for machine_reading_df in (regular_df, irregular_df):
+        fast_df = transform_sensor_data(machine_reading_df, sensors_lookup_df, inserted_at=0)
+        generic_df = transform_sensor_data(machine_reading_df, sensors_lookup_df, inserted_at=0, fast_path=False)
+        pd.testing.assert_frame_equal(fast_df, generic_df)
+    assert list(fast_df["coordinate"].isna()) == [False, True, True, False], "Expected unknown tags to be unmapped"
+
+
 def test_make_summery_report(sample_yesterday_csv, sample_today_csv, sample_machines_csv,tmp_path):
 
     machine_reading_df = extract_csv(sample_yesterday_csv)
@@ -116,6 +192,140 @@ def test_onboard_machine_readings_etl(sample_yesterday_csv, sample_sensors_csv,
     loaded_df = pd.read_parquet(out_parquet)
     assert not loaded_df.empty, "Loaded parquet is empty"
 
+def test_onboard_machine_readings_etl_stage_metrics(sample_yesterday_csv, sample_sensors_csv, tmp_path):
+
+    out_parquet = os.path.join(tmp_path, 'p')
+    with collect_request_stages() as records:
+        onboard_machine_readings_etl(
+            machine_readings_csv=sample_yesterday_csv,
+            sensors_csv=sample_sensors_csv,
+            output_parquet=out_parquet
+        )
+
+    stages = {record.stage: record for record in records}
+    assert stages['extract'].bytes_read > 0
+    assert stages['transform'].rows_in == stages['transform'].rows_out == 1
+    assert stages['load'].bytes_written == os.path.getsize(out_parquet)
+    assert all(record.seconds >= 0 and record.rss_bytes > 0 for record in records)
+    timing = server_timing(records, total_seconds=1)
+    assert 'transform;dur=' in timing and 'desc="1 calls / 1 rows / ' in timing
+    assert timing.split(", ")[-1].startswith('total;dur=1000.0;desc="') and timing.endswith(' MiB peak rss"')
+
+def test_onboard_machine_readings_etl_streaming(sample_yesterday_csv, sample_sensors_csv, tmp_path):
+
+    out_parquet = os.path.join(tmp_path, 'streamed')
+    with open(sample_yesterday_csv, 'rb') as f:
+        onboard_machine_readings_etl(
+            machine_readings_csv=f,
+            sensors_csv=sample_sensors_csv,
+            output_parquet=out_parquet,
+            chunk_size=1
+        )
+    reference_parquet = os.path.join(tmp_path, 'reference')
+    onboard_machine_readings_etl(
+        machine_readings_csv=sample_yesterday_csv,
+        sensors_csv=sample_sensors_csv,
+        output_parquet=reference_parquet
+    )
+
+    streamed_df = pd.read_parquet(out_parquet).drop(columns='inserted_at')
+    reference_df = pd.read_parquet(reference_parquet).drop(columns='inserted_at')
+    assert streamed_df.equals(reference_df), "Streamed onboarding differs from the in-memory one"
+
+def test_onboard_machine_readings_unknown_first_chunk(tmp_path):
+
+    sensors_df = pd.DataFrame({"tag_name": ["T1"], "machine_code": ["CR1"], "component_code": ["Motor"],
+                               "coordinate": ["1V"]})
+    readings_csv = pd.DataFrame({"Tag Name": ["UNKNOWN", "T1"],
+                                 "Timestamp": ["2024-01-01T00:00:00", "2024-01-01T00:10:00"],
+                                 "Value": [1.0, 2.0]}).to_csv(index=False).encode()
+
+    table = onboard_machine_readings(io.BytesIO(readings_csv), sensors_df, chunk_size=1)
+    assert table.column('machine_code').to_pylist() == ['CR1', None], \
+        "Expected a first chunk of unknown tags not to pin null lookup columns"
+
+    out_parquet = os.path.join(tmp_path, 'streamed')
+    assert onboard_machine_readings_etl(machine_readings_csv=io.BytesIO(readings_csv), sensors_csv=sensors_df,
+                                        output_parquet=out_parquet, chunk_size=1) == out_parquet
+    assert pd.read_parquet(out_parquet)['machine_code'].tolist() == ['CR1', None]
+
+def test_onboard_machine_readings_etl_out_of_core(tmp_path):
+    import pyarrow.parquet as pq
+
+    sensors_csv, readings_csv = os.path.join(tmp_path, 'sensors.csv'), os.path.join(tmp_path, 'readings.csv')
+    pd.DataFrame({"tag_name": ["T1", "T2", "T3"], "machine_code": ["CR2", "CR1", "CR1"],
+                  "component_code": ["Motor"] * 3, "coordinate": ["1V", "2V", "1V"]}).to_csv(sensors_csv, index=False)
+    pd.DataFrame({"Tag Name": ["T2", "T1", "UNKNOWN", "T3", "T2", "T1", "T3", "T2", "UNKNOWN", "T3"],
+                  "Timestamp": [f"2024-01-01T00:0{minute}:00" for minute in [3, 1, 2, 2, 1, 1, 2, 3, 1, 0]],
+                  "Value": range(10)}).to_csv(readings_csv, index=False)
+
+    reference_parquet = os.path.join(tmp_path, 'reference')
+    onboard_machine_readings_etl(machine_readings_csv=readings_csv, sensors_csv=sensors_csv,
+                                 output_parquet=reference_parquet)
+    reference_df = pd.read_parquet(reference_parquet).drop(columns='inserted_at')
+
+    for chunk_size in [1, 3, 100]:
+        out_parquet = os.path.join(tmp_path, f'chunked-{chunk_size}')
+        onboard_machine_readings_etl(machine_readings_csv=readings_csv, sensors_csv=sensors_csv,
+                                     output_parquet=out_parquet, chunk_size=chunk_size)
+        chunked_df = pd.read_parquet(out_parquet).drop(columns='inserted_at')
+        assert chunked_df.equals(reference_df), f"Chunks of {chunk_size} rows differ from the in-memory onboarding"
+        assert pq.read_schema(out_parquet).remove_metadata() == pq.read_schema(reference_parquet).remove_metadata()
+
+        in_memory_df = onboard_machine_readings(machine_readings_csv=readings_csv, sensors_csv=sensors_csv,
+                                                chunk_size=chunk_size).to_pandas().drop(columns='inserted_at')
+        assert in_memory_df.equals(reference_df)
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('.sort-')], "Expected the spill to be removed"
+
+def test_onboard_machine_reading_parts(tmp_path):
+
+    sensors_csv = os.path.join(tmp_path, 'sensors.csv')
+    pd.DataFrame({"tag_name": ["T1", "T2", "T3"], "machine_code": ["CR2", "CR1", "CR1"],
+                  "component_code": ["Motor"] * 3, "coordinate": ["1V", "2V", "1V"]}).to_csv(sensors_csv, index=False)
+    readings_df = pd.DataFrame({"Tag Name": ["T2", "T1", "UNKNOWN", "T3", "T2", "T1", "T3", "T2"],
+                                "Timestamp": [f"2024-01-01T00:0{minute}:00" for minute in [3, 1, 2, 2, 1, 1, 2, 3]],
+                                "Value": range(8)})
+    readings_csv = os.path.join(tmp_path, 'readings.csv')
+    readings_df.to_csv(readings_csv, index=False)
+    part_csvs = []
+    for i, rows in enumerate([slice(0, 3), slice(3, 5), slice(5, 8)]):
+        part_csvs.append(os.path.join(tmp_path, f'part-{i}.csv.gz'))
+        readings_df[rows].to_csv(part_csvs[-1], index=False, compression='gzip')
+
+    reference_df = onboard_machine_readings(machine_readings_csv=readings_csv, sensors_csv=sensors_csv) \
+        .to_pandas().drop(columns='inserted_at')
+    for chunk_size in [None, 2]:
+        table = onboard_machine_reading_parts(machine_readings_parts=part_csvs, sensors_csv=sensors_csv,
+                                              chunk_size=chunk_size)
+        assert len(set(table.column('inserted_at').to_pylist())) == 1, "Expected one insertion time for the day"
+        assert table.to_pandas().drop(columns='inserted_at').equals(reference_df)
+
+        out_parquet = os.path.join(tmp_path, f'parts-{chunk_size}')
+        onboard_machine_readings_etl(machine_readings_csv=part_csvs, sensors_csv=sensors_csv,
+                                     output_parquet=out_parquet, chunk_size=chunk_size)
+        assert pd.read_parquet(out_parquet).drop(columns='inserted_at').equals(reference_df)
+
+def test_onboard_machine_readings_etl_duckdb_engine(sample_yesterday_csv, sample_sensors_csv, tmp_path):
+
+    import pyarrow.parquet as pq
+    outputs = {}
+    for engine in ('pandas', 'duckdb'):
+        outputs[engine] = os.path.join(tmp_path, engine)
+        onboard_machine_readings_etl(
+            machine_readings_csv=sample_yesterday_csv,
+            sensors_csv=sample_sensors_csv,
+            output_parquet=outputs[engine],
+            engine=engine
+        )
+
+    pandas_schema = pq.read_schema(outputs['pandas']).remove_metadata()
+    duckdb_schema = pq.read_schema(outputs['duckdb']).remove_metadata()
+    assert duckdb_schema.equals(pandas_schema), "Engines produced different schemas"
+
+    pandas_df = pd.read_parquet(outputs['pandas']).drop(columns='inserted_at')
+    duckdb_df = pd.read_parquet(outputs['duckdb']).drop(columns='inserted_at')
+    assert duckdb_df.equals(pandas_df), "Engines produced different data"
+
 def test_produce_summary_report_etl(sample_yesterday_csv, sample_today_csv, sample_machines_csv, tmp_path):
 
     machine_reading_df = extract_csv(sample_yesterday_csv)
@@ -134,3 +344,368 @@ def test_produce_summary_report_etl(sample_yesterday_csv, sample_today_csv, samp
 
     loaded_df = pd.read_parquet(output_path)
     assert not loaded_df.empty, "Loaded parquet is empty"
+
+
+def test_duckdb_connection_pool(sample_sensors_csv, sample_machines_csv):
+
+    pool = DuckDBConnectionPool(size=2, machines_csv=sample_machines_csv, sensors_csv=sample_sensors_csv)
+    assert not pool.refresh_lookups(), "Expected no reload while the lookup files are unchanged"
+    assert pool.lookup_index.sensors_df.equals(pd.read_csv(sample_sensors_csv)), "Sensors lookup mismatch"
+
+    with pool.connection() as con:
+        assert con.sql("SELECT machine_name FROM machines").fetchall() == [("Crusher A",)]
+
+    pd.DataFrame([{"machine_code": "CR1", "machine_name": "Crusher B"}]).to_csv(sample_machines_csv, index=False)
+    os.utime(sample_machines_csv, (0, 0))
+    with pool.connection() as con:
+        assert con.sql("SELECT machine_name FROM machines").fetchall() == [("Crusher B",)], "Expected a reload"
+    pool.close()
+
+
+def test_lookup_index_and_store(sample_sensors_csv, sample_machines_csv):
+
+    sensors_df = pd.DataFrame({"tag_name": ["T1", "T2", "T3"], "machine_code": ["CR1", "CR1", "CR2"],
+                               "component_code": ["Motor", float("nan"), "Pump"], "coordinate": ["1V", "2V", "1V"]})
+    index = LookupIndex(sensors_df)
+    tags = pd.Series(["T3", "T1", "UNKNOWN", None, "T2", "T3"])
+    mapped = pd.DataFrame(index.map_tags(tags))
+    merged = pd.DataFrame({"tag_name": tags}).merge(sensors_df, on="tag_name", how="left").drop(columns="tag_name")
+    pd.testing.assert_frame_equal(mapped, merged)
+    assert list(index.sensor_ids["machine_code"]) == [0, 0, 1], "Expected machines to be integer keyed"
+    assert LookupIndex(sensors_df.assign(tag_name=["T1", "T1", "T3"])).map_tags(tags) is None, \
+        "Expected duplicate tags to fall back to a merge"
+
+    store = LookupStore(machines_csv=sample_machines_csv, sensors_csv=sample_sensors_csv)
+    first = store.index
+    assert store.index is first, "Expected no reload while the lookup files are unchanged"
+    assert first.versions == {"machines": hash_file(sample_machines_csv), "sensors": hash_file(sample_sensors_csv)}
+
+    pd.DataFrame([{"tag_name": "RZR__MTR_001", "machine_code": "CR1", "component_code": "Motor",
+                   "coordinate": "2V"}]).to_csv(sample_sensors_csv, index=False)
+    os.utime(sample_sensors_csv, (0, 0))
+    second = store.index
+    assert second is not first and second.version != first.version, "Expected a new index to be swapped in"
+    assert second.versions["machines"] == first.versions["machines"]
+    assert list(first.map_tags(pd.Series(["RZR__MTR_001"]))["coordinate"]) == ["1V"], "Expected the old index intact"
+    assert list(second.map_tags(pd.Series(["RZR__MTR_001"]))["coordinate"]) == ["2V"]
+
+
+def test_onboarded_parquet_lookup_version(sample_yesterday_csv, sample_sensors_csv, tmp_path):
+
+    import pyarrow.parquet as pq
+    runs = {
+        'pandas': dict(machine_readings_csv=sample_yesterday_csv),
+        'streaming': dict(machine_readings_csv=sample_yesterday_csv, chunk_size=1),
+        'parts': dict(machine_readings_csv=[sample_yesterday_csv, sample_yesterday_csv]),
+        'duckdb': dict(machine_readings_csv=sample_yesterday_csv, engine='duckdb'),
+    }
+    for name, kwargs in runs.items():
+        output_parquet = onboard_machine_readings_etl(sensors_csv=sample_sensors_csv,
+                                                      output_parquet=os.path.join(tmp_path, name), **kwargs)
+        metadata = pq.read_schema(output_parquet).metadata
+        assert metadata[b"lookup_version"] == hash_file(sample_sensors_csv).encode(), f"{name} not stamped"
+
+
+def test_make_summery_report_pooled_connection(sample_yesterday_csv, sample_today_csv, sample_sensors_csv,
+                                               sample_machines_csv, tmp_path):
+
+    sensor_parquets = [os.path.join(tmp_path, 'p1'), os.path.join(tmp_path, 'p2')]
+    for csv_file, parquet in zip([sample_yesterday_csv, sample_today_csv], sensor_parquets):
+        onboard_machine_readings_etl(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv,
+                                     output_parquet=parquet)
+
+    pool = DuckDBConnectionPool(size=1, machines_csv=sample_machines_csv, sensors_csv=sample_sensors_csv)
+    with pool.connection() as con:
+        df = make_summary_report(sensor_data_parquets=sensor_parquets, connection=con)
+    pool.close()
+    assert df.to_dict(orient="records") == make_summary_report(
+        sensor_data_parquets=sensor_parquets, machines_lookup_csv=sample_machines_csv).to_dict(orient="records")
+    assert list(df["machine_name"]) == ["Crusher A"]
+
+
+def test_produce_batch_summary_reports(sample_yesterday_csv, sample_today_csv, sample_sensors_csv,
+                                      sample_machines_csv, tmp_path):
+
+    broken_csv = os.path.join(tmp_path, 'broken.csv')
+    pd.DataFrame({"Not": [1], "Readings": [2]}).to_csv(broken_csv, index=False)
+    sites = [(f'site-{i}', sample_yesterday_csv, sample_today_csv) for i in range(3)] + \
+            [('reversed', sample_today_csv, sample_yesterday_csv), ('broken', broken_csv, sample_today_csv)]
+
+    results = dict(produce_batch_summary_reports(sites, sensors_csv=sample_sensors_csv,
+                                                 machines_lookup_csv=sample_machines_csv, max_workers=3))
+    assert sorted(results) == sorted(site for site, *_ in sites)
+    assert isinstance(results.pop('broken'), Exception), "Expected a failing site not to fail the others"
+
+    expected = make_summary_report(
+        sensor_data_parquets=[onboard_machine_readings(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv)
+                     for csv_file in [sample_yesterday_csv, sample_today_csv]],
+        machines_lookup_csv=sample_machines_csv)
+    for i in range(3):
+        assert results[f'site-{i}'].to_pandas().to_dict(orient="records") == expected.to_dict(orient="records")
+    assert results['reversed'].num_rows == 0  # readings went down
+
+
+def test_make_summery_report_quoted_paths_and_macro_reuse(sample_yesterday_csv, sample_today_csv, sample_sensors_csv,
+                                                          sample_machines_csv, tmp_path):
+
+    data_dir = os.path.join(tmp_path, "o'hare")
+    os.makedirs(data_dir)
+    sensor_parquets = [os.path.join(data_dir, "p'1"), os.path.join(data_dir, "p'2")]
+    for csv_file, parquet in zip([sample_yesterday_csv, sample_today_csv], sensor_parquets):
+        onboard_machine_readings_etl(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv,
+                                     output_parquet=parquet)
+
+    pool = DuckDBConnectionPool(size=1, machines_csv=sample_machines_csv, sensors_csv=sample_sensors_csv)
+    with pool.connection() as con:
+        reports = [make_summary_report(sensor_data_parquets=sensor_parquets, connection=con) for _ in range(3)]
+        reports.append(make_summary_report(sensor_data_parquets=[[parquet] for parquet in sensor_parquets],
+                                           connection=con))
+        macros = con.execute("SELECT function_name FROM duckdb_functions() "
+                             "WHERE function_name LIKE 'summary_%'").fetchall()
+        views = con.execute("SELECT view_name FROM duckdb_views() WHERE NOT internal").fetchall()
+    pool.close()
+    assert all(report.equals(reports[0]) for report in reports)
+    assert list(reports[0]["machine_name"]) == ["Crusher A"]
+    assert macros == [("summary_absolute_increase_table",)], "Expected the comparison to be defined once"
+    assert views == [], "Expected the per call input views to be dropped"
+
+
+def test_make_summery_report_arrow_tables(sample_yesterday_csv, sample_today_csv, sample_sensors_csv,
+                                          sample_machines_csv, tmp_path):
+
+    sensor_parquets = [os.path.join(tmp_path, 'p1'), os.path.join(tmp_path, 'p2')]
+    for csv_file, parquet in zip([sample_yesterday_csv, sample_today_csv], sensor_parquets):
+        onboard_machine_readings_etl(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv,
+                                     output_parquet=parquet)
+    sensor_tables = [onboard_machine_readings(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv)
+                     for csv_file in [sample_yesterday_csv, sample_today_csv]]
+
+    table = make_summary_report(sensor_data_parquets=sensor_tables, machines_lookup_csv=sample_machines_csv,
+                                as_arrow=True)
+    assert table.to_pylist() == make_summary_report(
+        sensor_data_parquets=sensor_parquets, machines_lookup_csv=sample_machines_csv).to_dict(orient="records")
+    assert table.column_names == ["machine_name", "coordinate", "value_avg", "increase_in_value", "sample_cnt"]
+
+
+def test_make_summery_report_ranking(tmp_path):
+
+    sensors_csv, machines_csv = os.path.join(tmp_path, 'sensors.csv'), os.path.join(tmp_path, 'machines.csv')
+    pd.DataFrame({"tag_name": ["T1", "T2", "T3"], "machine_code": ["CR1", "CR1", "CR2"],
+                  "component_code": ["Motor"] * 3, "coordinate": ["1V", "2V", "1V"]}).to_csv(sensors_csv, index=False)
+    pd.DataFrame({"machine_code": ["CR1", "CR2"], "machine_name": ["Crusher A", "Crusher B"]}).to_csv(machines_csv,
+                                                                                                 index=False)
+    sensor_tables = [onboard_machine_readings(
+        machine_readings_csv=io.StringIO(pd.DataFrame({"Tag Name": ["T1", "T2", "T3"],
+                                                       "Timestamp": [f"2024-01-0{day}T00:00:00"] * 3,
+                                                       "Value": values}).to_csv(index=False)),
+        sensors_csv=sensors_csv) for day, values in [(1, [10, 20, 5]), (2, [12, 30, 5.5])]]
+
+    def report(**ranking):
+        df = make_summary_report(sensor_data_parquets=sensor_tables, machines_lookup_csv=machines_csv, **ranking)
+        return list(zip(df["machine_name"], df["coordinate"]))
+
+    assert report() == [("Crusher A", "2V"), ("Crusher B", "1V")]
+    assert report(top_k=2) == [("Crusher A", "2V"), ("Crusher A", "1V"), ("Crusher B", "1V")]
+    assert report(top_k=2, min_increase=1) == [("Crusher A", "2V"), ("Crusher A", "1V")]
+    assert report(top_k=2, min_increase=0.15, increase_mode="relative") == [("Crusher A", "2V"), ("Crusher A", "1V")]
+    assert report(top_k=2, machine_codes=["CR2"]) == [("Crusher B", "1V")]
+    assert report(top_k=2, sort_by="value") == [("Crusher A", "2V"), ("Crusher A", "1V"), ("Crusher B", "1V")]
+    assert report(sort_by="machine") == [("Crusher A", "2V"), ("Crusher B", "1V")]
+    with pytest.raises(ValueError):
+        report(sort_by="nope")
+
+
+def test_live_day_aggregates(tmp_path):
+
+    sensors_df = pd.DataFrame({"tag_name": ["T1", "T2", "T3"], "machine_code": ["CR1", "CR1", "CR2"],
+                               "component_code": ["Motor"] * 3, "coordinate": ["1V", "2V", "1V"]})
+    machines_csv = os.path.join(tmp_path, 'machines.csv')
+    pd.DataFrame({"machine_code": ["CR1", "CR2"], "machine_name": ["Crusher A", "Crusher B"]}).to_csv(machines_csv,
+                                                                                                 index=False)
+    days = {day: pd.DataFrame({"Tag Name": ["T1", "T2", "T3", "T1", "T9"],
+                               "Timestamp": [f"2024-01-0{day}T0{hour}:00:00" for hour in range(5)],
+                               "Value": [v * day for v in [10, 20, 5, 14, 1]]}) for day in [1, 2]}
+
+    live_dir = os.path.join(tmp_path, 'live')
+    live_day = LiveDayAggregates(flush_dir=live_dir)
+    assert live_day.append(days[1], sensors_df) == {'date': '2024-01-01', 'rows': 4, 'late_rows': 0,
+                                                    'unmapped_rows': 1}
+    for batch in [days[2][:2], days[2][2:]]:
+        live_day.append(batch, sensors_df)
+    assert live_day.append(days[1], sensors_df)['late_rows'] == 5, "Expected yesterday's readings to be dropped"
+    assert list_lake_dates(live_dir) == ['2024-01-01'], "Expected the finished day to be flushed on roll over"
+    live_day.flush()
+    assert LiveDayAggregates(flush_dir=live_dir).snapshot().sort_by('coordinate').equals(
+        live_day.snapshot().sort_by('coordinate')), "Expected the restart to resume from the flush"
+
+    live_report = make_summary_report_from_aggregates(
+        yesterday_aggregates=os.path.join(live_dir, 'aggregates', 'date=2024-01-01', 'part.parquet'),
+        today_aggregates=live_day.snapshot(), machines_lookup_csv=machines_csv, top_k=2)
+    day_report = make_summary_report(
+        sensor_data_parquets=[onboard_machine_readings(io.BytesIO(days[day].to_csv(index=False).encode()),
+                                                       sensors_df) for day in [1, 2]],
+        machines_lookup_csv=machines_csv, top_k=2)
+    pd.testing.assert_frame_equal(live_report, day_report)
+
+
+def test_live_day_aggregates_batch_across_midnight(tmp_path):
+
+    sensors_df = pd.DataFrame({"tag_name": ["T1"], "machine_code": ["CR1"], "component_code": ["Motor"],
+                               "coordinate": ["1V"]})
+    batch = pd.DataFrame({"Tag Name": ["T1"] * 3,
+                          "Timestamp": ["2024-01-01T23:59:50", "2024-01-01T23:59:59", "2024-01-02T00:00:01"],
+                          "Value": [10.0, 20.0, 7.0]})
+
+    live_dir = os.path.join(tmp_path, 'live')
+    live_day = LiveDayAggregates(flush_dir=live_dir)
+    assert live_day.append(batch, sensors_df) == {'date': '2024-01-02', 'rows': 3, 'late_rows': 0,
+                                                  'unmapped_rows': 0}
+    flushed = pd.read_parquet(os.path.join(live_dir, 'aggregates', 'date=2024-01-01', 'part.parquet'))
+    assert flushed[['value_sum', 'value_cnt']].to_dict(orient="records") == [{'value_sum': 30.0, 'value_cnt': 2}], \
+        "Expected the finished day's readings of the batch in its flush"
+    assert live_day.snapshot().to_pydict()['value_sum'] == [7.0]
+
+
+def test_hash_file(sample_yesterday_csv):
+
+    with open(sample_yesterday_csv, 'rb') as f:
+        f.read(3)
+        assert hash_file(f) == hash_file(sample_yesterday_csv), "Expected the stream to be hashed from the start"
+        assert f.tell() == 0, "Expected the stream to be rewound"
+
+
+def test_parquet_cache(sample_yesterday_csv, tmp_path):
+
+    df = pd.read_csv(sample_yesterday_csv)
+    cache = ParquetCache(cache_dir=os.path.join(tmp_path, 'cache'), max_bytes=1)
+    builds = []
+
+    def build(path):
+        builds.append(path)
+        return load_parquet(parquet_path=path, df=df)
+
+    first = cache.get_or_create('a', build)
+    assert cache.get_or_create('a', build) == first and len(builds) == 1, "Expected a single build per key"
+    assert pd.read_parquet(first).equals(df), "Cached data mismatch"
+
+    second = cache.get_or_create('b', build)
+    assert cache.get('a') is None, "Expected the least recently used entry to be evicted"
+    assert cache.get('b') == second, "Expected the newest entry to be kept"
+
+    # leased entries outlive evictions until the lease is released
+    with cache.lease() as lease:
+        assert cache.get('b', lease=lease) == second
+        cache.get_or_create('c', build)
+        assert os.path.exists(second), "Expected a leased entry not to be evicted"
+    cache.get_or_create('d', build)
+    assert not os.path.exists(second), "Expected a released entry to be evictable again"
+
+
+def test_summary_report_from_lake(sample_yesterday_csv, sample_today_csv, sample_sensors_csv, sample_machines_csv,
+                                  tmp_path):
+
+    lake_dir = os.path.join(tmp_path, 'lake')
+    sensor_parquets = [os.path.join(tmp_path, 'p1'), os.path.join(tmp_path, 'p2')]
+    for csv_file, parquet, date in zip([sample_yesterday_csv, sample_today_csv], sensor_parquets,
+                                       ['2024-01-01', '2024-01-02']):
+        onboard_machine_readings_etl(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv,
+                                     output_parquet=parquet)
+        assert onboard_day_to_lake_etl(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv,
+                                       lake_dir=lake_dir, date=date) == date
+    assert list_lake_dates(lake_dir) == ['2024-01-01', '2024-01-02']
+    assert os.path.isdir(os.path.join(lake_dir, 'readings', 'machine_code=CR1', 'date=2024-01-02'))
+
+    expected = make_summary_report(sensor_data_parquets=sensor_parquets, machines_lookup_csv=sample_machines_csv)
+    df = make_summary_report_from_lake(lake_dir=lake_dir, yesterday_date='2024-01-01', today_date='2024-01-02',
+                                       machines_lookup_csv=sample_machines_csv)
+    pd.testing.assert_frame_equal(df, expected)
+
+    # replacing a day leaves the others alone
+    onboard_day_to_lake_etl(machine_readings_csv=sample_yesterday_csv, sensors_csv=sample_sensors_csv,
+                            lake_dir=lake_dir, date='2024-01-02')
+    df = make_summary_report_from_lake(lake_dir=lake_dir, yesterday_date='2024-01-01', today_date='2024-01-02',
+                                       machines_lookup_csv=sample_machines_csv)
+    assert df.empty, "Expected no increase once both days hold the same readings"
+    assert remove_day_from_lake(lake_dir=lake_dir, date='2024-01-02')
+    assert list_lake_dates(lake_dir) == ['2024-01-01']
+
+
+def test_load_day_to_lake_failure(sample_yesterday_csv, sample_sensors_csv, tmp_path):
+    import duckdb
+
+    day_parquet = os.path.join(tmp_path, 'day.parquet')
+    onboard_machine_readings_etl(machine_readings_csv=sample_yesterday_csv, sensors_csv=sample_sensors_csv,
+                                 output_parquet=day_parquet)
+    lake_dir = os.path.join(tmp_path, 'lake')
+    assert load_day_to_lake(day_parquet=day_parquet, lake_dir=lake_dir, date='2024-01-01') == '2024-01-01'
+
+    class FailingReadingsCopy:
+        def execute(self, query, params=None):
+            if 'PARTITION_BY' in query:
+                raise duckdb.IOException("No space left on device")
+            return duckdb.execute(query, params)
+
+    assert load_day_to_lake(day_parquet=day_parquet, lake_dir=lake_dir, date='2024-01-01',
+                            connection=FailingReadingsCopy()) == ''
+    assert list_lake_dates(lake_dir) == [], "Expected a half landed date not to be listed, so a resume retries it"
+    assert sorted(os.listdir(lake_dir)) == ['aggregates', 'readings'], "Expected no staging leftovers"
+    assert load_day_to_lake(day_parquet=day_parquet, lake_dir=lake_dir, date='2024-01-01') == '2024-01-01'
+    assert list_lake_dates(lake_dir) == ['2024-01-01']
+
+
+def test_make_window_report(sample_sensors_csv, sample_machines_csv, tmp_path):
+
+    lake_dir = os.path.join(tmp_path, 'lake')
+    for day, value in enumerate([1.0, 2.0, 3.0, 10.0], start=1):
+        csv_file = os.path.join(tmp_path, f'{day}.csv')
+        pd.DataFrame([{"Tag Name": "RZR__MTR_001", "Timestamp": f"2024-01-0{day}T00:00:00", "Value": value}]) \
+            .to_csv(csv_file, index=False)
+        onboard_day_to_lake_etl(machine_readings_csv=csv_file, sensors_csv=sample_sensors_csv,
+                                lake_dir=lake_dir, date=f'2024-01-0{day}')
+
+    trailing = make_window_report(lake_dir=lake_dir, date='2024-01-04', window=3, mode='trailing',
+                                  machines_lookup_csv=sample_machines_csv)
+    assert trailing.to_dict(orient="records") == [{"machine_name": "Crusher A", "coordinate": "1V", "value_avg": 10.0,
+                                                   "increase_in_value": 8.0, "sample_cnt": 1}]
+
+    period = make_window_report(lake_dir=lake_dir, date='2024-01-04', window=2, mode='period',
+                                machines_lookup_csv=sample_machines_csv)
+    assert period.to_dict(orient="records") == [{"machine_name": "Crusher A", "coordinate": "1V", "value_avg": 6.5,
+                                                 "increase_in_value": 5.0, "sample_cnt": 2}]
+
+
+def test_backfill(sample_yesterday_csv, sample_today_csv, sample_sensors_csv, sample_machines_csv, tmp_path):
+
+    csv_dir = os.path.join(tmp_path, 'csv')
+    os.makedirs(csv_dir)
+    for csv_file, date in [(sample_yesterday_csv, '2024-01-01'), (sample_today_csv, '2024-01-02')]:
+        pd.read_csv(csv_file).to_csv(os.path.join(csv_dir, f'{date}.csv'), index=False)
+    output_dir, lake_dir = os.path.join(tmp_path, 'parquet'), os.path.join(tmp_path, 'lake')
+    timings_json = os.path.join(tmp_path, 'timings.json')
+    argv = [csv_dir, '--sensors-csv', sample_sensors_csv, '--machines-csv', sample_machines_csv,
+            '--output-dir', output_dir, '--lake-dir', lake_dir, '--workers', '1', '--timings-json', timings_json]
+
+    assert backfill_main(argv) == 0
+    assert sorted(os.listdir(output_dir)) == ['2024-01-01.parquet', '2024-01-02.parquet', 'summary-2024-01-02.parquet']
+    assert list_lake_dates(lake_dir) == ['2024-01-01', '2024-01-02']
+
+    # resumable, everything already onboarded is skipped
+    assert backfill_main(argv) == 0
+    import json
+    with open(timings_json) as f:
+        assert {record['status'] for record in json.load(f)} == {'skipped'}
+
+
+def test_backfill_interrupted_write(tmp_path):
+    from app.data_processor.backfill import _write_atomically
+
+    output_parquet = os.path.join(tmp_path, '2024-01-01.parquet')
+
+    def killed_mid_write(tmp_parquet):
+        with open(tmp_parquet, 'wb') as f:
+            f.write(b'PAR1')
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        _write_atomically(output_parquet, killed_mid_write)
+    assert os.listdir(tmp_path) == [], "Expected no partial parquet for a resumed backfill to skip"
@@ -5,11 +5,21 @@ import os
 import pytest
 import pandas as pd
 from httpx import AsyncClient, ASGITransport
+from app.api import config
 from app.api.api import app
+from app.data_processor.pipeline import onboard_day_to_lake_etl
 
+import io
+import pyarrow as pa
 import tempfile
 
 # ------- Fixtures --------
+@pytest.fixture(autouse=True)
+def tmp_cache_dir(tmp_path, monkeypatch):
+    cache_dir = os.path.join(tmp_path, "cache")
+    monkeypatch.setattr(config, "CACHE_DIR", cache_dir)
+    yield cache_dir
+
 @pytest.fixture
 def sample_yesterday_csv():
     df = pd.DataFrame([{
@@ -32,27 +42,359 @@ def sample_today_csv():
         df.to_csv(f.name, index=False)
         yield f.name
 
+@pytest.fixture
+def report_files(sample_yesterday_csv, sample_today_csv):
+    """Factory of fresh multipart uploads of the two sample days, optionally under other filenames."""
+    handles = []
+
+    def files(names=None):
+        paths = (sample_yesterday_csv, sample_today_csv)
+        names = names or [os.path.basename(path) for path in paths]
+        handles.extend(open(path, "rb") for path in paths)
+        return [("machine_readings_csv", (name, handle, "text/csv")) for name, handle in zip(names, handles[-2:])]
+
+    yield files
+    for handle in handles:
+        handle.close()
+
 # ------- Tests --------
 
 @pytest.mark.asyncio
 async def test_make_report_endpoint(sample_yesterday_csv, sample_today_csv):
-    # TODO: Fails on lookup tables not being found because of docker vs local structure
-    # TODO: Solution is for dynamic base dir inference
-    pass
-    # files = [
-    #     ("machine_readings_csv", (os.path.basename(sample_yesterday_csv), open(sample_yesterday_csv, "rb"), "text/csv")),
-    #     ("machine_readings_csv", (os.path.basename(sample_today_csv), open(sample_today_csv, "rb"), "text/csv")),
-    # ]
-    #
-    # async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
-    #     response = await ac.post("/report", files=files)
-    # print("Response content:", response.text)
-    # assert response.status_code == 200
-    # json_data = response.json()
-    #
-    # assert "machines" in json_data
-    # assert "metadata" in json_data
-    # assert isinstance(json_data["machines"], list)
-    # assert "date" in json_data["metadata"]
-    # assert "today_data" in json_data["metadata"]
-    # assert "yesterday_data" in json_data["metadata"]
\ No newline at end of file
+    files = [
+        ("machine_readings_csv", (os.path.basename(sample_yesterday_csv), open(sample_yesterday_csv, "rb"), "text/csv")),
+        ("machine_readings_csv", (os.path.basename(sample_today_csv), open(sample_today_csv, "rb"), "text/csv")),
+    ]
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/report", files=files)
+    print("Response content:", response.text)
+    assert response.status_code == 200
+    json_data = response.json()
+
+    assert "machines" in json_data
+    assert "metadata" in json_data
+    assert isinstance(json_data["machines"], list)
+    assert "date" in json_data["metadata"]
+    assert "today_data" in json_data["metadata"]
+    assert "yesterday_data" in json_data["metadata"]
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_queue_full(sample_yesterday_csv, sample_today_csv):
+    files = [
+        ("machine_readings_csv", (os.path.basename(sample_yesterday_csv), open(sample_yesterday_csv, "rb"), "text/csv")),
+        ("machine_readings_csv", (os.path.basename(sample_today_csv), open(sample_today_csv, "rb"), "text/csv")),
+    ]
+
+    async with app.router.lifespan_context(app):
+        app.state.worker_pool.max_pending = 0
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/report", files=files)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_cached(report_files, tmp_cache_dir):
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            first = await ac.post("/report", files=report_files())
+            cached = sorted(os.listdir(tmp_cache_dir))
+            second = await ac.post("/report", files=report_files())
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert len(cached) == 3, "Expected both days and the summary to be cached"
+    assert sorted(os.listdir(tmp_cache_dir)) == cached, "Expected the repeated request to be served from cache"
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_large_days(report_files, tmp_cache_dir, monkeypatch):
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            in_memory = await ac.post("/report", files=report_files(["2024-01-01.csv", "2024-01-02.csv"]))
+            for name in os.listdir(tmp_cache_dir):
+                os.remove(os.path.join(tmp_cache_dir, name))
+            monkeypatch.setattr(config, "CACHE_ONBOARDED_DAYS", False)
+            monkeypatch.setattr(config, "IN_MEMORY_ONBOARD_MAX_BYTES", 0)
+            streamed = await ac.post("/report", files=report_files(["2024-01-01.csv", "2024-01-02.csv"]))
+    assert in_memory.status_code == streamed.status_code == 200
+    assert streamed.json() == in_memory.json()
+    assert len([name for name in os.listdir(tmp_cache_dir) if name.startswith("day-")]) == 2, \
+        "Expected days over the in memory limit to be onboarded into the cache"
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_compressed_days_streamed(sample_yesterday_csv, sample_today_csv, tmp_cache_dir,
+                                                             monkeypatch):
+    import gzip
+
+    monkeypatch.setattr(config, "CACHE_ONBOARDED_DAYS", False)
+    files = [("machine_readings_csv", (f"{date}.csv.gz", io.BytesIO(gzip.compress(open(csv_file, "rb").read())),
+                                       "application/gzip"))
+             for date, csv_file in [("2024-01-01", sample_yesterday_csv), ("2024-01-02", sample_today_csv)]]
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/report", files=files)
+    assert response.status_code == 200
+    assert len([name for name in os.listdir(tmp_cache_dir) if name.startswith("day-")]) == 2, \
+        "Expected compressed days, of unknown expanded size, to be streamed into the cache"
+
+
+@pytest.mark.asyncio
+async def test_make_window_report_endpoint(sample_yesterday_csv, sample_today_csv, tmp_path, monkeypatch):
+    lake_dir = os.path.join(tmp_path, "lake")
+    monkeypatch.setattr(config, "LAKE_DIR", lake_dir)
+    for csv_file, date in [(sample_yesterday_csv, "2024-01-01"), (sample_today_csv, "2024-01-02")]:
+        onboard_day_to_lake_etl(machine_readings_csv=csv_file, sensors_csv=config.SENSORS_CSV,
+                                lake_dir=lake_dir, date=date)
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.get("/report/window", params={"date": "2024-01-02", "window": 7})
+            missing = await ac.get("/report/window", params={"date": "2024-02-01", "window": 7})
+    assert response.status_code == 200
+    json_data = response.json()
+    assert [m["coordinate"] for m in json_data["machines"]] == ["1V"]
+    assert json_data["metadata"]["baseline_start"] == "2023-12-26"
+    assert json_data["metadata"]["baseline_end"] == "2024-01-01"
+    assert missing.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_metrics_and_server_timing(sample_yesterday_csv, sample_today_csv):
+    files = [
+        ("machine_readings_csv", (os.path.basename(sample_yesterday_csv), open(sample_yesterday_csv, "rb"), "text/csv")),
+        ("machine_readings_csv", (os.path.basename(sample_today_csv), open(sample_today_csv, "rb"), "text/csv")),
+    ]
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            response = await ac.post("/report", files=files)
+            metrics = await ac.get("/metrics")
+    assert response.status_code == 200
+    timings = [entry.split(";")[0].strip() for entry in response.headers["Server-Timing"].split(",")]
+    for stage in ["extract", "transform", "load", "analysis", "total"]:
+        assert stage in timings
+    assert metrics.status_code == 200
+    assert 'etl_stage_calls_total{stage="transform"}' in metrics.text
+    assert 'etl_stage_max_rss_bytes{stage="transform"}' in metrics.text
+    assert 'http_requests_total{method="POST",route="/report",status="200"}' in metrics.text
+
+
+@pytest.mark.asyncio
+async def test_report_job(report_files):
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            submitted = await ac.post("/report/jobs", files=report_files())
+            duplicate = await ac.post("/report/jobs", files=report_files())
+            renamed = await ac.post("/report/jobs", files=report_files(["2024-01-01.csv", "2024-01-02.csv"]))
+            await app.state.report_jobs.get(renamed.json()["job_id"]).task
+            renamed_polled = await ac.get(renamed.headers["Location"])
+            await app.state.report_jobs.get(submitted.json()["job_id"]).task
+            polled = await ac.get(submitted.headers["Location"])
+            report = await ac.post("/report", files=report_files())
+            missing = await ac.get("/report/0123456789abcdef")
+    assert submitted.status_code == duplicate.status_code == 202
+    assert duplicate.json()["job_id"] == submitted.json()["job_id"], "Expected identical submissions to share a job"
+    assert polled.status_code == 200
+    assert polled.json()["status"] == "succeeded"
+    assert polled.json()["progress"] == 1
+    assert polled.json()["result"] == report.json()
+    assert renamed.json()["job_id"] != submitted.json()["job_id"], \
+        "Expected the same content under other names not to share the job (its metadata names the files)"
+    assert renamed_polled.json()["result"]["metadata"]["today_data"] == "2024-01-02.csv"
+    assert missing.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_formats(sample_today_csv, report_files):
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            as_json = await ac.post("/report", files=report_files())
+            as_arrow = await ac.post("/report", files=report_files(),
+                                     headers={"Accept": "application/json;q=0.5, application/vnd.apache.arrow.stream"})
+            as_parquet = await ac.post("/report", files=report_files(), headers={"Accept": "application/x-parquet"})
+            unsupported = await ac.post("/report", files=report_files(), headers={"Accept": "text/html"})
+    assert as_json.status_code == as_arrow.status_code == as_parquet.status_code == 200
+    assert as_arrow.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    assert as_parquet.headers["X-Report-Today-Data"] == os.path.basename(sample_today_csv)
+    machines = pd.DataFrame(as_json.json()["machines"])
+    arrow_df = pa.ipc.open_stream(as_arrow.content).read_pandas()
+    parquet_df = pd.read_parquet(io.BytesIO(as_parquet.content))
+    assert arrow_df.equals(machines)
+    assert parquet_df[list(machines.columns)].equals(machines)
+    assert unsupported.status_code == 406
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_non_ascii_filenames(sample_yesterday_csv, sample_today_csv):
+    import urllib.parse
+
+    files = [
+        ("machine_readings_csv", ("אתמול.csv", open(sample_yesterday_csv, "rb"), "text/csv")),
+        ("machine_readings_csv", ("היום.csv", open(sample_today_csv, "rb"), "text/csv")),
+    ]
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            as_parquet = await ac.post("/report", files=files, headers={"Accept": "application/x-parquet"})
+    assert as_parquet.status_code == 200
+    assert urllib.parse.unquote(as_parquet.headers["X-Report-Yesterday-Data"]) == "אתמול.csv"
+    assert urllib.parse.unquote(as_parquet.headers["X-Report-Today-Data"]) == "היום.csv"
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_ranking(report_files, tmp_cache_dir):
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            default = await ac.post("/report", files=report_files())
+            filtered = await ac.post("/report", files=report_files(), params={"machines": "NOPE", "top_k": 3})
+            above = await ac.post("/report", files=report_files(), params={"min_increase": 1})
+            invalid = await ac.post("/report", files=report_files(), params={"sort_by": "nope"})
+    assert len(default.json()["machines"]) == 1
+    assert filtered.json()["machines"] == []
+    assert above.json()["machines"] == [], "Expected the 0.458 increase to be filtered out"
+    assert invalid.status_code == 400
+    assert len([name for name in os.listdir(tmp_cache_dir) if name.startswith("summary-")]) == 3
+
+
+@pytest.mark.asyncio
+async def test_make_report_endpoint_compressed_parts(sample_yesterday_csv, sample_today_csv, tmp_path):
+    import gzip
+
+    today_df = pd.read_csv(sample_today_csv)
+    today_parts = [today_df.assign(Value=10.0), today_df.assign(Value=12.0)]  # averages to 11.0
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            plain = await ac.post("/report", files=[
+                ("machine_readings_csv", ("2024-01-01.csv", open(sample_yesterday_csv, "rb"), "text/csv")),
+                ("machine_readings_csv", ("2024-01-02.csv", io.BytesIO(pd.concat(today_parts).to_csv(
+                    index=False).encode()), "text/csv"))])
+            parts = await ac.post("/report", files=[
+                ("machine_readings_csv", ("2024-01-02.CR1.csv.gz", io.BytesIO(gzip.compress(
+                    today_parts[0].to_csv(index=False).encode())), "application/gzip")),
+                ("machine_readings_csv", ("2024-01-01.csv.gz", io.BytesIO(gzip.compress(
+                    open(sample_yesterday_csv, "rb").read())), "application/gzip")),
+                ("machine_readings_csv", ("2024-01-02.CR2.csv", io.BytesIO(
+                    today_parts[1].to_csv(index=False).encode()), "text/csv"))])
+            three_days = await ac.post("/report", files=[
+                ("machine_readings_csv", (f"2024-01-0{day}.csv", open(sample_today_csv, "rb"), "text/csv"))
+                for day in [1, 2, 3]])
+    assert plain.status_code == parts.status_code == 200
+    assert parts.json()["machines"] == plain.json()["machines"]
+    assert parts.json()["metadata"] == {"date": "2024-01-02", "yesterday_data": "2024-01-01.csv.gz",
+                                        "today_data": "2024-01-02.CR1.csv.gz,2024-01-02.CR2.csv"}
+    assert three_days.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_live_readings_and_report(sample_yesterday_csv, tmp_path, monkeypatch):
+    lake_dir, live_dir = os.path.join(tmp_path, "lake"), os.path.join(tmp_path, "live")
+    monkeypatch.setattr(config, "LAKE_DIR", lake_dir)
+    monkeypatch.setattr(config, "LIVE_DIR", live_dir)
+    onboard_day_to_lake_etl(machine_readings_csv=sample_yesterday_csv, sensors_csv=config.SENSORS_CSV,
+                            lake_dir=lake_dir, date="2024-01-01")
+
+    def readings(*rows):
+        return pd.DataFrame(rows, columns=["Tag Name", "Timestamp", "Value"]).to_csv(index=False)
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            empty = await ac.get("/live/report")
+            first = await ac.post("/live/readings", content=readings(("RZR__MTR_001", "2024-01-02T00:00:00", 11.0),
+                                                                      ("RZR__UNKNOWN", "2024-01-02T00:00:00", 1.0)),
+                                  headers={"Content-Type": "text/csv"})
+            second = await ac.post("/live/readings", content=readings(("RZR__MTR_001", "2024-01-02T00:10:00", 12.0),
+                                                                       ("RZR__MTR_001", "2024-01-01T23:59:00", 1.0)),
+                                   headers={"Content-Type": "text/csv"})
+            report = await ac.get("/live/report")
+            wrong_type = await ac.post("/live/readings", content=b"{}", headers={"Content-Type": "application/json"})
+    assert empty.status_code == 404
+    assert first.json() == {"date": "2024-01-02", "rows": 1, "late_rows": 0, "unmapped_rows": 1}
+    assert second.json() == {"date": "2024-01-02", "rows": 1, "late_rows": 1, "unmapped_rows": 0}
+    assert report.status_code == 200
+    assert [(m["coordinate"], m["value_avg"], m["sample_cnt"]) for m in report.json()["machines"]] == [("1V", 11.5, 2)]
+    assert report.json()["metadata"]["yesterday_source"] == "lake"
+    assert wrong_type.status_code == 415
+    assert os.listdir(os.path.join(live_dir, "aggregates")) == ["date=2024-01-02"], "Expected a flush on shutdown"
+
+
+@pytest.mark.asyncio
+async def test_readiness_after_warm_up():
+    import asyncio
+    from app.data_processor.metrics import METRICS
+
+    METRICS.reset()
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            health = await ac.get("/healthz")
+            warming = await ac.get("/readyz")
+            for _ in range(300):
+                ready = await ac.get("/readyz")
+                if ready.status_code == 200:
+                    break
+                await asyncio.sleep(0.05)
+    assert health.json() == {"status": "ok"}
+    assert warming.status_code == 503
+    assert ready.status_code == 200
+    metrics = METRICS.render()
+    assert 'stage="transform"' not in metrics and 'stage="analysis"' not in metrics, \
+        "Expected the warm-up to stay out of the metrics"
+
+
+@pytest.mark.asyncio
+async def test_make_batch_report_endpoint(sample_yesterday_csv, sample_today_csv):
+    import json
+
+    def batch_files():
+        return [
+            ("machine_readings_csv", ("2024-01-01.csv", open(sample_yesterday_csv, "rb"), "text/csv")),
+            ("machine_readings_csv", ("2024-01-02.csv", open(sample_today_csv, "rb"), "text/csv")),
+            ("machine_readings_csv", ("2024-01-02.csv", open(sample_yesterday_csv, "rb"), "text/csv")),
+            ("machine_readings_csv", ("2024-01-01.csv", open(sample_today_csv, "rb"), "text/csv")),
+            ("machine_readings_csv", ("2024-01-01.csv", io.BytesIO(b"Not,Readings\n1,2\n"), "text/csv")),
+            ("machine_readings_csv", ("2024-01-02.csv", io.BytesIO(b"Not,Readings\n1,2\n"), "text/csv")),
+        ]
+    sites = {"sites": ["north", "north", "south", "south", "broken", "broken"]}
+
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            single = await ac.post("/report", files=batch_files()[:2])
+            batch = await ac.post("/report/batch", files=batch_files(), data=sites)
+            streamed = await ac.post("/report/batch", files=batch_files(), data=sites,
+                                     headers={"Accept": "application/x-ndjson"})
+            mismatched = await ac.post("/report/batch", files=batch_files(), data={"sites": ["north"]})
+
+    assert batch.status_code == 200
+    site_reports = batch.json()["sites"]
+    assert [site_report["site"] for site_report in site_reports] == ["north", "south", "broken"], \
+        "Expected the sites in submission order"
+    north, south, broken = site_reports
+    assert north["status"] == south["status"] == "succeeded"
+    assert north["report"] == single.json()
+    # south's days come from the filenames: its readings went down, no increase to report
+    assert south["report"] == {"machines": [], "metadata": {"date": "2024-01-02", "yesterday_data": "2024-01-01.csv",
+                                                             "today_data": "2024-01-02.csv"}}
+    assert broken["status"] == "failed" and broken["error"] and broken["report"] is None
+
+    assert streamed.status_code == 200
+    assert streamed.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in streamed.text.splitlines()]
+    assert sorted(lines, key=lambda site_report: site_report["site"]) == \
+        sorted(site_reports, key=lambda site_report: site_report["site"])
+
+    assert mismatched.status_code == 400
+
+
+def test_app_import_leaves_data_stack_to_warm_up():
+    import subprocess
+    import sys
+
+    code = "import sys, app.api.api; print(sorted({'duckdb', 'pandas', 'pyarrow'} & set(sys.modules)))"
+    loaded = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    assert loaded == "[]", "Expected the data stack to be loaded by the warm-up, not on import"